@@ -4,14 +4,37 @@
 
 import os
 import time
+import argparse
+import traceback
+import multiprocessing
+import threading
 import datetime
 import requests
+import archive
+import blobstore
+import catalog
+import dedup
+import delta
+import engine
+import httpcache
+import httpsession
+import journal
+import metrics
+import pagination
+import parsepool
 import parsers
+import pipeline
+import profiling
+import related
 import resources
+import retry
+import scheduler
+import sessionhealth
+import sinks
+import workqueue
 from utils import (
     correct_name_generator, 
-    create_subdir, 
-    set_cookie
+    create_subdir
 )
 
 class OSMixin:
@@ -19,7 +42,7 @@ class OSMixin:
     BASE_DIR = '/home/dgachechiladze/Desktop/Ford'
 
     def create_dir(self, menu_name):
-        dirname = os.path.join(OSMixin.BASE_DIR, menu_name)
+        dirname = os.path.join(self.__class__.BASE_DIR, menu_name)
         try:
             os.mkdir(dirname)
         except FileExistsError as exc:
@@ -36,101 +59,818 @@ class DownloadClient(OSMixin):
 
     BASE_URL = 'https://parts.ford.com/shop/en/us/shop-parts'
     XHR_BASE_URL = 'https://parts.ford.com/shop/FordRelatedItemsView'
+    BLOB_DIR = '.blobs' # inside BASE_DIR, next to menu directories
+    SHARD_POLL_INTERVAL = 0.2 # seconds, idle shard worker waits for units of other workers
+    STAGE_WORKERS = {'submenu': 2, 'list': 4, 'content': 16, 'related': 8, 'download': 16} # worker threads per pipeline stage
     
-    def __init__(self):
+    def __init__(self, concurrency=None, per_host_concurrency=None, pool_size=None, retries=None, timeout=None,
+                 streaming=True, stage_workers=None, queue_size=None, journal_path=None, max_attempts=None,
+                 parser_backend=None, metrics_path=None, metrics_interval=None, parse_workers=0,
+                 deduplicate=True, blob_store=True, blob_dir=None, chunk_size=None, output='dirs',
+                 cache_dir=None, cache_size=None, delta_path=None, delta_recheck=False,
+                 record_path=None, replay_path=None, record_streams=False, related_items=True,
+                 related_concurrency=None, session_health=True, cookie_provider=None, rotate_cookies=None, logon_url=None,
+                 shard_queue=None, worker_id=None, deadline=None, menu_weights=None, smallest_first=False,
+                 content_first=False, eta_interval=None, probe_page_sizes=None, profile_targets=None,
+                 profile_mode='sample', profile_dir=None, profile_memory=False, catalog_path=None):
         self.menu_dict = {} # this variable is shared by multiple methods...
-        cookies = set_cookie()
+        # sharded crawl: units are claimed from queue shared by worker processes, see workqueue.py
+        self.work_queue = workqueue.WorkQueue(shard_queue, worker_id=worker_id) if shard_queue else None
+        if self.work_queue is not None and output != 'dirs':
+            raise ValueError('sharded crawl writes directory output only')
+        self.deduplicate = deduplicate
+        # finished work is recorded here and skipped by a restarted client
+        self.journal = journal.CrawlJournal(journal_path) if journal_path else None
+        # state of previous runs, unchanged submenus and known resources are skipped
+        self.delta = delta.DeltaState(delta_path, recheck=delta_recheck) if delta_path else None
+        self.streaming = streaming
+        self.parser_backend = parser_backend # None -> BasePageParser.BACKEND of every parser
+        # parse_workers=0 -> parse in the crawling thread, N -> N parser processes (off the GIL)
+        self.parse_pool = parsepool.ParsePool(workers=parse_workers, backend=parser_backend)
+        self.stage_workers = stage_workers or {}
+        # related items XHRs run in their own stage, memoized, related_items=False -> images only
+        self.related_items = None
+        if related_items:
+            self.related_items = related.RelatedItems(self._fetch_related_text, concurrency=related_concurrency)
+        self.queue_size = queue_size
+        self.pipeline = None
+        # list page size is probed and autotuned, landing page is reused as page 1, see pagination.py
+        self.page_sizes = pagination.PageSizeTuner(parsers.ListPageParser.ITEM_PER_PAGE, probe_sizes=probe_page_sizes)
+        self._first_pages = {} # page url -> resource urls of reused landing or probe page, without journal
+        self._first_pages_lock = threading.Lock()
+        # same part listed under several submenus is crawled once, later listings are linked to it
+        self.resource_index = dedup.ResourceIndex() if deduplicate and self.work_queue is None else None
+        # images are stored once by content hash and hardlinked into resource directories
+        self.chunk_size = chunk_size # download buffer, None -> filedownload.DEFAULT_CHUNK_SIZE
+        self.blob_store = None
+        if blob_store:
+            self.blob_store = blobstore.BlobStore(
+                blob_dir or os.path.join(self.__class__.BASE_DIR, self.__class__.BLOB_DIR),
+                chunk_size=chunk_size,
+                worker_id=self.work_queue.worker_id if self.work_queue is not None else None
+            )
+        # parsed resources are streamed to JSONL with part number / section / url index, see catalog.py
+        self.catalog = catalog.Catalog(catalog_path, base_dir=self.__class__.BASE_DIR) if catalog_path else None
+        # dirs -> directory tree, tar/pack -> few big archive files, see sinks.py
+        self.sink = sinks.SINKS[output](self.__class__.BASE_DIR, store=self.blob_store, chunk_size=chunk_size)
+        self._dir_lock = threading.Lock() # journal lookup + directory name reservation
+        # failed requests are retried with exponential backoff instead of time.sleep(15)
+        self.retry_scheduler = retry.RetryScheduler(
+            max_attempts=max_attempts,
+            retry_on=(requests.exceptions.RequestException,)
+        )
+        # metrics are always collected (cheap), written to files only when metrics_path is given
+        self.metrics = metrics.Metrics()
+        self.metrics_reporter = metrics.MetricsReporter(self.metrics, metrics_path, metrics_interval) if metrics_path else None
+        # opt-in profiling of chosen phases, stages and parsers, see profiling.py
+        self.profiler = None
+        if profile_targets:
+            self.profiler = profiling.Profiler(
+                profile_targets,
+                output_dir=profile_dir or 'profile',
+                mode=profile_mode,
+                memory=profile_memory
+            )
+            self.metrics.profiler = self.profiler
+        self.metrics.register_gauge('retries', lambda: self.retry_scheduler.retries)
+        self.metrics.register_gauge('retry_pending', lambda: self.retry_scheduler.pending())
+        self.metrics.register_gauge('dead_letters', lambda: len(self.retry_scheduler.dead_letters))
+        self.metrics.register_gauge(
+            'queue_depth',
+            lambda: self.pipeline.queue_depths() if self.pipeline else {},
+            label_name='stage'
+        )
+        self.metrics.register_gauge('pagination', self.page_sizes.stats, label_name='stat')
+        self.metrics.register_gauge('pagination_requests_saved', self.page_sizes.requests_saved, label_name='submenu')
+        if self.resource_index is not None:
+            self.metrics.register_gauge('duplicates', lambda: len(self.resource_index.duplicates))
+            self.metrics.register_gauge('requests_saved', self.resource_index.requests_saved)
+        if self.catalog is not None:
+            self.metrics.register_gauge('catalog', self.catalog.stats, label_name='stat')
+        if self.blob_store is not None:
+            self.metrics.register_gauge('blob_store', self.blob_store.stats, label_name='stat')
+        # conditional requests, unchanged pages of recrawl are 304s or aren't requested at all
+        self.http_cache = httpcache.HTTPCache(cache_dir, max_size=cache_size) if cache_dir else None
+        if self.related_items is not None:
+            self.metrics.register_gauge('related_items', self.related_items.stats, label_name='stat')
+        if self.delta is not None:
+            self.metrics.register_gauge('delta', self.delta.get_stats, label_name='stat')
+        if self.http_cache is not None:
+            self.metrics.register_gauge('http_cache', self.http_cache.stats, label_name='stat')
+        # raw responses are recorded to archive, replay reparses them with no network
+        self.archive = None
+        if replay_path or record_path:
+            self.archive = archive.ResponseArchive(replay_path or record_path, record_streams=record_streams)
+            self.metrics.register_gauge('archive', self.archive.stats, label_name='stat')
+        cookies = resources.Resource.get_cookies()
         setattr(type(self), 'COOKIES', cookies) # COOKIES is static variable
+        self.session = httpsession.PooledSession(
+            cookies=cookies,
+            pool_size=pool_size or concurrency,
+            retries=retries,
+            timeout=timeout,
+            cache=self.http_cache,
+            archive=self.archive,
+            replay=bool(replay_path)
+        )
+        # most valuable work first, nothing new is started after the deadline, live ETA
+        self.scheduler = None
+        if deadline or menu_weights or smallest_first or content_first or eta_interval:
+            self.scheduler = scheduler.DeadlineScheduler(
+                deadline=deadline,
+                menu_weights=menu_weights,
+                smallest_first=smallest_first,
+                content_first=content_first,
+                resources_per_page=parsers.ListPageParser.ITEM_PER_PAGE,
+                eta_interval=eta_interval
+            )
+            self.metrics.register_gauge('schedule', self.scheduler.stats, label_name='stat')
+        # expired session pauses the crawl until cookies are reloaded, failed requests are requeued
+        self.session_health = None
+        if session_health and not replay_path:
+            self.session_health = sessionhealth.SessionHealth(
+                self.session,
+                cookie_provider or sessionhealth.FileCookieProvider(),
+                cache=self.http_cache,
+                rotate_after=rotate_cookies,
+                logon_url=logon_url
+            )
+            self.metrics.register_gauge('session', self.session_health.stats, label_name='stat')
+        # concurrency=1 -> old sequential behaviour
+        self.engine = engine.CrawlEngine(
+            concurrency=concurrency,
+            per_host_concurrency=per_host_concurrency,
+            session=self.session,
+            metrics=self.metrics,
+            health=self.session_health,
+            scheduler=self.scheduler
+        )
+
+    def _iter_submenus(self):
+        # menu order, or scheduler's order (keyed by submenu url in phase mode)
+        submenus = []
+        for menu_name, menu_submenus in self.menu_dict.items():
+            for submenu in menu_submenus:
+                if self.scheduler is not None:
+                    self.scheduler.add_submenu(submenu['url'], menu_name)
+                submenus.append(submenu)
+        if self.scheduler is not None:
+            submenus.sort(key=lambda submenu: self.scheduler.item_priority(submenu['url']))
+        return iter(submenus)
+
+    def _iter_resources(self):
+        seen = set()
+        for submenu in self._iter_submenus():
+            for resource in submenu['resources']:
+                if self.resource_index is not None:
+                    if resource.url in seen:
+                        continue # content is fetched for the first listing only
+                    seen.add(resource.url)
+                yield resource
         
     def _get_menu(self):
-        response = requests.get(self.__class__.BASE_URL, cookies=self.__class__.COOKIES)
-        menu_parser = parsers.MenuPageParser(response.text)
-        setattr(self, 'menu_dict', menu_parser.parse())
+        menu_dict = self.journal.get_menu() if self.journal else None
+        if menu_dict is None:
+            response = self.engine.fetch(self.__class__.BASE_URL, kind='menu')
+            with self.metrics.timer('parse_seconds', parser='MenuPageParser'):
+                menu_dict = self.parse_pool.menu(response.content)
+            if self.journal:
+                self.journal.set_menu(menu_dict)
+        setattr(self, 'menu_dict', menu_dict)
+
+    def _probe_page(self, url, size, probed):
+        # page 1 of probed size -> (served size, resource urls), None when server rejects the size
+        page_url = parsers.ListPageParser.generate_valid_url(url, 1, size)
+        start = time.perf_counter()
+        response = self.engine.fetch(page_url, kind='list')
+        probed.append(page_url)
+        if 400 <= response.status_code < 500:
+            return None
+        response.raise_for_status() # server error, submenu is retried
+        seconds = time.perf_counter() - start
+        with self.metrics.timer('parse_seconds', parser='ListPageParser'):
+            result_count, served, resource_urls = self.parse_pool.list_summary(response.content)
+        if not resource_urls:
+            return None
+        self.page_sizes.observe(min(served, size), seconds, len(resource_urls))
+        return served, resource_urls
+
+    def _add_first_page(self, page_url, resource_urls):
+        # landing or probe response is page 1, _get_page doesn't request it again
+        if self.journal:
+            self.journal.add_page(page_url, resource_urls)
+        else:
+            with self._first_pages_lock:
+                self._first_pages[page_url] = resource_urls
+
+    def _get_num_pages(self, url):
+        # returns (page size, num pages), 0 pages when delta crawl finds submenu unchanged since previous run
+        num_pages, page_size = self.journal.get_pagination(url) if self.journal else (None, None)
+        if num_pages is not None:
+            return page_size or parsers.ListPageParser.ITEM_PER_PAGE, num_pages
+        response = self.engine.fetch(url, kind='list')
+        with self.metrics.timer('parse_seconds', parser='ListPageParser.get_num_pages'):
+            result_count, landing_size, first_page_urls = self.parse_pool.list_summary(response.content)
+        probed = [] # probe requests of this submenu
+        first_page = None
+        if self.delta is not None and self.delta.submenu_unchanged(url, result_count, first_page_urls):
+            page_size, num_pages = landing_size, 0
+        else:
+            page_size = landing_size
+            if result_count > landing_size:
+                probe = self.page_sizes.probe(lambda size: self._probe_page(url, size, probed), landing_size)
+                page_size, first_page = probe if probe is not None else (self.page_sizes.choose(), None)
+            if page_size == landing_size:
+                first_page = first_page_urls
+            num_pages = parsers.ListPageParser.num_pages(result_count, page_size)
+            if num_pages and first_page is not None:
+                self._add_first_page(parsers.ListPageParser.generate_valid_url(url, 1, page_size), first_page)
+            reused = 1 if num_pages and first_page is not None else 0
+            self.page_sizes.record(url, result_count, 1 + len(probed) + num_pages - reused, reused)
+        if self.journal:
+            self.journal.set_num_pages(url, num_pages, page_size)
+        return page_size, num_pages
+
+    def _get_page(self, page_url):
+        resource_urls = self.journal.get_page(page_url) if self.journal else None
+        if resource_urls is None and not self.journal:
+            with self._first_pages_lock:
+                resource_urls = self._first_pages.pop(page_url, None)
+        if resource_urls is None:
+            start = time.perf_counter()
+            response = self.engine.fetch(page_url, kind='list')
+            seconds = time.perf_counter() - start
+            with self.metrics.timer('parse_seconds', parser='ListPageParser'):
+                resource_urls = self.parse_pool.list_page(response.content)
+            self.page_sizes.observe(parsers.ListPageParser.split_valid_url(page_url)[1], seconds, len(resource_urls))
+            if self.journal:
+                self.journal.add_page(page_url, resource_urls)
+        if self.delta is not None:
+            resource_urls = [url for url in resource_urls if self.delta.is_new(url)]
+        if self.scheduler is not None:
+            self.scheduler.page_done(len(resource_urls))
+        return resources.ResourceSet.from_urls(resource_urls)
+
+    def _iter_page_urls(self, url, page_size, num_pages):
+        get_range = parsers.ListPageParser.generate_page_range(num_pages)
+        for page_num in get_range:
+            yield parsers.ListPageParser.generate_valid_url(url, page_num, page_size)
+
+    def _list_submenu(self, submenu):
+        # returns page urls of submenu, every submenu is retried on its own
+        url = submenu['url']
+        submenu['resources'] = resources.ResourceSet()
+        pagination = self.retry_scheduler.call(('submenu', url), self._get_num_pages, url)
+        if pagination is None:
+            return []
+        page_size, num_pages = pagination
+        if self.scheduler is not None:
+            self.scheduler.set_num_pages(url, num_pages)
+        return list(self._iter_page_urls(url, page_size, num_pages))
 
     def _get_list(self):
+        # pages of all submenus are fetched in parallel, every list page is retried on its own
+        submenus = list(self._iter_submenus())
+        pages = [
+            (submenu, page_url)
+            for submenu, page_urls in zip(submenus, self.engine.map(self._list_submenu, submenus))
+            for page_url in page_urls
+        ]
+        def get_page(page):
+            return self.retry_scheduler.call(('list', page[1]), self._get_page, page[1])
+        for (submenu, page_url), resource_set in zip(pages, self.engine.map(get_page, pages)):
+            if resource_set is not None:
+                submenu['resources'].add(resource_set)
+
+    def _content_unchanged(self, resource):
+        # delta recheck: product page of known resource is parsed again, download is skipped when equal
+        return self.delta is not None and self.delta.content_unchanged(resource.url, resource.content_dict())
+
+    def _fetch_content(self, resource):
+        # raises RequestException, product page only, related items are fetched by _fetch_related
+        if resource.sections is None:
+            parsed_dict = self.journal.get_content(resource.url) if self.journal else None
+            if parsed_dict is None:
+                response = self.engine.fetch(resource.url, kind='content')
+                with self.metrics.timer('parse_seconds', parser='ContentPageParser'):
+                    parsed_dict = self.parse_pool.content(response.content)
+                if self.journal:
+                    self.journal.add_content(resource.url, parsed_dict)
+            resource.set_content(parsed_dict)
+        if self.related_items is None:
+            for section in resource.sections:
+                section.text = section.text or None # not requested, related_parts files aren't written
+
+    def _fetch_related_text(self, params):
+        # Ford's server ignores X-Requested-With: XMLHttpRequest
+        xhr_response = self.engine.fetch(self.__class__.XHR_BASE_URL, kind='xhr', params=params)
+        with self.metrics.timer('parse_seconds', parser='ContentPageParser.xhr_response_parser'):
+            return self.parse_pool.xhr(xhr_response.content)
+
+    def _fetch_related(self, resource):
+        # raises RequestException, retried attempt only fetches sections still without text
+        if self.related_items.fetch_resource(resource) and self.journal:
+            self.journal.add_content(resource.url, resource.content_dict())
+
+    def _deferred(self):
+        # deadline passed, resource is left for the next (resumed) run
+        return self.scheduler is not None and self.scheduler.defer()
+
+    def _get_content(self):
+        def fetch_content(resource):
+            if self._deferred():
+                return
+            self.retry_scheduler.call(('content', resource.url), self._fetch_content, resource)
+        self.engine.map(fetch_content, list(self._iter_resources()))
+
+    def _get_related(self):
+        def fetch_related(resource):
+            if resource.sections is not None: # product page failed (dead letter)
+                self.retry_scheduler.call(('related', resource.url), self._fetch_related, resource)
+        self.engine.map(fetch_related, list(self._iter_resources()))
+
+    def _submenu_dir(self, dirname, submenu):
+        subdirname = self.journal.get_submenu(submenu['url'])[0] if self.journal else None
+        if subdirname is None and self.delta is not None:
+            subdirname = self.delta.get_submenu_dir(submenu['url']) # created by previous run
+        if subdirname is None or not self.sink.reuse(subdirname):
+            subdirname = self.sink.make_dir(dirname, submenu['name'])
+            if self.journal:
+                self.journal.set_submenu_dir(submenu['url'], subdirname)
+            if self.delta is not None:
+                self.delta.set_submenu_dir(submenu['url'], subdirname)
+        return subdirname
+
+    def _resource_dir(self, subdirname, resource):
+        # returns (new_dir, done), resumed run reuses directory of unfinished download
+        if self.journal:
+            if self.resource_index is not None:
+                new_dir, done = self.journal.find_download(resource.url) # downloaded under any submenu
+            else:
+                new_dir, done = self.journal.get_download(resource.url, subdirname)
+            if new_dir is not None and self.sink.reuse(new_dir):
+                return new_dir, done
+        new_dir = self.delta.get_resource_dir(resource.url) if self.delta is not None else None # changed resource
+        if new_dir is None or not self.sink.reuse(new_dir):
+            new_dir = self.sink.make_dir(subdirname, correct_name_generator(resource.dirname))
+        if self.journal:
+            self.journal.start_download(resource.url, subdirname, new_dir)
+        return new_dir, False
+
+    def _record_resource(self, resource, subdirname, new_dir):
+        if self.catalog is not None:
+            self.catalog.add(resource, subdirname, new_dir)
+        if self.resource_index is not None:
+            self.resource_index.record(resource.url, new_dir, self.resource_index.resource_requests(resource))
+
+    def _download_resource(self, job):
+        # raises RequestException
+        resource, subdirname, new_dir = job
+        self.sink.write_resource(resource, new_dir, self.engine.fetch)
+        self.metrics.increment('resources_downloaded')
+        if self.scheduler is not None:
+            self.scheduler.resource_done(dedup.ResourceIndex.resource_requests(resource))
+        if self.journal:
+            self.journal.finish_download(resource.url, subdirname)
+        if self.delta is not None:
+            self.delta.add_resource(resource.url, new_dir, resource.content_dict())
+
+    def start_download(self):
+        # directories are created up front in one thread:
+        # create_subdir's unique name generation is not thread-safe !!!
+        jobs = []
+        priorities = {} # submenu directory -> scheduler's sort key
+        subdirnames = {} # submenu url -> directory, created in menu order
         for menu_name, submenus in self.menu_dict.items():
+            dirname = self.sink.menu_dir(menu_name)
             for submenu in submenus:
-                url = submenu['url']
+                subdirnames[submenu['url']] = self._submenu_dir(dirname, submenu)
+        # same order as _iter_resources: the listing claimed first is the one whose content was fetched
+        for submenu in self._iter_submenus():
+            subdirname = subdirnames[submenu['url']]
+            if self.scheduler is not None:
+                priorities[subdirname] = self.scheduler.item_priority(submenu['url'])
+            for resource in submenu['resources']:
+                if self.resource_index is not None and not self.resource_index.claim(resource.url, subdirname):
+                    continue
+                if resource.sections is None:
+                    continue # content failed (dead letter) or deferred by scheduler
+                if self._content_unchanged(resource):
+                    continue
                 try:
-                    submenu['resources'] = resources.ResourceSet()
-                    response = requests.get(url, cookies=self.__class__.COOKIES)
-                    num_pages = parsers.ListPageParser.get_num_pages(response.text)
-                    get_range = parsers.ListPageParser.generate_page_range(num_pages)
-                    for page_num in get_range:
-                        new_url = parsers.ListPageParser.generate_valid_url(url, page_num)
-                        response = requests.get(new_url, cookies=self.__class__.COOKIES)
-                        list_parser = parsers.ListPageParser(response.text)
-                        resource_set = list_parser.parse()
-                        submenu['resources'].add(resource_set)
-                except requests.exceptions.RequestException:
-                    time.sleep(15)
+                    new_dir, done = self._resource_dir(subdirname, resource)
+                except Exception as exc:
+                    print('XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX Resource => ', resource.url)
+                else:
+                    self._record_resource(resource, subdirname, new_dir)
+                    if not done:
+                        jobs.append((resource, subdirname, new_dir))
+        if self.scheduler is not None:
+            jobs.sort(key=lambda job: priorities[job[1]])
+        def download(job):
+            if self._deferred():
+                return
+            self.retry_scheduler.call(('download', job[0].url), self._download_resource, job)
+        self.engine.map(download, jobs)
 
-    def _get_content(self):
+    # streaming pipeline stages, see pipeline.py
+    # failed items are requeued by self.retry_scheduler, other items keep flowing
+    def _menu_stage(self, item, emit):
+        self._get_menu()
         for menu_name, submenus in self.menu_dict.items():
+            dirname = self.sink.menu_dir(menu_name)
             for submenu in submenus:
-                for resource in submenu['resources']:
-                    try:
-                        response = requests.get(resource.url, cookies=self.__class__.COOKIES)
-                        content_parser = parsers.ContentPageParser(response.text)
-                        parsed_dict = content_parser.parse()
-                        resource.title = parsed_dict['title']
-                        resource.number = parsed_dict['number']
-                        resource.dirname = '{title}_{number}'.format(
-                            title=resource.title,
-                            number=resource.number
-                        )
-                        resource.slider_images = parsed_dict['slider_images']
-                        resource.sections_data = parsed_dict['section_data']
-                        for section_id, section_value in resource.sections_data.items():
-                            for xhr_key, xhr_value in section_value.items():
-                                if isinstance(xhr_value, dict):
-                                    try:
-                                        # Ford's server ignores X-Requested-With: XMLHttpRequest
-                                        xhr_response = requests.get(self.__class__.XHR_BASE_URL, params=xhr_value, cookies=self.__class__.COOKIES)
-                                        text = parsers.ContentPageParser.xhr_response_parser(xhr_response.text)
-                                        section_value['text'] = text
-                                    except requests.exceptions.RequestException:
-                                        time.sleep(15)
-                    except requests.exceptions.RequestException:
-                        time.sleep(15)
-                        # wait 15 seconds...
+                subdirname = self._submenu_dir(dirname, submenu)
+                if self.scheduler is not None:
+                    self.scheduler.add_submenu(subdirname, menu_name) # pipeline items are keyed by directory
+                emit((submenu, subdirname))
 
-    def start_download(self):
+    def _submenu_stage(self, item, emit):
+        submenu, subdirname = item
+        page_size, num_pages = self._get_num_pages(submenu['url'])
+        if self.scheduler is not None:
+            self.scheduler.set_num_pages(subdirname, num_pages)
+        for page_url in self._iter_page_urls(submenu['url'], page_size, num_pages):
+            emit((page_url, subdirname))
+
+    def _list_stage(self, item, emit):
+        page_url, subdirname = item
+        for resource in self._get_page(page_url):
+            if self.resource_index is not None and not self.resource_index.claim(resource.url, subdirname):
+                continue # linked to the first listing when the crawl is finished
+            emit((resource, subdirname))
+
+    def _content_stage(self, item, emit):
+        resource, subdirname = item
+        if resource.sections is None and self._deferred():
+            return
+        self._fetch_content(resource)
+        if self.related_items is not None:
+            emit(item)
+        else:
+            self._emit_download(resource, subdirname, emit)
+
+    def _related_stage(self, item, emit):
+        resource, subdirname = item
+        self._fetch_related(resource)
+        self._emit_download(resource, subdirname, emit)
+
+    def _emit_download(self, resource, subdirname, emit):
+        if self._content_unchanged(resource):
+            return
+        with self._dir_lock:
+            new_dir, done = self._resource_dir(subdirname, resource)
+        self._record_resource(resource, subdirname, new_dir)
+        if not done:
+            emit((resource, subdirname, new_dir))
+
+    def _download_stage(self, item, emit):
+        if self._deferred():
+            return
+        self._download_resource(item)
+
+    def _item_priority(self, item):
+        return self.scheduler.item_priority(item[1]) # item[1] is submenu directory in every stage after menu
+
+    def _run_pipeline(self):
+        workers = dict(self.__class__.STAGE_WORKERS, **self.stage_workers)
+        stages = [
+            pipeline.Stage(
+                name,
+                func,
+                workers=workers.get(name, 1),
+                queue_size=self.queue_size,
+                retry=self.retry_scheduler,
+                metrics=self.metrics,
+                priority=self._item_priority if self.scheduler is not None and name != 'menu' else None
+            )
+            for name, func in (
+                ('menu', self._menu_stage),
+                ('submenu', self._submenu_stage),
+                ('list', self._list_stage),
+                ('content', self._content_stage),
+                ('related', self._related_stage),
+                ('download', self._download_stage),
+            )
+            if name != 'related' or self.related_items is not None
+        ]
+        self.pipeline = pipeline.Pipeline(stages)
+        self.pipeline.run([None])
+
+    # sharded crawl, every unit kind has its handler, units found by a handler are added to the queue
+    def _shard_menu(self, key, payload):
+        self._get_menu()
         for menu_name, submenus in self.menu_dict.items():
-            dirname = self.create_dir(menu_name)
+            dirname = self.sink.menu_dir(menu_name)
             for submenu in submenus:
-                submenu_name = submenu['name']
-                subdirname = self.create_subdir(dirname, submenu_name)
-                for resource in submenu['resources']:
-                    try:
-                        try:
-                            new_dir = self.create_subdir(subdirname, correct_name_generator(resource.dirname))
-                        except Exception as exc:
-                            print('XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX Resource_Dir => ', new_dir)
-                        else:
-                            resource.download(new_dir)
-                    except requests.exceptions.RequestException:
-                        time.sleep(15)
+                submenu_key = self.work_queue.unit_key('submenu', submenu['url'])
+                if self.work_queue.exists(submenu_key):
+                    continue # added by previous attempt
+                subdirname = self._submenu_dir(dirname, submenu)
+                self.work_queue.add('submenu', submenu_key, {'url': submenu['url'], 'dir': subdirname})
+
+    def _shard_submenu(self, key, payload):
+        for page_url in self._iter_page_urls(payload['url'], *self._get_num_pages(payload['url'])):
+            self.work_queue.add('list', self.work_queue.unit_key('list', page_url), {'url': page_url, 'dir': payload['dir']})
+
+    def _shard_list(self, key, payload):
+        for resource in self._get_page(payload['url']):
+            if not self.deduplicate:
+                resource_key = self.work_queue.unit_key('resource', resource.url, payload['dir'])
+            else:
+                resource_key = self.work_queue.unit_key('resource', resource.url)
+            if self.work_queue.add('resource', resource_key, {'url': resource.url, 'parent': payload['dir']}):
+                continue
+            state, resource_payload = self.work_queue.get(resource_key)
+            if resource_payload['parent'] != payload['dir']:
+                self.work_queue.add_link(resource.url, payload['dir']) # listed under other submenu too
+
+    def _shard_resource(self, key, payload):
+        resource, subdirname = resources.Resource(payload['url']), payload['parent']
+        self._fetch_content(resource)
+        if self.related_items is not None:
+            self._fetch_related(resource)
+        if self._content_unchanged(resource):
+            return
+        new_dir = payload.get('dir')
+        if new_dir is None or not self.sink.reuse(new_dir):
+            with self._dir_lock:
+                new_dir, done = self._resource_dir(subdirname, resource)
+            if done:
+                return
+            payload['dir'] = new_dir # retried attempt downloads into the same directory
+            self.work_queue.update_payload(key, payload)
+        if self.catalog is not None:
+            self.catalog.add(resource, subdirname, new_dir)
+        self._download_resource((resource, subdirname, new_dir))
+
+    def _shard_link(self, key, payload):
+        for url, parent in self.work_queue.iter_links():
+            state, resource_payload = self.work_queue.get(self.work_queue.unit_key('resource', url))
+            if state == 'done' and resource_payload.get('dir'):
+                self.sink.link(url, resource_payload['dir'], parent)
+
+    def _shard_loop(self):
+        # one worker thread: claim, process, complete (or release for retry) until queue is drained
+        queue = self.work_queue
+        while True:
+            unit = queue.claim()
+            if unit is None:
+                if queue.active():
+                    time.sleep(self.__class__.SHARD_POLL_INTERVAL) # other workers may still add units
+                    continue
+                if self.deduplicate and queue.add('link', queue.unit_key('link'), {}):
+                    continue # duplicate listings are linked by one worker, once everything is crawled
+                return
+            key, kind, payload = unit
+            start = time.perf_counter()
+            try:
+                with self.metrics.profile(stage=kind):
+                    getattr(self, '_shard_' + kind)(key, payload)
+            except Exception as exc:
+                if not isinstance(exc, requests.exceptions.RequestException):
+                    traceback.print_exc()
+                queue.release(key, exc)
+            else:
+                queue.complete(key)
+                self.metrics.observe('stage_seconds', time.perf_counter() - start, stage=kind)
+
+    def _run_shard(self):
+        self.work_queue.add('menu', self.work_queue.unit_key('menu'), {}) # first worker seeds the queue
+        self.work_queue.start_heartbeat()
+        try:
+            self.engine.map(lambda index: self._shard_loop(), range(self.engine.concurrency))
+        finally:
+            self.work_queue.stop_heartbeat()
+
+    def _run_phases(self):
+        with self.metrics.timer('phase_seconds', phase='menu'):
+            self.retry_scheduler.call(('menu', self.__class__.BASE_URL), self._get_menu)
+        with self.metrics.timer('phase_seconds', phase='list'):
+            self._get_list()
+        with self.metrics.timer('phase_seconds', phase='content'):
+            self._get_content()
+        if self.related_items is not None:
+            with self.metrics.timer('phase_seconds', phase='related'):
+                self._get_related()
+        with self.metrics.timer('phase_seconds', phase='download'):
+            self.start_download()
 
     def _send_request(self):
         # implements request execution ordering !!!
         # 1 -> Parse Menu View 
         # 2 -> Parse List View 
-        # 3 -> Parse Content View 
+        # 3 -> Parse Content View, then its related items (XHRs)
         # 4 -> Download
+        # streaming mode runs all four at once, every resource flows downstream as soon as it is parsed
         start = datetime.datetime.now()
-        self._get_menu()
-        self._get_list()
-        self._get_content()
-        self.start_download()
+        if self.metrics_reporter:
+            self.metrics_reporter.start()
+        if self.profiler is not None:
+            self.profiler.start()
+        if self.scheduler is not None:
+            self.scheduler.start()
+        try:
+            if self.work_queue is not None:
+                self._run_shard()
+            elif self.streaming and not self.engine.sequential:
+                self._run_pipeline()
+            else:
+                self._run_phases()
+            if self.resource_index is not None:
+                self.resource_index.link(self.sink)
+            failed = self.work_queue.failed() if self.work_queue is not None else self.retry_scheduler.dead_letters
+            if self.delta is not None and not failed:
+                self.delta.commit()
+        finally:
+            self.sink.close()
+            self.parse_pool.close()
+            if self.archive is not None:
+                self.archive.close()
+            if self.catalog is not None:
+                catalog_stats = dict(self.catalog.stats(), parts=self.catalog.count())
+                self.catalog.close()
+            if self.work_queue is not None:
+                shard_stats = dict(self.work_queue.stats(), units=self.work_queue.counts())
+                shard_failed = self.work_queue.failed()
+                self.work_queue.close()
+            if self.metrics_reporter:
+                self.metrics_reporter.stop()
+            if self.profiler is not None:
+                profile_paths = self.profiler.stop()
+            if self.scheduler is not None:
+                self.scheduler.stop()
         stop = datetime.datetime.now()
         print('Finished in  =====================================> ', stop-start)
+        print('Pages/sec    =====================================> ', round(self.engine.pages_per_sec(), 2))
+        print('Connections  =====================================> ', self.session.connection_stats())
+        print('Retries      =====================================> ', self.retry_scheduler.retries)
+        print('Pagination   =====================================> ', self.page_sizes.stats())
+        if self.resource_index is not None:
+            print('Duplicates   =====================================> ', len(self.resource_index.duplicates))
+            print('Req. saved   =====================================> ', self.resource_index.requests_saved())
+        if self.scheduler is not None:
+            print('Schedule     =====================================> ', self.scheduler.stats())
+        if self.session_health is not None:
+            print('Session      =====================================> ', self.session_health.stats())
+        if self.related_items is not None:
+            print('Related      =====================================> ', self.related_items.stats())
+        if self.archive is not None:
+            print('Archive      =====================================> ', self.archive.stats())
+        if self.delta is not None:
+            print('Delta        =====================================> ', self.delta.get_stats())
+        if self.http_cache is not None:
+            print('HTTP cache   =====================================> ', self.http_cache.stats())
+        if self.catalog is not None:
+            print('Catalog      =====================================> ', self.catalog.path, catalog_stats)
+        if self.blob_store is not None:
+            print('Blob store   =====================================> ', self.blob_store.stats())
+        if self.profiler is not None:
+            print('Profile      =====================================> ', self.profiler.stats())
+            for path in profile_paths:
+                print('Profile file =====================================> ', path)
+        if self.work_queue is not None:
+            print('Shard        =====================================> ', self.work_queue.worker_id, shard_stats)
+            for failed_unit in shard_failed:
+                print('Failed unit  =====================================> ', failed_unit)
+        for dead_letter in self.retry_scheduler.dead_letters:
+            print('Dead letter  =====================================> ', dead_letter)
 
     def __call__(self):
         self._send_request()
 
 def main():
-    dc = DownloadClient()
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--concurrency', type=int, default=None, help='global limit, 1 = sequential')
+    arg_parser.add_argument('--per-host', type=int, default=None, help='per host limit')
+    arg_parser.add_argument('--pool-size', type=int, default=None, help='keep-alive connections per host')
+    arg_parser.add_argument('--retries', type=int, default=None, help='transport level retries')
+    arg_parser.add_argument('--timeout', type=float, default=None, help='request timeout (seconds)')
+    arg_parser.add_argument('--phases', action='store_true', help='run menu/list/content/download one after another')
+    arg_parser.add_argument('--list-workers', type=int, default=None)
+    arg_parser.add_argument('--content-workers', type=int, default=None)
+    arg_parser.add_argument('--related-workers', type=int, default=None)
+    arg_parser.add_argument('--download-workers', type=int, default=None)
+    arg_parser.add_argument('--probe-page-sizes', default=None,
+                            help='list page sizes to probe, largest first (default {0})'.format(
+                                ','.join(map(str, pagination.PageSizeTuner.PROBE_SIZES))))
+    arg_parser.add_argument('--queue-size', type=int, default=None, help='bounded queue size between stages')
+    arg_parser.add_argument('--journal', default=None, help='SQLite crawl journal, resume an interrupted run')
+    arg_parser.add_argument('--max-attempts', type=int, default=None, help='give up (dead letter) after N failures')
+    arg_parser.add_argument('--parser-backend', choices=parsers.BasePageParser.BACKENDS, default=None)
+    arg_parser.add_argument('--parse-workers', type=int, default=0, help='parser processes, 0 = parse in crawler threads')
+    arg_parser.add_argument('--no-dedup', action='store_true', help='crawl part again for every submenu it is listed in')
+    arg_parser.add_argument('--no-blob-store', action='store_true', help='download every image into every resource directory')
+    arg_parser.add_argument('--blob-dir', default=None, help='content addressed image store, default <BASE_DIR>/.blobs')
+    arg_parser.add_argument('--output', choices=sorted(sinks.SINKS), default='dirs',
+                            help='directory tree, sharded tar archives or catalog.jsonl + blob store')
+    arg_parser.add_argument('--catalog', default=None,
+                            help='stream parsed resources to JSONL, indexed by part number / section / url in <path>.db')
+    arg_parser.add_argument('--cache', default=None, help='HTTP cache directory (ETag / Last-Modified / Cache-Control)')
+    arg_parser.add_argument('--cache-size', type=int, default=None, help='HTTP cache size limit (bytes), LRU eviction')
+    arg_parser.add_argument('--delta', default=None, help='state of previous runs (SQLite), crawl only what changed')
+    arg_parser.add_argument('--delta-recheck', action='store_true', help='fetch known product pages again, download changed ones')
+    arg_parser.add_argument('--record', default=None, help='record raw responses to WARC-like archive (.warc.gz)')
+    arg_parser.add_argument('--record-images', action='store_true', help='record image bodies too, not only headers')
+    arg_parser.add_argument('--replay', default=None, help='crawl recorded archive instead of parts.ford.com')
+    arg_parser.add_argument('--related-concurrency', type=int, default=None, help='related items XHRs in flight')
+    arg_parser.add_argument('--no-related', action='store_true', help="don't request related items, images only")
+    arg_parser.add_argument('--cookie-command', default=None, help='command printing fresh cookies JSON, default: reload cookies.json')
+    arg_parser.add_argument('--logon-url', default=None,
+                            help='redirect to it means expired session (default {0})'.format(sessionhealth.SessionHealth.LOGON_URL))
+    arg_parser.add_argument('--rotate-cookies', type=float, default=None, help='reload cookies every N seconds, before session expires')
+    arg_parser.add_argument('--no-session-health', action='store_true', help="don't check responses for expired session")
+    arg_parser.add_argument('--deadline', type=float, default=None, help='seconds, no new resource is started after it')
+    arg_parser.add_argument('--menu-weight', action='append', default=[], metavar='MENU=WEIGHT',
+                            help='submenus of heavier menus are crawled first (default weight 1)')
+    arg_parser.add_argument('--smallest-first', action='store_true', help='submenus with fewer list pages first')
+    arg_parser.add_argument('--content-first', action='store_true', help='pages and XHRs get request slots before images')
+    arg_parser.add_argument('--eta-interval', type=float, default=None, help='print ETA every N seconds')
+    arg_parser.add_argument('--shard-queue', default=None, help='sharded crawl, SQLite work queue shared by all workers')
+    arg_parser.add_argument('--shard-processes', type=int, default=1, help='worker processes started by this command')
+    arg_parser.add_argument('--worker-id', default=None, help='unique worker name, default <hostname>-<pid>')
+    arg_parser.add_argument('--chunk-size', type=int, default=None, help='download buffer size (bytes)')
+    arg_parser.add_argument('--profile', action='append', default=[], metavar='TARGET',
+                            help='profile phase, stage or parser (e.g. content, ContentPageParser), comma separated')
+    arg_parser.add_argument('--profile-mode', choices=profiling.Profiler.MODES, default='sample',
+                            help='stack sampling (collapsed stacks for flamegraphs) or cProfile')
+    arg_parser.add_argument('--profile-memory', action='store_true', help='tracemalloc top allocation sites of profiled targets')
+    arg_parser.add_argument('--profile-dir', default=None, help='profile output directory, default ./profile')
+    arg_parser.add_argument('--metrics', default=None, help='write <path>.json and <path>.prom snapshots')
+    arg_parser.add_argument('--metrics-interval', type=float, default=None, help='snapshot interval (seconds)')
+    args = arg_parser.parse_args()
+    stage_workers = {
+        'list': args.list_workers,
+        'content': args.content_workers,
+        'related': args.related_workers,
+        'download': args.download_workers,
+    }
+    client_kwargs = dict(
+        concurrency=args.concurrency,
+        per_host_concurrency=args.per_host,
+        pool_size=args.pool_size,
+        retries=args.retries,
+        timeout=args.timeout,
+        streaming=not args.phases,
+        stage_workers={name: value for name, value in stage_workers.items() if value},
+        queue_size=args.queue_size,
+        journal_path=args.journal,
+        max_attempts=args.max_attempts,
+        parser_backend=args.parser_backend,
+        metrics_path=args.metrics,
+        metrics_interval=args.metrics_interval,
+        parse_workers=args.parse_workers,
+        deduplicate=not args.no_dedup,
+        blob_store=not args.no_blob_store,
+        blob_dir=args.blob_dir,
+        chunk_size=args.chunk_size,
+        output=args.output,
+        cache_dir=args.cache,
+        cache_size=args.cache_size,
+        delta_path=args.delta,
+        delta_recheck=args.delta_recheck,
+        record_path=args.record,
+        replay_path=args.replay,
+        record_streams=args.record_images,
+        related_items=not args.no_related,
+        related_concurrency=args.related_concurrency,
+        session_health=not args.no_session_health,
+        cookie_provider=sessionhealth.CommandCookieProvider(args.cookie_command) if args.cookie_command else None,
+        rotate_cookies=args.rotate_cookies,
+        logon_url=args.logon_url,
+        shard_queue=args.shard_queue,
+        worker_id=args.worker_id,
+        deadline=args.deadline,
+        menu_weights={name: float(weight) for name, weight in (item.rsplit('=', 1) for item in args.menu_weight)},
+        smallest_first=args.smallest_first,
+        content_first=args.content_first,
+        eta_interval=args.eta_interval,
+        probe_page_sizes=[int(size) for size in args.probe_page_sizes.split(',')] if args.probe_page_sizes else None,
+        profile_targets=[target for value in args.profile for target in value.split(',') if target],
+        profile_mode=args.profile_mode,
+        profile_dir=args.profile_dir,
+        profile_memory=args.profile_memory,
+        catalog_path=args.catalog
+    )
+    if args.shard_queue and args.shard_processes > 1:
+        # N local workers draining the same queue, other machines may run more of them
+        context = multiprocessing.get_context('spawn')
+        processes = [
+            context.Process(
+                target=run_client,
+                args=(dict(client_kwargs, worker_id='{0}-{1}'.format(args.worker_id, index) if args.worker_id else None),)
+            )
+            for index in range(args.shard_processes)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        return
+    run_client(client_kwargs)
+
+def run_client(client_kwargs):
+    dc = DownloadClient(**client_kwargs)
     dc()
 
 if __name__ == '__main__':
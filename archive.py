@@ -0,0 +1,135 @@
+# Record / replay archive of raw HTTP responses (WARC-like).
+# Every record is one gzip member (concatenated members = valid .gz file, zcat works):
+#   WARC/1.1 headers, then "HTTP/1.1 <status>" + response headers + decoded body
+# <path>.idx holds "offset<TAB>length<TAB>url" of every record, replay reads records by offset.
+# Streamed responses (images, svg) are recorded without body (WARC-Truncated) unless record_streams=True.
+# Replay serves everything from the archive, parsers and output stage run with no network at all;
+# combined with --parse-workers reparsing runs on every core.
+import io
+import os
+import gzip
+import uuid
+import datetime
+import threading
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+SKIP_HEADERS = ('content-encoding', 'transfer-encoding', 'content-length', 'connection') # body is stored decoded
+
+class ResponseArchive:
+
+    def __init__(self, path, record_streams=False):
+        self.path = path
+        self.record_streams = record_streams
+        self._lock = threading.Lock()
+        self._file = None
+        self._index = None # url -> (offset, length), loaded by replay
+        self.recorded = 0
+        self.replayed = 0
+        self.missing = 0
+
+    def _index_path(self):
+        return self.path + '.idx'
+
+    # record
+    def _format_record(self, response, body, truncated):
+        http_headers = ''.join(
+            '{0}: {1}\r\n'.format(name, value) for name, value in response.headers.items()
+            if name.lower() not in SKIP_HEADERS
+        )
+        http_part = 'HTTP/1.1 {0} {1}\r\n{2}Content-Length: {3}\r\n\r\n'.format(
+            response.status_code,
+            response.reason or '',
+            http_headers,
+            len(body)
+        ).encode('latin-1') + body
+        warc_headers = [
+            ('WARC-Type', 'response'),
+            ('WARC-Target-URI', response.url),
+            ('WARC-Date', datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')),
+            ('WARC-Record-ID', '<urn:uuid:{0}>'.format(uuid.uuid4())),
+            ('Content-Type', 'application/http; msgtype=response'),
+            ('Content-Length', str(len(http_part))),
+        ]
+        if truncated:
+            warc_headers.append(('WARC-Truncated', 'length'))
+        header = 'WARC/1.1\r\n' + ''.join('{0}: {1}\r\n'.format(name, value) for name, value in warc_headers) + '\r\n'
+        return header.encode('latin-1') + http_part + b'\r\n\r\n'
+
+    def record(self, response, stream=False):
+        # called by transport adapter with every network response, returns it unchanged
+        if 'Range' in response.request.headers:
+            return response # partial body of resumed download, full one is (or will be) recorded
+        truncated = stream and not self.record_streams
+        body = b'' if truncated else response.content
+        member = gzip.compress(self._format_record(response, body, truncated))
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'ab')
+            offset = self._file.tell()
+            self._file.write(member)
+            self._file.flush()
+            with open(self._index_path(), 'a') as f:
+                f.write('{0}\t{1}\t{2}\n'.format(offset, len(member), response.url))
+            self.recorded += 1
+        return response
+
+    # replay
+    def _load_index(self):
+        index = {}
+        with open(self._index_path(), 'r') as f:
+            for line in f:
+                offset, length, url = line.rstrip('\n').split('\t', 2)
+                index[url] = (int(offset), int(length)) # the latest record wins
+        return index
+
+    def _read_record(self, offset, length):
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'rb')
+        data = gzip.decompress(os.pread(self._file.fileno(), length, offset))
+        warc_header, _, http_part = data.partition(b'\r\n\r\n')
+        http_header, _, body = http_part.partition(b'\r\n\r\n')
+        lines = http_header.decode('latin-1').split('\r\n')
+        status = int(lines[0].split(' ', 2)[1])
+        headers = CaseInsensitiveDict(line.split(': ', 1) for line in lines[1:] if ': ' in line)
+        body = body[:-len(b'\r\n\r\n')] if body.endswith(b'\r\n\r\n') else body
+        return status, headers, body, b'WARC-Truncated' in warc_header
+
+    def replay(self, request):
+        # recorded response, 404 for url which isn't in the archive or was recorded without body
+        with self._lock:
+            if self._index is None:
+                self._index = self._load_index()
+            location = self._index.get(request.url)
+        status, headers, body, truncated = 404, CaseInsensitiveDict(), b'', False
+        if location is not None:
+            status, headers, body, truncated = self._read_record(*location)
+        if location is None or truncated:
+            status, body = 404, b''
+            with self._lock:
+                self.missing += 1
+        else:
+            with self._lock:
+                self.replayed += 1
+        response = requests.Response()
+        response.status_code = status
+        response.reason = 'OK' if status == 200 else 'Not In Archive'
+        response.headers = headers
+        response.encoding = get_encoding_from_headers(headers)
+        response.raw = io.BytesIO(body)
+        response.url = request.url
+        response.request = request
+        response.from_archive = True
+        return response
+
+    def stats(self):
+        with self._lock:
+            return {'recorded': self.recorded, 'replayed': self.replayed, 'missing': self.missing}
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
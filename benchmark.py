@@ -0,0 +1,341 @@
+# Offline benchmarks against mockserver.MockFordServer, no parts.ford.com traffic at all.
+# Run from the project directory (cookies.json is loaded from cwd):
+# >>> python benchmark.py --latency 0.02 --error-rate 0.01 --output before.json
+# every end-to-end run is executed in a fresh child process, so peak RSS belongs to that run only.
+# compare two changes by comparing their --output files.
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from bs4 import BeautifulSoup
+import app
+import parsers
+import parsepool
+import resources
+import mockserver
+
+# (name, fixture, parse function) used by parity checks and parser microbenchmarks
+PARSE_FUNCTIONS = (
+    ('MenuPageParser', 'menu', lambda html, backend: parsers.MenuPageParser(html, backend=backend).parse()),
+    ('ListPageParser', 'list', lambda html, backend: [
+        resource.url for resource in parsers.ListPageParser(html, backend=backend).parse()
+    ]),
+    ('ListPageParser.get_num_pages', 'list', lambda html, backend: parsers.ListPageParser.get_num_pages(html, backend=backend)),
+    ('ContentPageParser', 'content', lambda html, backend: parsers.ContentPageParser(html, backend=backend).parse()),
+    ('ContentPageParser.xhr_response_parser', 'xhr', lambda html, backend: (
+        parsers.ContentPageParser.xhr_response_parser(html, backend=backend)
+    )),
+)
+
+def make_client_class(base_url):
+    # point DownloadClient to the local stub instead of parts.ford.com
+    class MockDownloadClient(app.DownloadClient):
+        BASE_URL = base_url + mockserver.MockFordServer.MENU_PATH
+        XHR_BASE_URL = base_url + mockserver.MockFordServer.XHR_PATH
+    return MockDownloadClient
+
+def directory_size(path):
+    # disk usage, hardlinked files (blob store) are counted once
+    size, inodes = 0, set()
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            stat = os.lstat(os.path.join(dirpath, filename))
+            if (stat.st_dev, stat.st_ino) not in inodes:
+                inodes.add((stat.st_dev, stat.st_ino))
+                size += stat.st_size
+    return size
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # ru_maxrss is KiB on Linux
+
+def run_client(base_url, client_kwargs):
+    base_dir = tempfile.mkdtemp(prefix='ford-bench-')
+    client_class = make_client_class(base_url)
+    client_class.BASE_DIR = base_dir
+    try:
+        client = client_class(**client_kwargs)
+        start = time.monotonic()
+        client()
+        elapsed = time.monotonic() - start
+        bytes_written = directory_size(base_dir)
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+    return {
+        'requests': client.engine.pages,
+        'seconds': elapsed,
+        'requests_per_sec': client.engine.pages / elapsed,
+        'connections': client.session.connection_stats()['connections'],
+        'retries': client.retry_scheduler.retries,
+        'dead_letters': len(client.retry_scheduler.dead_letters),
+        'bytes_written': bytes_written,
+        'peak_rss_mb': peak_rss_mb(),
+        'http_cache': client.http_cache.stats() if client.http_cache else None,
+    }
+
+def run_isolated(base_url, client_kwargs):
+    # fork: child inherits imported modules, mock server keeps running in the parent
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(run_client, base_url, client_kwargs).result()
+
+def run_shard_worker(base_url, base_dir, client_kwargs):
+    client_class = make_client_class(base_url)
+    client_class.BASE_DIR = base_dir
+    client = client_class(**client_kwargs)
+    client()
+    return client.engine.pages
+
+def benchmark_shards(server, client_kwargs, process_counts):
+    # N worker processes drain one shared work queue (sharded crawl), resources/sec against N
+    results = {}
+    for processes in process_counts:
+        base_dir = tempfile.mkdtemp(prefix='ford-bench-shard-')
+        kwargs = dict(client_kwargs, shard_queue=os.path.join(base_dir, 'queue.db'))
+        try:
+            start = time.monotonic()
+            with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('fork')) as executor:
+                futures = [executor.submit(run_shard_worker, server.base_url, base_dir, kwargs) for _ in range(processes)]
+                requests = sum(future.result() for future in futures)
+            elapsed = time.monotonic() - start
+            downloaded = sum(1 for dirpath, dirnames, filenames in os.walk(base_dir) if 'www' in filenames)
+        finally:
+            shutil.rmtree(base_dir, ignore_errors=True)
+        results['processes={0}'.format(processes)] = {
+            'requests': requests,
+            'resources': downloaded,
+            'seconds': elapsed,
+            'resources_per_sec': downloaded / elapsed,
+        }
+        print('Sharded crawl {processes:>2} processes: {resources} resources, {requests} requests, '
+              '{resources_per_sec:.1f} resources/sec'.format(processes=processes, **results['processes={0}'.format(processes)]))
+    return results
+
+def parser_fixtures(server):
+    return {
+        'menu': server.menu_page(),
+        'list': server.list_page(0, 0, per_page=parsers.ListPageParser.ITEM_PER_PAGE),
+        'content': server.content_page('0-0-0'),
+        'xhr': server.xhr_page('PN-0-0-0', '1'),
+    }
+
+def check_parser_parity(fixtures):
+    # every other backend must return exactly what BeautifulSoup returns, tests/test_parsers.py asserts the same
+    mismatches = []
+    for name, fixture, parse in PARSE_FUNCTIONS:
+        expected = parse(fixtures[fixture], 'soup')
+        for backend in parsers.BasePageParser.BACKENDS:
+            if backend == 'soup':
+                continue
+            if parse(fixtures[fixture], backend) != expected:
+                mismatches.append((name, backend))
+    for name, backend in mismatches:
+        print('parity      : {0} [{1}] differs from soup backend'.format(name, backend))
+    if not mismatches:
+        print('parity      : all backends match')
+    return mismatches
+
+def time_per_call(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000 # ms
+
+def benchmark_parsers(fixtures, repeat=50):
+    results = {}
+    for name, fixture, parse in PARSE_FUNCTIONS:
+        for backend in parsers.BasePageParser.BACKENDS:
+            ms = time_per_call(lambda: parse(fixtures[fixture], backend), repeat)
+            results['{0} [{1}]'.format(name, backend)] = ms
+            print('{name:<40} [{backend}] {ms:.2f} ms/page'.format(name=name, backend=backend, ms=ms))
+    return results
+
+def benchmark_js_parser(repeat=2000):
+    # decoded JS literal vs line based fallback, on JSParser's SCHEMA fixtures
+    schemas = parsers.JSParser.SLIDER_SCHEMA + parsers.JSParser.SECTION_IDS_SCHEMA
+    soup = BeautifulSoup(schemas, parsers.BasePageParser.DEFAULT_PARSER)
+    def literal():
+        js_parser = parsers.JSParser(soup)
+        return js_parser.get_slider_images(), js_parser.get_section_ids()
+    def lines():
+        js_parser = parsers.JSParser(soup)
+        return (
+            js_parser.split_slider_images(js_parser.get_slider_script_tag()),
+            js_parser.split_section_ids(js_parser.get_section_script_tag())
+        )
+    if literal() != lines():
+        print('parity      : JSParser literal and line based results differ')
+    results = {}
+    for name, func in (('literal', literal), ('lines', lines)):
+        ms = time_per_call(func, repeat)
+        results['JSParser [{0}]'.format(name)] = ms
+        print('{name:<40} [{kind}] {ms:.3f} ms/page'.format(name='JSParser', kind=name, ms=ms))
+    return results
+
+def benchmark_parse_pool(fixtures, backend=None, pages=400):
+    # content pages/sec against parser process count, 0 = parse inline in crawler threads
+    # pages are submitted from a thread pool, just like content stage workers do
+    html = fixtures['content'].encode()
+    cpu_count = parsepool.ParsePool.cpu_count()
+    workers_list = sorted({0, 1, 2, 4, cpu_count})
+    results = {}
+    for workers in workers_list:
+        pool = parsepool.ParsePool(workers=workers, backend=backend)
+        try:
+            pool.content(html) # warm up, starts worker processes
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=max(workers, 1) * 2) as executor:
+                list(executor.map(lambda _: pool.content(html), range(pages)))
+            pages_per_sec = pages / (time.perf_counter() - start)
+        finally:
+            pool.close()
+        results['parse_workers={0}'.format(workers)] = pages_per_sec
+        print('ParsePool [{backend}] {workers:>2} workers: {pages_per_sec:.1f} pages/sec'.format(
+            backend=backend or parsers.BasePageParser.BACKEND,
+            workers=workers,
+            pages_per_sec=pages_per_sec
+        ))
+    return results
+
+def benchmark_memory(fixtures, count=1000000, dict_count=100000):
+    # bytes per resource held by a crawl of `count` parsed resources (tracemalloc)
+    # compact = resources.Resource, dict = the same content kept as parsed dictionaries
+    parsed = parsers.ContentPageParser(fixtures['content']).parse()
+    text = parsers.ContentPageParser.xhr_response_parser(fixtures['xhr'])
+    url = parsers.ListPageParser(fixtures['list']).parse().container[0].url
+    def parsed_dict(index):
+        # unique per resource: url, title, number, part number, related parts text
+        suffix = '-{0}'.format(index)
+        return {
+            'title': parsed['title'] + suffix,
+            'number': parsed['number'] + suffix,
+            'slider_images': list(parsed['slider_images']),
+            'section_data': {
+                section_id: {
+                    'image': section_value['image'],
+                    'xhr_request_body': dict(
+                        section_value['xhr_request_body'],
+                        partnumber=section_value['xhr_request_body']['partnumber'] + suffix
+                    ),
+                    'text': text + suffix
+                }
+                for section_id, section_value in parsed['section_data'].items()
+            },
+        }
+    def measure(build, count):
+        tracemalloc.start()
+        start = tracemalloc.get_traced_memory()[0]
+        kept = [build(index) for index in range(count)]
+        size = tracemalloc.get_traced_memory()[0] - start
+        tracemalloc.stop()
+        del kept
+        return size / count
+    def compact(index):
+        resource = resources.Resource(url + str(index))
+        resource.set_content(parsed_dict(index))
+        return resource
+    def dictionaries(index):
+        return (url + str(index), parsed_dict(index))
+    results = {'compact': measure(compact, count), 'dict': measure(dictionaries, dict_count)}
+    for name, per_resource in results.items():
+        print('Resource memory [{name:<7}] {per_resource:.0f} bytes/resource ({count} resources)'.format(
+            name=name,
+            per_resource=per_resource,
+            count=count if name == 'compact' else dict_count
+        ))
+    return results
+
+def benchmark_clients(server, scenarios):
+    results = {}
+    for name, client_kwargs in scenarios:
+        result = run_isolated(server.base_url, client_kwargs)
+        results[name] = result
+        print(
+            '{name:<12}: {requests} requests, {requests_per_sec:.1f} req/s, {connections} connections, '
+            '{retries} retries, {dead_letters} dead, {bytes_written} bytes, {peak_rss_mb:.1f} MiB peak RSS'.format(
+                name=name,
+                **result
+            )
+        )
+    return results
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--concurrency', type=int, default=16)
+    arg_parser.add_argument('--per-host', type=int, default=16)
+    arg_parser.add_argument('--latency', type=float, default=0.01, help='mock server latency (seconds)')
+    arg_parser.add_argument('--error-rate', type=float, default=0.0, help='mock server 500 responses probability')
+    arg_parser.add_argument('--menus', type=int, default=2)
+    arg_parser.add_argument('--submenus', type=int, default=2)
+    arg_parser.add_argument('--items', type=int, default=50)
+    arg_parser.add_argument('--shared-items', type=int, default=0, help='parts listed under every submenu')
+    arg_parser.add_argument('--parse-workers', type=int, default=0, help='parser processes of concurrent scenarios')
+    arg_parser.add_argument('--skip-parsers', action='store_true')
+    arg_parser.add_argument('--skip-parse-pool', action='store_true')
+    arg_parser.add_argument('--skip-clients', action='store_true')
+    arg_parser.add_argument('--shards', default='', help='sharded crawl with these worker process counts, e.g. 1,2,4')
+    arg_parser.add_argument('--shard-concurrency', type=int, default=4, help='requests in flight per shard worker')
+    arg_parser.add_argument('--memory-resources', type=int, default=0, help='bytes/resource benchmark size, 1000000 for full crawl')
+    arg_parser.add_argument('--output', default=None, help='write results to JSON file')
+    args = arg_parser.parse_args()
+    concurrent_kwargs = {
+        'concurrency': args.concurrency,
+        'per_host_concurrency': args.per_host,
+        'parse_workers': args.parse_workers,
+    }
+    scenarios = (
+        ('sequential', {'concurrency': 1}),
+        ('concurrent', dict(concurrent_kwargs, streaming=False)),
+        ('streaming', dict(concurrent_kwargs)),
+    )
+    # nightly recrawl: second run revalidates everything the first one cached (ETag -> 304)
+    cache_dir = tempfile.mkdtemp(prefix='ford-bench-cache-')
+    scenarios += (
+        ('cache-cold', dict(concurrent_kwargs, cache_dir=cache_dir)),
+        ('cache-warm', dict(concurrent_kwargs, cache_dir=cache_dir)),
+    )
+    results = {'args': vars(args)}
+    with mockserver.MockFordServer(
+        menus=args.menus,
+        submenus=args.submenus,
+        items=args.items,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        shared_items=args.shared_items
+    ) as server:
+        if not args.skip_parsers:
+            fixtures = parser_fixtures(server)
+            results['parity_mismatches'] = check_parser_parity(fixtures)
+            results['parsers'] = benchmark_parsers(fixtures)
+            results['parsers'].update(benchmark_js_parser())
+        if not args.skip_parse_pool:
+            results['parse_pool'] = benchmark_parse_pool(parser_fixtures(server))
+        if args.memory_resources:
+            results['memory'] = benchmark_memory(
+                parser_fixtures(server),
+                count=args.memory_resources,
+                dict_count=min(args.memory_resources, 100000)
+            )
+        if args.shards:
+            results['shards'] = benchmark_shards(
+                server,
+                dict(concurrent_kwargs, concurrency=args.shard_concurrency, per_host_concurrency=args.shard_concurrency),
+                [int(count) for count in args.shards.split(',')]
+            )
+        if not args.skip_clients:
+            results['clients'] = benchmark_clients(server, scenarios)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+    if results.get('parity_mismatches'):
+        sys.exit(1) # timings of a backend returning different data are meaningless
+
+if __name__ == '__main__':
+    main()
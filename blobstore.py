@@ -0,0 +1,135 @@
+# Content-addressed image store.
+# Slider images, section images and SVGs are shared by many parts. Every unique URL is
+# downloaded once into <root>/objects/<sha256[:2]>/<sha256>, and the per-resource tree
+# only gets hardlinks to the blobs (copies when hardlinks are not possible, e.g. other filesystem).
+# <root>/urls (url<TAB>sha256 lines) survives restarts, resumed runs don't download images again.
+import os
+import shutil
+import hashlib
+import threading
+from filedownload import DEFAULT_CHUNK_SIZE, download_file
+
+class BlobStore:
+
+    INDEX_NAME = 'urls'
+
+    def __init__(self, root, chunk_size=None, worker_id=None):
+        self.root = root
+        self.worker_id = worker_id # store shared by worker processes (sharded crawl), keeps tmp files apart
+        self.chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+        self.objects_dir = os.path.join(root, 'objects')
+        self.tmp_dir = os.path.join(root, 'tmp')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._urls = {} # url -> sha256 hex digest
+        self._pending = {} # url -> threading.Event, url is being downloaded by other thread
+        self.hits = 0 # url already in the store, no request sent
+        self.misses = 0 # url downloaded
+        self.duplicate_blobs = 0 # other url, same content
+        self.links = 0
+        self.copies = 0
+        self.bytes_saved = 0 # disk space saved by links
+        self._load_index()
+
+    def _index_path(self):
+        return os.path.join(self.root, self.__class__.INDEX_NAME)
+
+    def _load_index(self):
+        if not os.path.exists(self._index_path()):
+            return
+        with open(self._index_path(), 'r') as f:
+            for line in f:
+                url, _, digest = line.rstrip('\n').rpartition('\t')
+                if url and digest:
+                    self._urls[url] = digest
+
+    def blob_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def _hash_file(self, path):
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def _download(self, url, fetch, kind):
+        # returns (status code, digest), digest is None for non 200 responses
+        # tmp file name depends on url only, so interrupted download is resumed by the next attempt
+        tmp_name = hashlib.sha1(url.encode()).hexdigest()
+        if self.worker_id:
+            tmp_name += '.' + self.worker_id
+        tmp_path = os.path.join(self.tmp_dir, tmp_name)
+        status = download_file(url, tmp_path, fetch, kind=kind, chunk_size=self.chunk_size)
+        if status != 200:
+            return status, None
+        digest = self._hash_file(tmp_path)
+        blob_path = self.blob_path(digest)
+        if os.path.exists(blob_path):
+            os.remove(tmp_path)
+            with self._lock:
+                self.duplicate_blobs += 1
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(tmp_path, blob_path)
+        with self._lock:
+            self._urls[url] = digest
+            self.misses += 1
+            with open(self._index_path(), 'a') as f:
+                f.write('{0}\t{1}\n'.format(url, digest))
+        return 200, digest
+
+    def get(self, url, fetch, kind='image'):
+        # returns (status code, digest), url is downloaded at most once even by concurrent callers
+        while True:
+            with self._lock:
+                digest = self._urls.get(url)
+                if digest is not None and os.path.exists(self.blob_path(digest)):
+                    self.hits += 1
+                    return 200, digest
+                event = self._pending.get(url)
+                if event is None:
+                    event = self._pending[url] = threading.Event()
+                    break
+            event.wait() # other thread downloads it, failed download is retried by us
+        try:
+            return self._download(url, fetch, kind)
+        finally:
+            with self._lock:
+                del self._pending[url]
+            event.set()
+
+    def materialize(self, digest, path):
+        blob_path = self.blob_path(digest)
+        if os.path.lexists(path):
+            os.remove(path) # resumed download
+        try:
+            os.link(blob_path, path)
+        except OSError:
+            shutil.copyfile(blob_path, path)
+            with self._lock:
+                self.copies += 1
+            return
+        with self._lock:
+            self.links += 1
+            if os.stat(blob_path).st_nlink > 2: # blob itself + first materialized file
+                self.bytes_saved += os.path.getsize(blob_path)
+
+    def save(self, url, path, fetch, kind='image'):
+        # returns response status code, path is written only for 200
+        status, digest = self.get(url, fetch, kind=kind)
+        if digest is not None:
+            self.materialize(digest, path)
+        return status
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'duplicate_blobs': self.duplicate_blobs,
+                'links': self.links,
+                'copies': self.copies,
+                'bytes_saved': self.bytes_saved,
+            }
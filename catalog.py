@@ -0,0 +1,183 @@
+# Structured catalog export, written while the crawl runs (any output sink).
+#   <path>     -> JSONL, one record per parsed resource: url, number, title, submenu, dir, slider images,
+#                 related items parameters and sections (id, image, related parts text)
+#   <path>.db  -> SQLite index: part number, section id and url -> (offset, length) of the latest record,
+#                 filtered queries (number prefix, title words, submenu) without scanning the JSONL or the tree
+# Records of resumed or recrawled resources are appended again, the index points to the latest one.
+# Worker processes of a sharded crawl may share one catalog: lines are appended with O_APPEND.
+#   python catalog.py catalog.jsonl --number 5L8Z-7822
+#   python catalog.py catalog.jsonl --section 1234 --submenu 'Accessories/Electronics'
+import os
+import json
+import sqlite3
+import argparse
+import threading
+
+class Catalog:
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS parts (
+            url TEXT PRIMARY KEY,
+            number TEXT,
+            title TEXT,
+            submenu TEXT,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS parts_number ON parts (number);
+        CREATE INDEX IF NOT EXISTS parts_submenu ON parts (submenu);
+        CREATE TABLE IF NOT EXISTS sections (
+            section_id TEXT NOT NULL,
+            url TEXT NOT NULL,
+            PRIMARY KEY (section_id, url)
+        );
+        CREATE INDEX IF NOT EXISTS sections_url ON sections (url);
+    '''
+
+    def __init__(self, path, base_dir=None):
+        self.path = path
+        self.base_dir = base_dir # submenu and dir of records are relative to it
+        self._lock = threading.Lock()
+        self._fd = None # opened by the first write, readers only need the index
+        # one connection shared by all worker threads, access is serialized by self._lock
+        self._connection = sqlite3.connect(path + '.db', check_same_thread=False, isolation_level=None, timeout=60)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(self.__class__.SCHEMA)
+        self.written = 0
+
+    def _relpath(self, path):
+        return os.path.relpath(path, self.base_dir) if self.base_dir and path else path
+
+    # export
+    def record(self, resource, subdirname, dirname=None):
+        # JSON-able record of parsed resource
+        return {
+            'url': resource.url,
+            'number': resource.number,
+            'title': resource.title,
+            'submenu': self._relpath(subdirname),
+            'dir': self._relpath(dirname),
+            'slider_images': list(resource.slider_images),
+            'related': dict(resource.related),
+            'sections': [
+                {'section_id': str(section.section_id), 'image': section.image, 'text': section.text}
+                for section in resource.sections
+            ],
+        }
+
+    def add(self, resource, subdirname, dirname=None):
+        record = self.record(resource, subdirname, dirname)
+        line = json.dumps(record).encode() + b'\n'
+        with self._lock:
+            if self._fd is None:
+                self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            os.write(self._fd, line)
+            offset = os.lseek(self._fd, 0, os.SEEK_CUR) - len(line) # O_APPEND: other processes may append too
+            connection = self._connection
+            connection.execute('BEGIN')
+            try:
+                connection.execute(
+                    'INSERT OR REPLACE INTO parts (url, number, title, submenu, offset, length) VALUES (?, ?, ?, ?, ?, ?)',
+                    (record['url'], record['number'], record['title'], record['submenu'], offset, len(line))
+                )
+                connection.execute('DELETE FROM sections WHERE url = ?', (record['url'],))
+                connection.executemany(
+                    'INSERT OR IGNORE INTO sections (section_id, url) VALUES (?, ?)',
+                    [(section['section_id'], record['url']) for section in record['sections']]
+                )
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            self.written += 1
+
+    # lookups
+    def _read(self, offset, length):
+        with open(self.path, 'rb') as f:
+            return json.loads(os.pread(f.fileno(), length, offset))
+
+    def get(self, url):
+        # record of url or None
+        with self._lock:
+            row = self._connection.execute('SELECT offset, length FROM parts WHERE url = ?', (url,)).fetchone()
+        return self._read(*row) if row else None
+
+    def query(self, number=None, number_prefix=None, section_id=None, url=None, submenu=None, title=None, limit=None):
+        # records matching every given filter, title matches words anywhere (LIKE), others exactly
+        conditions, params = [], []
+        if number is not None:
+            conditions.append('parts.number = ?')
+            params.append(number)
+        if number_prefix is not None:
+            # range instead of LIKE, parts_number index is used
+            conditions.append('parts.number >= ? AND parts.number < ?')
+            params.extend((number_prefix, number_prefix + '\U0010ffff'))
+        if section_id is not None:
+            conditions.append('parts.url IN (SELECT url FROM sections WHERE section_id = ?)')
+            params.append(str(section_id))
+        if url is not None:
+            conditions.append('parts.url = ?')
+            params.append(url)
+        if submenu is not None:
+            conditions.append('parts.submenu = ?')
+            params.append(submenu)
+        if title is not None:
+            conditions.append('parts.title LIKE ?')
+            params.append('%{0}%'.format(title))
+        sql = 'SELECT offset, length FROM parts'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY offset'
+        if limit is not None:
+            sql += ' LIMIT {0:d}'.format(limit)
+        with self._lock:
+            rows = self._connection.execute(sql, params).fetchall()
+        with open(self.path, 'rb') as f:
+            for offset, length in rows:
+                yield json.loads(os.pread(f.fileno(), length, offset))
+
+    def count(self):
+        # indexed parts, full index scan (not for metrics gauges)
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM parts').fetchone()[0]
+
+    def stats(self):
+        with self._lock:
+            return {'written': self.written}
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            self._connection.close()
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='query catalog exported by app.py --catalog')
+    arg_parser.add_argument('catalog', help='catalog JSONL path, index is <path>.db')
+    arg_parser.add_argument('--number', default=None, help='part number')
+    arg_parser.add_argument('--number-prefix', default=None)
+    arg_parser.add_argument('--section', default=None, help='section id')
+    arg_parser.add_argument('--url', default=None)
+    arg_parser.add_argument('--submenu', default=None, help='submenu directory, relative to BASE_DIR')
+    arg_parser.add_argument('--title', default=None, help='words anywhere in the title')
+    arg_parser.add_argument('--limit', type=int, default=None)
+    args = arg_parser.parse_args()
+    catalog = Catalog(args.catalog)
+    try:
+        for record in catalog.query(
+            number=args.number,
+            number_prefix=args.number_prefix,
+            section_id=args.section,
+            url=args.url,
+            submenu=args.submenu,
+            title=args.title,
+            limit=args.limit
+        ):
+            print(json.dumps(record))
+    finally:
+        catalog.close()
+
+if __name__ == '__main__':
+    main()
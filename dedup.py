@@ -0,0 +1,49 @@
+# Crawl-wide resource URL index.
+# The same part is often listed under several submenus. Its product page, XHRs and images
+# are fetched once, and every later listing gets a link to the first directory
+# (symlink, <submenu dir>/links manifest line or link entry of packed output, see sinks.py).
+import threading
+
+class ResourceIndex:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # url -> [directory, requests], filled in while the first occurrence is processed
+        self._entries = {}
+        self.duplicates = [] # (url, parent directory of the duplicate)
+        self.linked = 0
+
+    def claim(self, url, parent):
+        # True for the first occurrence of url, later ones are remembered for link()
+        with self._lock:
+            if url in self._entries:
+                self.duplicates.append((url, parent))
+                return False
+            self._entries[url] = [None, 0]
+            return True
+
+    def record(self, url, dirname, requests):
+        # requests: how many requests the first occurrence took (content + XHRs + images)
+        with self._lock:
+            self._entries[url] = [dirname, requests]
+
+    def requests_saved(self):
+        with self._lock:
+            return sum(self._entries[url][1] for url, parent in self.duplicates)
+
+    @staticmethod
+    def resource_requests(resource):
+        sections = resource.sections or ()
+        # product page, XHR (unless skipped) + section image + svg per section, slider images
+        xhrs = sum(1 for section in sections if section.text is not None)
+        return 1 + xhrs + 2 * len(sections) + len(resource.slider_images or ())
+
+    def link(self, sink):
+        # called once the crawl is finished, every first occurrence has its directory by now
+        # sink is sinks.DirectorySink (symlink) or packed sink (link entry in archive)
+        for url, parent in self.duplicates:
+            dirname = self._entries[url][0]
+            if dirname is None:
+                continue # first occurrence failed (dead letter)
+            if sink.link(url, dirname, parent):
+                self.linked += 1
@@ -0,0 +1,131 @@
+# Incremental (delta) crawl state, kept between runs (SQLite).
+# Submenu fingerprint is resultCount + resource urls of its landing page: unchanged fingerprint
+# means nothing was added or removed, submenu isn't listed at all. Resources downloaded by
+# previous runs are skipped, with recheck=True their product page is fetched again (cheap with
+# httpcache) and the resource is downloaded again only when parsed content changed.
+import json
+import sqlite3
+import hashlib
+import threading
+
+class DeltaState:
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS submenus (
+            url TEXT PRIMARY KEY,
+            result_count INTEGER,
+            first_page TEXT,
+            dirname TEXT
+        );
+        CREATE TABLE IF NOT EXISTS resources (
+            url TEXT PRIMARY KEY,
+            dirname TEXT NOT NULL,
+            content TEXT NOT NULL
+        );
+    '''
+
+    def __init__(self, path, recheck=False):
+        self.path = path
+        self.recheck = recheck
+        self._lock = threading.Lock()
+        # one connection shared by all worker threads, like journal.CrawlJournal
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(self.__class__.SCHEMA)
+        self._fingerprints = {} # url -> (result count, first page), saved by commit()
+        self.stats = {
+            'submenus_unchanged': 0,
+            'submenus_changed': 0,
+            'resources_known': 0, # listed by previous run, skipped without request
+            'resources_unchanged': 0, # recheck, same content
+            'resources_changed': 0, # recheck, downloaded again
+            'resources_new': 0,
+        }
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._connection.execute(sql, params).fetchall()
+
+    def _fetch_one(self, sql, params=()):
+        rows = self._execute(sql, params)
+        return rows[0] if rows else None
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    @staticmethod
+    def fingerprint(urls):
+        return hashlib.sha1('\n'.join(urls).encode()).hexdigest()
+
+    @staticmethod
+    def content_hash(content_dict):
+        return hashlib.sha1(json.dumps(content_dict, sort_keys=True).encode()).hexdigest()
+
+    # submenus
+    def submenu_unchanged(self, url, result_count, first_page_urls):
+        first_page = self.__class__.fingerprint(first_page_urls)
+        with self._lock:
+            self._fingerprints[url] = (result_count, first_page)
+        row = self._fetch_one('SELECT result_count, first_page FROM submenus WHERE url = ?', (url,))
+        unchanged = row is not None and tuple(row) == (result_count, first_page)
+        self._count('submenus_unchanged' if unchanged else 'submenus_changed')
+        return unchanged
+
+    def get_submenu_dir(self, url):
+        row = self._fetch_one('SELECT dirname FROM submenus WHERE url = ?', (url,))
+        return row[0] if row else None
+
+    def set_submenu_dir(self, url, dirname):
+        self._execute('INSERT OR IGNORE INTO submenus (url) VALUES (?)', (url,))
+        self._execute('UPDATE submenus SET dirname = ? WHERE url = ?', (dirname, url))
+
+    def commit(self):
+        # fingerprints are saved only after clean run (no dead letters),
+        # otherwise failed resources of "unchanged" submenu would never be crawled again
+        with self._lock:
+            fingerprints, self._fingerprints = self._fingerprints, {}
+        for url, (result_count, first_page) in fingerprints.items():
+            self._execute('INSERT OR IGNORE INTO submenus (url) VALUES (?)', (url,))
+            self._execute(
+                'UPDATE submenus SET result_count = ?, first_page = ? WHERE url = ?',
+                (result_count, first_page, url)
+            )
+
+    # resources
+    def is_new(self, url):
+        # False for resource downloaded by previous run, it is skipped (unless recheck)
+        if self._fetch_one('SELECT 1 FROM resources WHERE url = ?', (url,)) is None:
+            self._count('resources_new')
+            return True
+        if self.recheck:
+            return True
+        self._count('resources_known')
+        return False
+
+    def get_resource_dir(self, url):
+        row = self._fetch_one('SELECT dirname FROM resources WHERE url = ?', (url,))
+        return row[0] if row else None
+
+    def content_unchanged(self, url, content_dict):
+        row = self._fetch_one('SELECT content FROM resources WHERE url = ?', (url,))
+        if row is None:
+            return False
+        unchanged = row[0] == self.__class__.content_hash(content_dict)
+        self._count('resources_unchanged' if unchanged else 'resources_changed')
+        return unchanged
+
+    def add_resource(self, url, dirname, content_dict):
+        self._execute(
+            'INSERT OR REPLACE INTO resources (url, dirname, content) VALUES (?, ?, ?)',
+            (url, dirname, self.__class__.content_hash(content_dict))
+        )
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
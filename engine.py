@@ -0,0 +1,98 @@
+# Concurrent crawl engine.
+# Thread-pool based: requests/bs4 release the GIL on socket I/O and lxml parsing,
+# so a pool of threads is enough to keep many requests in flight.
+import time
+import threading
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+import httpsession
+from scheduler import PrioritySlots
+
+class CrawlEngine:
+
+    DEFAULT_CONCURRENCY = 16 # global limit of requests in flight
+    DEFAULT_PER_HOST_CONCURRENCY = 8 # don't hammer a single host (parts.ford.com) !!!
+
+    def __init__(self, concurrency=None, per_host_concurrency=None, session=None, metrics=None, health=None,
+                 scheduler=None):
+        self.concurrency = concurrency or self.__class__.DEFAULT_CONCURRENCY
+        self.per_host_concurrency = min(
+            per_host_concurrency or self.__class__.DEFAULT_PER_HOST_CONCURRENCY,
+            self.concurrency
+        )
+        # every phase shares the same keep-alive connection pool
+        self.session = session if session is not None else httpsession.PooledSession(pool_size=self.concurrency)
+        self.metrics = metrics # metrics.Metrics, optional
+        self.health = health # sessionhealth.SessionHealth, optional, pauses requests while cookies are refreshed
+        self.pages = 0 # number of finished requests, used for pages/sec report
+        self.started = time.monotonic()
+        self.scheduler = scheduler # scheduler.DeadlineScheduler, optional, orders waiting requests by kind
+        if scheduler is not None:
+            scheduler.concurrency = self.concurrency
+            self._global_slots = PrioritySlots(self.concurrency)
+        else:
+            self._global_slots = threading.BoundedSemaphore(self.concurrency)
+        self._host_slots = {}
+        self._lock = threading.Lock()
+
+    @property
+    def sequential(self):
+        # concurrency=1 is the old blocking path, one request at a time
+        return self.concurrency == 1
+
+    def _get_host_slots(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            slots = self._host_slots.get(host)
+            if slots is None:
+                slots = threading.BoundedSemaphore(self.per_host_concurrency)
+                self._host_slots[host] = slots
+            return slots
+
+    def fetch(self, url, kind='other', **kwargs):
+        # kind is endpoint type for metrics: menu, list, content, xhr, image, svg
+        start = time.perf_counter()
+        try:
+            global_slots = self._global_slots
+            if self.scheduler is not None:
+                global_slots = global_slots.slot(self.scheduler.request_priority(kind))
+            with global_slots, self._get_host_slots(url):
+                # inside the slots: requests queued on them during refresh are sent with new cookies
+                generation = self.health.wait() if self.health is not None else None
+                sent = time.perf_counter() # latency without waiting for slots, used for ETA
+                response = self.session.get(url, **kwargs)
+            if self.health is not None:
+                self.health.check(response, kind, generation) # raises SessionExpired
+        except Exception:
+            if self.metrics is not None:
+                self.metrics.increment('request_errors', kind=kind)
+            raise
+        with self._lock:
+            self.pages += 1
+        if self.scheduler is not None:
+            self.scheduler.observe_request(time.perf_counter() - sent)
+        if self.metrics is not None:
+            if kwargs.get('stream'):
+                num_bytes = int(response.headers.get('Content-Length') or 0)
+            else:
+                num_bytes = len(response.content)
+            self.metrics.observe('request_seconds', time.perf_counter() - start, kind=kind)
+            self.metrics.increment('requests', kind=kind)
+            self.metrics.increment('bytes_downloaded', num_bytes, kind=kind)
+            if getattr(response, 'from_cache', False):
+                self.metrics.increment('cache_responses', kind=kind) # fresh hit or 304, body from disk
+        return response
+
+    def map(self, func, iterable):
+        # results are returned in input order, like builtin map()
+        if self.sequential:
+            return [func(item) for item in iterable]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return list(executor.map(func, iterable))
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def pages_per_sec(self):
+        elapsed = self.elapsed()
+        return self.pages / elapsed if elapsed else 0.0
@@ -0,0 +1,40 @@
+# Streaming, atomic and resumable file downloads.
+# Body is streamed in chunk_size pieces into <path>.part (memory doesn't depend on file size)
+# and renamed to <path> once complete, so an existing <path> is always a complete file.
+# <path>.part left by interrupted download (crash, dropped connection) is continued with
+# "Range: bytes=<size>-" request instead of downloading the whole file again.
+import os
+
+DEFAULT_CHUNK_SIZE = 256 * 1024
+PART_SUFFIX = '.part'
+
+def part_path(path):
+    return path + PART_SUFFIX
+
+def download_file(url, path, fetch, kind='image', chunk_size=None):
+    # fetch is CrawlEngine.fetch like callable, returns response status code.
+    # path is written only for successful (200/206) responses, existing path is kept as it is.
+    if os.path.exists(path):
+        return 200 # downloaded by previous attempt
+    chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+    tmp_path = part_path(path)
+    offset = os.path.getsize(tmp_path) if os.path.exists(tmp_path) else 0
+    headers = {'Range': 'bytes={0}-'.format(offset)} if offset else None
+    response = fetch(url, kind=kind, stream=True, headers=headers)
+    try:
+        if response.status_code == 416 and offset:
+            # .part is already complete, previous attempt died before rename
+            os.replace(tmp_path, path)
+            return 200
+        if response.status_code not in (200, 206):
+            return response.status_code
+        # server which ignores Range sends whole file (200), start from scratch
+        mode = 'ab' if response.status_code == 206 else 'wb'
+        with open(tmp_path, mode) as f:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    f.write(chunk)
+    finally:
+        response.close()
+    os.replace(tmp_path, path)
+    return 200
@@ -0,0 +1,246 @@
+# On-disk HTTP cache for GET requests (RFC 7234 subset).
+# Responses with validators (ETag, Last-Modified) or freshness (Cache-Control: max-age, Expires)
+# are stored in <root>/bodies, metadata in <root>/index.db (SQLite).
+#   fresh entry  -> served locally, no request at all
+#   stale entry  -> conditional request (If-None-Match / If-Modified-Since), 304 is served locally
+# Total size is capped, least recently used entries are evicted first.
+# Nightly recrawl of unchanged catalog costs 304s instead of full pages.
+import os
+import io
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import email.utils
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+def parse_cache_control(value):
+    directives = {}
+    for directive in (value or '').split(','):
+        name, _, argument = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"')
+    return directives
+
+def freshness_lifetime(headers):
+    # seconds the response may be served without revalidation
+    directives = parse_cache_control(headers.get('Cache-Control'))
+    if 'no-cache' in directives:
+        return 0
+    for name in ('s-maxage', 'max-age'):
+        if name in directives:
+            try:
+                return max(int(directives[name]), 0)
+            except ValueError:
+                return 0
+    if headers.get('Expires'):
+        try:
+            expires = email.utils.parsedate_to_datetime(headers['Expires']).timestamp()
+        except (TypeError, ValueError):
+            return 0
+        return max(expires - time.time(), 0)
+    return 0
+
+class HTTPCache:
+
+    DEFAULT_MAX_SIZE = 1024 ** 3 # bytes, whole cache
+    MAX_ENTRY_SIZE = 16 * 1024 ** 2 # bigger bodies are not cached
+    EVICT_TO = 0.9 # eviction frees space down to 90% of max_size
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS entries (
+            url TEXT PRIMARY KEY,
+            headers TEXT NOT NULL,
+            expires REAL NOT NULL,
+            size INTEGER NOT NULL,
+            accessed REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+    '''
+
+    def __init__(self, root, max_size=None):
+        self.root = root
+        self.max_size = max_size or self.__class__.DEFAULT_MAX_SIZE
+        self.bodies_dir = os.path.join(root, 'bodies')
+        os.makedirs(self.bodies_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        # one connection shared by all worker threads, like journal.CrawlJournal
+        self._connection = sqlite3.connect(
+            os.path.join(root, 'index.db'),
+            check_same_thread=False,
+            isolation_level=None
+        )
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(self.__class__.SCHEMA)
+        self.size = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        self.hits = 0 # fresh entry, no request
+        self.revalidated = 0 # 304 Not Modified
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.bytes_saved = 0 # body bytes not downloaded thanks to hits and 304s
+
+    def _body_path(self, url):
+        digest = hashlib.sha1(url.encode()).hexdigest()
+        return os.path.join(self.bodies_dir, digest[:2], digest)
+
+    def _get_entry(self, url):
+        # returns (headers, expires) or None
+        with self._lock:
+            row = self._connection.execute('SELECT headers, expires FROM entries WHERE url = ?', (url,)).fetchone()
+            if row is None:
+                return None
+            self._connection.execute('UPDATE entries SET accessed = ? WHERE url = ?', (time.time(), url))
+        return json.loads(row[0]), row[1]
+
+    def _read_body(self, url):
+        try:
+            with open(self._body_path(url), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def cacheable(request):
+        # resumed downloads (Range) always go to the network
+        return request.method == 'GET' and 'Range' not in request.headers
+
+    def _build_response(self, request, headers, body):
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.headers = CaseInsensitiveDict(headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.raw = io.BytesIO(body)
+        response.url = request.url
+        response.request = request
+        response.from_cache = True
+        return response
+
+    def fresh(self, request):
+        # cached response when entry is still fresh, None otherwise (adds validators to request)
+        entry = self._get_entry(request.url)
+        if entry is None:
+            return None
+        headers, expires = entry
+        if expires > time.time():
+            body = self._read_body(request.url)
+            if body is not None:
+                with self._lock:
+                    self.hits += 1
+                    self.bytes_saved += len(body)
+                return self._build_response(request, headers, body)
+        if headers.get('ETag'):
+            request.headers['If-None-Match'] = headers['ETag']
+        if headers.get('Last-Modified'):
+            request.headers['If-Modified-Since'] = headers['Last-Modified']
+        return None
+
+    def update(self, request, response):
+        # called with network response, returns response given to the caller
+        if response.status_code == 304:
+            response.close() # no body, connection goes back to the pool
+            entry = self._get_entry(request.url)
+            body = self._read_body(request.url) if entry is not None else None
+            if body is None:
+                return None # entry evicted meanwhile, caller repeats unconditional request
+            headers = dict(entry[0], **{
+                name: value for name, value in response.headers.items()
+                if name.lower() in ('etag', 'last-modified', 'cache-control', 'expires', 'date')
+            })
+            with self._lock:
+                # body didn't change, only freshness is renewed
+                self._connection.execute(
+                    'UPDATE entries SET headers = ?, expires = ? WHERE url = ?',
+                    (json.dumps(headers), time.time() + freshness_lifetime(headers), request.url)
+                )
+                self.revalidated += 1
+                self.bytes_saved += len(body)
+            return self._build_response(request, headers, body)
+        with self._lock:
+            self.misses += 1
+        if response.status_code != 200 or 'no-store' in parse_cache_control(response.headers.get('Cache-Control')):
+            return response
+        has_validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+        if not has_validator and not freshness_lifetime(response.headers):
+            return response # it could never be reused
+        length = response.headers.get('Content-Length')
+        if length and int(length) > self.__class__.MAX_ENTRY_SIZE:
+            return response
+        body = response.content # reads streamed body too, caller iterates over response._content
+        if len(body) <= self.__class__.MAX_ENTRY_SIZE:
+            self._put(request.url, dict(response.headers), body)
+        return response
+
+    def invalidate(self, url):
+        # entry must not be served again (e.g. logon page cached instead of product page)
+        with self._lock:
+            row = self._connection.execute('SELECT size FROM entries WHERE url = ?', (url,)).fetchone()
+            if row is None:
+                return
+            self._connection.execute('DELETE FROM entries WHERE url = ?', (url,))
+            self.size -= row[0]
+        try:
+            os.remove(self._body_path(url))
+        except FileNotFoundError:
+            pass
+
+    def _put(self, url, headers, body):
+        path = self._body_path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{0}.{1}.tmp'.format(path, threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+        headers = {
+            name: value for name, value in headers.items()
+            if name.lower() not in ('content-encoding', 'transfer-encoding', 'content-length', 'connection')
+        }
+        headers['Content-Length'] = str(len(body)) # body is stored decoded
+        expires = time.time() + freshness_lifetime(headers)
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute('SELECT size FROM entries WHERE url = ?', (url,)).fetchone()
+            self.size -= row[0] if row else 0
+            self._connection.execute(
+                'INSERT OR REPLACE INTO entries (url, headers, expires, size, accessed) VALUES (?, ?, ?, ?, ?)',
+                (url, json.dumps(headers), expires, len(body), now)
+            )
+            self.size += len(body)
+            self.stores += 1
+            if self.size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        # LRU, called with self._lock held
+        target = self.max_size * self.__class__.EVICT_TO
+        rows = self._connection.execute('SELECT url, size FROM entries ORDER BY accessed').fetchall()
+        for url, size in rows:
+            if self.size <= target:
+                break
+            self._connection.execute('DELETE FROM entries WHERE url = ?', (url,))
+            try:
+                os.remove(self._body_path(url))
+            except FileNotFoundError:
+                pass
+            self.size -= size
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'revalidated': self.revalidated,
+                'misses': self.misses,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'bytes_saved': self.bytes_saved,
+                'size': self.size,
+            }
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,104 @@
+# One pooled keep-alive session shared by every crawl phase.
+# requests.get() creates a new Session (new TCP+TLS handshake) on every call !!!
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+class StatsHTTPAdapter(HTTPAdapter):
+
+    def __init__(self, cache=None, archive=None, replay=False, **kwargs):
+        self.cache = cache # httpcache.HTTPCache, optional
+        self.archive = archive # archive.ResponseArchive, records every response (or replays them)
+        self.replay = replay # True -> responses come from self.archive, no network at all
+        super().__init__(**kwargs)
+
+    def send(self, request, stream=False, **kwargs):
+        if self.replay:
+            return self.archive.replay(request)
+        response = self._send(request, stream=stream, **kwargs)
+        if self.archive is not None:
+            self.archive.record(response, stream=stream)
+        return response
+
+    def _send(self, request, **kwargs):
+        if self.cache is None or not self.cache.cacheable(request):
+            return super().send(request, **kwargs)
+        response = self.cache.fresh(request) # adds If-None-Match / If-Modified-Since to stale entry
+        if response is not None:
+            return response
+        response = self.cache.update(request, super().send(request, **kwargs))
+        if response is None:
+            # 304 for entry evicted in the meantime
+            request.headers.pop('If-None-Match', None)
+            request.headers.pop('If-Modified-Since', None)
+            response = self.cache.update(request, super().send(request, **kwargs))
+        return response
+
+    def connection_stats(self):
+        # urllib3 pools count every new connection and every request sent through them
+        connections, requests_sent = 0, 0
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            requests_sent += pool.num_requests
+        return {
+            'connections': connections,
+            'requests': requests_sent,
+            'reused': max(requests_sent - connections, 0),
+        }
+
+class PooledSession(requests.Session):
+
+    DEFAULT_POOL_SIZE = 32 # connections kept alive per host
+    DEFAULT_RETRIES = 3 # transport level retries (connect errors, 5xx)
+    DEFAULT_BACKOFF = 0.5
+    DEFAULT_TIMEOUT = (10, 60) # (connect, read) seconds
+    RETRY_STATUSES = (500, 502, 503, 504)
+
+    def __init__(self, cookies=None, pool_size=None, retries=None, backoff=None, timeout=None, cache=None,
+                 archive=None, replay=False):
+        super().__init__()
+        pool_size = pool_size or self.__class__.DEFAULT_POOL_SIZE
+        retries = self.__class__.DEFAULT_RETRIES if retries is None else retries
+        backoff = self.__class__.DEFAULT_BACKOFF if backoff is None else backoff
+        self.timeout = timeout or self.__class__.DEFAULT_TIMEOUT
+        max_retries = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=self.__class__.RETRY_STATUSES,
+            allowed_methods=frozenset(['GET', 'HEAD'])
+        )
+        self.adapter = StatsHTTPAdapter(
+            cache=cache,
+            archive=archive,
+            replay=replay,
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=max_retries
+        )
+        self.mount('https://', self.adapter)
+        self.mount('http://', self.adapter)
+        if cookies:
+            self.cookies.update(cookies) # attached once, not on every call
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+    def connection_stats(self):
+        return self.adapter.connection_stats()
+
+_shared_session = None
+_shared_session_lock = threading.Lock()
+
+def shared_session(cookies=None):
+    # process wide fallback session, for code which runs without DownloadClient
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            _shared_session = PooledSession(cookies=cookies)
+        return _shared_session
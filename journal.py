@@ -0,0 +1,135 @@
+# Durable crawl journal (SQLite).
+# https://parts.ford.com/ deletes session after ~6-7 hours, restarted DownloadClient
+# reads finished work from here instead of crawling it again.
+import json
+import sqlite3
+import threading
+
+class CrawlJournal:
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS submenus (
+            url TEXT PRIMARY KEY,
+            dirname TEXT,
+            num_pages INTEGER,
+            page_size INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS pages (
+            url TEXT PRIMARY KEY,
+            resources TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS contents (
+            url TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS downloads (
+            url TEXT NOT NULL,
+            parent TEXT NOT NULL,
+            dirname TEXT NOT NULL,
+            done INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (url, parent)
+        );
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # one connection shared by all worker threads, access is serialized by self._lock
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(self.__class__.SCHEMA)
+        try:
+            # journal of older version, its submenus were listed with ListPageParser.ITEM_PER_PAGE
+            self._connection.execute('ALTER TABLE submenus ADD COLUMN page_size INTEGER')
+        except sqlite3.OperationalError:
+            pass # column already exists
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._connection.execute(sql, params).fetchall()
+
+    def _fetch_one(self, sql, params=()):
+        rows = self._execute(sql, params)
+        return rows[0] if rows else None
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    # menu
+    def get_menu(self):
+        row = self._fetch_one('SELECT value FROM meta WHERE key = ?', ('menu',))
+        return json.loads(row[0]) if row else None
+
+    def set_menu(self, menu_dict):
+        self._execute(
+            'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+            ('menu', json.dumps(menu_dict))
+        )
+
+    # submenus
+    def get_submenu(self, url):
+        # returns (dirname, num_pages), both may be None
+        row = self._fetch_one('SELECT dirname, num_pages FROM submenus WHERE url = ?', (url,))
+        return row if row else (None, None)
+
+    def set_submenu_dir(self, url, dirname):
+        self._execute('INSERT OR IGNORE INTO submenus (url) VALUES (?)', (url,))
+        self._execute('UPDATE submenus SET dirname = ? WHERE url = ?', (dirname, url))
+
+    def get_pagination(self, url):
+        # returns (num_pages, page_size), both may be None
+        row = self._fetch_one('SELECT num_pages, page_size FROM submenus WHERE url = ?', (url,))
+        return row if row else (None, None)
+
+    def set_num_pages(self, url, num_pages, page_size=None):
+        self._execute('INSERT OR IGNORE INTO submenus (url) VALUES (?)', (url,))
+        self._execute('UPDATE submenus SET num_pages = ?, page_size = ? WHERE url = ?', (num_pages, page_size, url))
+
+    # list pages
+    def get_page(self, url):
+        # returns list of resource urls or None when page isn't crawled yet
+        row = self._fetch_one('SELECT resources FROM pages WHERE url = ?', (url,))
+        return json.loads(row[0]) if row else None
+
+    def add_page(self, url, resource_urls):
+        self._execute(
+            'INSERT OR REPLACE INTO pages (url, resources) VALUES (?, ?)',
+            (url, json.dumps(resource_urls))
+        )
+
+    # content pages (parse result including related parts text)
+    def get_content(self, url):
+        row = self._fetch_one('SELECT data FROM contents WHERE url = ?', (url,))
+        return json.loads(row[0]) if row else None
+
+    def add_content(self, url, parsed_dict):
+        self._execute(
+            'INSERT OR REPLACE INTO contents (url, data) VALUES (?, ?)',
+            (url, json.dumps(parsed_dict))
+        )
+
+    # downloads
+    def get_download(self, url, parent):
+        # returns (dirname, done) or (None, False)
+        row = self._fetch_one('SELECT dirname, done FROM downloads WHERE url = ? AND parent = ?', (url, parent))
+        return (row[0], bool(row[1])) if row else (None, False)
+
+    def find_download(self, url):
+        # (dirname, done) of resource downloaded under any parent, parts are downloaded once per crawl
+        row = self._fetch_one('SELECT dirname, done FROM downloads WHERE url = ? ORDER BY done DESC LIMIT 1', (url,))
+        return (row[0], bool(row[1])) if row else (None, False)
+
+    def start_download(self, url, parent, dirname):
+        self._execute(
+            'INSERT OR REPLACE INTO downloads (url, parent, dirname, done) VALUES (?, ?, ?, 0)',
+            (url, parent, dirname)
+        )
+
+    def finish_download(self, url, parent):
+        self._execute('UPDATE downloads SET done = 1 WHERE url = ? AND parent = ?', (url, parent))
@@ -0,0 +1,205 @@
+# Crawler instrumentation: latency histograms, counters and gauges.
+# Snapshots are written periodically as JSON and as Prometheus text file
+# (node_exporter textfile collector format), so a multi-hour run can be watched live.
+import os
+import json
+import time
+import bisect
+import threading
+import contextlib
+from profiling import NULL_SECTION
+from utils import write_atomic # readers (prometheus textfile collector) never see half written file
+
+class Histogram:
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0) # seconds
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets or self.__class__.BUCKETS
+        self.counts = [0] * (len(self.buckets) + 1) # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        # [(le, cumulative count)], Prometheus buckets are cumulative
+        total, result = 0, []
+        for le, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((le, total))
+        return result
+
+    def quantile(self, q):
+        # upper bound of the bucket which holds q-th observation
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        for le, total in self.cumulative():
+            if total >= rank:
+                return le if le != float('inf') else self.buckets[-1]
+        return self.buckets[-1]
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+        }
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def format_labels(key):
+    if not key:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, value) for name, value in key) + '}'
+
+class Metrics:
+
+    PREFIX = 'ford'
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._histograms = {} # name -> {label key: Histogram}
+        self._counters = {} # name -> {label key: value}
+        self._gauges = {} # name -> (callback, label name)
+        self.profiler = None # profiling.Profiler, timers and stages of its targets are profiled
+
+    def profile(self, **labels):
+        if self.profiler is None:
+            return NULL_SECTION
+        return self.profiler.section(labels)
+
+    def observe(self, name, value, **labels):
+        with self._lock:
+            histograms = self._histograms.setdefault(name, {})
+            key = label_key(labels)
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def increment(self, name, value=1, **labels):
+        with self._lock:
+            counters = self._counters.setdefault(name, {})
+            key = label_key(labels)
+            counters[key] = counters.get(key, 0) + value
+
+    def register_gauge(self, name, callback, label_name=None):
+        # callback() returns a number, or {label value: number} when label_name is given
+        with self._lock:
+            self._gauges[name] = (callback, label_name)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            with self.profile(**labels):
+                yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def counter_total(self, name):
+        with self._lock:
+            return sum(self._counters.get(name, {}).values())
+
+    def _read_gauges(self):
+        gauges = {}
+        for name, (callback, label_name) in list(self._gauges.items()):
+            value = callback()
+            if label_name is None:
+                gauges[name] = {(): value}
+            else:
+                gauges[name] = {((label_name, label),): number for label, number in value.items()}
+        return gauges
+
+    def snapshot(self):
+        elapsed = time.monotonic() - self.started
+        gauges = self._read_gauges()
+        with self._lock:
+            snapshot = {
+                'timestamp': time.time(),
+                'elapsed_seconds': elapsed,
+                'histograms': {
+                    name: {format_labels(key) or 'all': histogram.snapshot() for key, histogram in histograms.items()}
+                    for name, histograms in self._histograms.items()
+                },
+                'counters': {
+                    name: {format_labels(key) or 'all': value for key, value in counters.items()}
+                    for name, counters in self._counters.items()
+                },
+            }
+        snapshot['gauges'] = {
+            name: {format_labels(key) or 'all': value for key, value in values.items()}
+            for name, values in gauges.items()
+        }
+        snapshot['rates'] = {
+            'requests_per_sec': self.counter_total('requests') / elapsed if elapsed else 0.0,
+            'resources_per_sec': self.counter_total('resources_downloaded') / elapsed if elapsed else 0.0,
+        }
+        return snapshot
+
+    def prometheus_text(self):
+        prefix = self.__class__.PREFIX
+        lines = []
+        gauges = self._read_gauges()
+        with self._lock:
+            for name, histograms in sorted(self._histograms.items()):
+                metric = '{0}_{1}'.format(prefix, name)
+                lines.append('# TYPE {0} histogram'.format(metric))
+                for key, histogram in sorted(histograms.items()):
+                    for le, total in histogram.cumulative():
+                        bucket_key = key + (('le', '+Inf' if le == float('inf') else repr(le)),)
+                        lines.append('{0}_bucket{1} {2}'.format(metric, format_labels(bucket_key), total))
+                    lines.append('{0}_sum{1} {2}'.format(metric, format_labels(key), histogram.sum))
+                    lines.append('{0}_count{1} {2}'.format(metric, format_labels(key), histogram.count))
+            for name, counters in sorted(self._counters.items()):
+                metric = '{0}_{1}_total'.format(prefix, name)
+                lines.append('# TYPE {0} counter'.format(metric))
+                for key, value in sorted(counters.items()):
+                    lines.append('{0}{1} {2}'.format(metric, format_labels(key), value))
+        for name, values in sorted(gauges.items()):
+            metric = '{0}_{1}'.format(prefix, name)
+            lines.append('# TYPE {0} gauge'.format(metric))
+            for key, value in sorted(values.items()):
+                lines.append('{0}{1} {2}'.format(metric, format_labels(key), value))
+        return '\n'.join(lines) + '\n'
+
+class MetricsReporter:
+
+    DEFAULT_INTERVAL = 30 # seconds
+
+    def __init__(self, metrics, path, interval=None):
+        # writes <path>.json and <path>.prom
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval or self.__class__.DEFAULT_INTERVAL
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def write(self):
+        write_atomic(self.path + '.json', json.dumps(self.metrics.snapshot(), indent=4))
+        write_atomic(self.path + '.prom', self.metrics.prometheus_text())
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.write()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='metrics-reporter', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.write() # final snapshot
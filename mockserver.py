@@ -0,0 +1,318 @@
+# Local stub of https://parts.ford.com/ for benchmarks and offline runs.
+# Serves menu / list / content / FordRelatedItemsView / image pages rendered from
+# fixtures/*.html (markup of recorded pages) with configurable latency and error rate.
+import os
+import json
+import math
+import zlib
+import time
+import random
+import string
+import argparse
+import email.utils
+import threading
+import http.cookies
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def load_fixture(name):
+    # fixtures/*.html are page skeletons with the markup of recorded parts.ford.com pages
+    with open(os.path.join(FIXTURES_DIR, name), 'r') as f:
+        return string.Template(f.read())
+
+MENU_PAGE = load_fixture('menu.html')
+LIST_PAGE = load_fixture('list.html')
+CONTENT_PAGE = load_fixture('content.html')
+XHR_PAGE = load_fixture('xhr.html')
+
+MENU_PANEL = string.Template('''
+        <div class="panel panel-default">
+            <div class="panel-heading" id="heading1" role="tab"><h4 class="panel-title">
+                Menu $menu
+            </h4></div>
+            <div class="panel-collapse collapse in" role="tabpanel"><ul class="list-unstyled">$items</ul></div>
+        </div>''')
+MENU_ITEM = string.Template('<li><a href="$url">Submenu $menu-$submenu</a></li>')
+LIST_TILE = string.Template('''
+                <div class="col-md-4 partTile"><a href="$url"><img src="/images/thumb.png"></a><p>$product</p></div>''')
+SECTION_IMAGE = string.Template('<img class="bdr img-responsive" src="$url">')
+SLIDER_IMAGE = string.Template('''
+        {
+            "imageFolder": "$folder",
+            "imagePath": "$path",
+            "imageName": "$name",
+            "imageSequence": "$sequence.0"
+        },''')
+USAGE_ITEM = string.Template('''
+        {
+            "xads_3sectiondescription": "Section $section",
+            "xads_5sectionid": "$section",
+            "partNumber_ntk": "PN-$product",
+            "xillustration_full": "$section.svg"
+        },''')
+
+SVG_IMAGE = b'<svg xmlns="http://www.w3.org/2000/svg"></svg>'
+LOGON_PAGE = b'<html><body><form id="Logon" method="post"><input name="logonId"></form></body></html>'
+
+class MockFordServer:
+
+    MENU_PATH = '/shop/en/us/shop-parts'
+    XHR_PATH = '/shop/FordRelatedItemsView'
+    LOGON_PATH = '/shop/LogonForm' # expired session is redirected here
+    LOGIN_PATH = '/mock/login' # new session cookies (JSON), for sessionhealth.CommandCookieProvider
+
+    def __init__(self, menus=2, submenus=3, items=250, sections=2, slider_images=2,
+                 image_size=4096, latency=0.0, error_rate=0.0, host='127.0.0.1', port=0, shared_items=0,
+                 truncate_rate=0.0, max_age=None, session_requests=None, max_page_size=None, item_latency=0.0):
+        self.menus = menus
+        self.submenus = submenus
+        self.items = items # products per submenu
+        self.shared_items = shared_items # first N products of every submenu are the same parts
+        self.sections = sections
+        self.slider_images = slider_images
+        self.image_size = image_size
+        self.latency = latency # seconds added to every response
+        self.error_rate = error_rate # probability of "500 Internal Server Error"
+        self.truncate_rate = truncate_rate # probability of image connection dropped in the middle of body
+        self.range_requests = 0
+        self.max_age = max_age # Cache-Control: max-age, None -> only validators (ETag, Last-Modified)
+        self.last_modified = email.utils.formatdate(time.time(), usegmt=True)
+        self.not_modified = 0
+        self.max_page_size = max_page_size # larger list pages are clamped to it, None -> any size is served
+        self.item_latency = item_latency # seconds added to list page per listed item (rendering cost)
+        self.session_requests = session_requests # pages served per JSESSIONID, None -> session never expires
+        self._sessions = {} # JSESSIONID -> pages served
+        self.logins = 0
+        self.expired = 0 # requests redirected to logon page
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return 'http://{host}:{port}'.format(host=host, port=port)
+
+    def url(self, path):
+        return self.base_url + path
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    # page generators
+    def menu_page(self):
+        panels = []
+        for menu in range(self.menus):
+            items = ''.join(
+                MENU_ITEM.substitute(
+                    url=self.url('/shop/en/us/list/{0}/{1}'.format(menu, submenu)),
+                    menu=menu,
+                    submenu=submenu
+                )
+                for submenu in range(self.submenus)
+            )
+            panels.append(MENU_PANEL.substitute(menu=menu, items=items))
+        return MENU_PAGE.substitute(panels=''.join(panels))
+
+    def list_page(self, menu, submenu, per_page=12, page=1):
+        first = (page - 1) * per_page
+        last = min(first + per_page, self.items)
+        if self.item_latency:
+            time.sleep(self.item_latency * max(last - first, 0))
+        tiles = ''.join(
+            LIST_TILE.substitute(url=self.url('/shop/en/us/product/{0}'.format(self.product(menu, submenu, index))), product=index)
+            for index in range(first, last)
+        )
+        return LIST_PAGE.substitute(
+            first=first + 1,
+            last=last,
+            count='{:,}'.format(self.items),
+            per_page=per_page,
+            tiles=tiles
+        )
+
+    def product(self, menu, submenu, index):
+        if index < self.shared_items:
+            return 'shared-{0}'.format(index) # listed under several submenus
+        return '{0}-{1}-{2}'.format(menu, submenu, index)
+
+    def content_page(self, product):
+        section_ids = ['{0}{1}'.format(zlib.crc32(product.encode()) % 100000, index) for index in range(self.sections)]
+        section_images = ''.join(
+            SECTION_IMAGE.substitute(url=self.url('/images/section-images/{0}.png'.format(section)))
+            for section in section_ids
+        )
+        slider_images = ''.join(
+            SLIDER_IMAGE.substitute(
+                folder=index,
+                path=self.url('/images/photo-images/{0}/'.format(index)),
+                name='{0}-{1}.jpg'.format(product, index),
+                sequence=index + 1
+            )
+            for index in range(self.slider_images)
+        )
+        usage_items = ''.join(USAGE_ITEM.substitute(section=section, product=product) for section in section_ids)
+        return CONTENT_PAGE.substitute(
+            product=product,
+            section_images=section_images,
+            slider_images=slider_images,
+            usage_items=usage_items
+        )
+
+    def xhr_page(self, partnumber, section):
+        return XHR_PAGE.substitute(partnumber=partnumber, section=section)
+
+    def login(self):
+        with self._lock:
+            self.logins += 1
+            return {'JSESSIONID': 'mock-session-{0}'.format(self.logins)}
+
+    def session_valid(self, cookie_header):
+        # every page request uses up the session a bit, any unknown JSESSIONID starts a new one
+        morsel = http.cookies.SimpleCookie(cookie_header or '').get('JSESSIONID')
+        session_id = morsel.value if morsel else ''
+        with self._lock:
+            served = self._sessions.get(session_id, 0)
+            if served >= self.session_requests:
+                self.expired += 1
+                return False
+            self._sessions[session_id] = served + 1
+            return True
+
+    def route(self, path, query):
+        # returns (status, content_type, body)
+        parts = path.strip('/').split('/')
+        if path == self.__class__.MENU_PATH:
+            return 200, 'text/html', self.menu_page().encode()
+        if path == self.__class__.XHR_PATH:
+            params = dict(pair.split('=', 1) for pair in query.split('&') if '=' in pair)
+            body = self.xhr_page(params.get('partnumber', ''), params.get('sectionId', ''))
+            return 200, 'text/html', body.encode()
+        if parts[:4] == ['shop', 'en', 'us', 'list']:
+            if len(parts) == 6:
+                return 200, 'text/html', self.list_page(int(parts[4]), int(parts[5])).encode()
+            if len(parts) == 8:
+                per_page, page = int(parts[6]), int(parts[7])
+                if self.max_page_size:
+                    per_page = min(per_page, self.max_page_size)
+                if page > max(1, math.ceil(self.items / per_page)):
+                    return 404, 'text/html', b''
+                return 200, 'text/html', self.list_page(int(parts[4]), int(parts[5]), per_page, page).encode()
+        if parts[:4] == ['shop', 'en', 'us', 'product'] and len(parts) == 5:
+            return 200, 'text/html', self.content_page(parts[4]).encode()
+        if parts[0] == 'images':
+            if path.endswith('.svg'):
+                return 200, 'image/svg+xml', SVG_IMAGE
+            return 200, 'image/jpeg', b'\0' * self.image_size
+        return 404, 'text/html', b''
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1' # keep-alive
+            disable_nagle_algorithm = True # headers and body are written separately
+
+            def do_GET(self):
+                with server._lock:
+                    server.requests += 1
+                if server.latency:
+                    time.sleep(server.latency)
+                split = urlsplit(self.path)
+                if server.error_rate and random.random() < server.error_rate:
+                    with server._lock:
+                        server.errors += 1
+                    status, content_type, body = 500, 'text/html', b''
+                else:
+                    status, content_type, body = server.route(split.path, split.query)
+                headers = {}
+                if split.path == server.__class__.LOGIN_PATH:
+                    status, content_type, body = 200, 'application/json', json.dumps(server.login()).encode()
+                elif split.path == server.__class__.LOGON_PATH:
+                    status, content_type, body = 200, 'text/html', LOGON_PAGE
+                elif (status == 200 and server.session_requests and not split.path.startswith('/images/')
+                        and not server.session_valid(self.headers.get('Cookie'))):
+                    status, content_type, body = 302, 'text/html', b''
+                    headers['Location'] = server.url(server.__class__.LOGON_PATH)
+                if status == 200:
+                    headers['ETag'] = '"{0:08x}"'.format(zlib.crc32(body))
+                    headers['Last-Modified'] = server.last_modified
+                    if server.max_age is not None:
+                        headers['Cache-Control'] = 'max-age={0}'.format(server.max_age)
+                    if self.headers.get('If-None-Match') == headers['ETag']:
+                        with server._lock:
+                            server.not_modified += 1
+                        status, body = 304, b''
+                byte_range = self.headers.get('Range')
+                if status == 200 and byte_range and byte_range.startswith('bytes='):
+                    with server._lock:
+                        server.range_requests += 1
+                    offset = int(byte_range[len('bytes='):].split('-')[0])
+                    if offset >= len(body):
+                        status, body = 416, b''
+                    else:
+                        headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(offset, len(body) - 1, len(body))
+                        status, body = 206, body[offset:]
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                if content_type == 'image/jpeg' and server.truncate_rate and random.random() < server.truncate_rate:
+                    self.wfile.write(body[:len(body) // 2]) # client sees short body, resumes with Range
+                    self.close_connection = True
+                    return
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # be quiet
+
+        return Handler
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--port', type=int, default=8000)
+    arg_parser.add_argument('--latency', type=float, default=0.0)
+    arg_parser.add_argument('--error-rate', type=float, default=0.0)
+    arg_parser.add_argument('--shared-items', type=int, default=0)
+    arg_parser.add_argument('--truncate-rate', type=float, default=0.0)
+    arg_parser.add_argument('--max-age', type=int, default=None, help='Cache-Control: max-age of every response')
+    arg_parser.add_argument('--session-requests', type=int, default=None, help='pages per session, then logon redirect')
+    arg_parser.add_argument('--max-page-size', type=int, default=None, help='larger list pages are clamped to it')
+    arg_parser.add_argument('--item-latency', type=float, default=0.0, help='seconds added to list page per item')
+    args = arg_parser.parse_args()
+    server = MockFordServer(
+        port=args.port,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        shared_items=args.shared_items,
+        truncate_rate=args.truncate_rate,
+        max_age=args.max_age,
+        session_requests=args.session_requests,
+        max_page_size=args.max_page_size,
+        item_latency=args.item_latency
+    )
+    print('Serving on', server.url(MockFordServer.MENU_PATH))
+    server._httpd.serve_forever()
+
+if __name__ == '__main__':
+    main()
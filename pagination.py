@@ -0,0 +1,100 @@
+# Adaptive pagination of submenu list pages.
+# ListPageParser.ITEM_PER_PAGE used to be fixed and the submenu landing page (fetched for the result count)
+# was thrown away, page 1 was requested again. Now:
+#   landing page      -> reused as page 1 when its page size is used, small submenus need no other request
+#   probe             -> the largest page size the server accepts is found once per crawl,
+#                        probe response is a real page 1 and is reused too
+#   autotune          -> every candidate size (max, max/2, max/4) is measured on SAMPLES real pages,
+#                        then submenus use the size with the lowest latency per listed item
+#   requests saved    -> against landing page + ceil(count / ITEM_PER_PAGE) pages, per submenu
+import math
+import threading
+
+class PageSizeTuner:
+
+    PROBE_SIZES = (500, 200, 100) # largest first, the first accepted one is the maximum
+    MIN_SIZE = 12 # page size of Ford's landing page, smaller pages are never worth it
+    CANDIDATES = 3 # max, max/2, max/4
+    SAMPLES = 3 # pages measured with every candidate before the best one is chosen
+
+    def __init__(self, default_size, probe_sizes=None, samples=None):
+        self.default_size = default_size # ListPageParser.ITEM_PER_PAGE, baseline of saved requests
+        self.probe_sizes = tuple(probe_sizes or self.__class__.PROBE_SIZES)
+        self.samples = samples or self.__class__.SAMPLES
+        self.max_size = None # None until probed
+        self._lock = threading.Lock()
+        self._probe_lock = threading.Lock() # one prober, submenus listed meanwhile wait for its result
+        self._measured = {} # page size -> [pages, seconds, items]
+        self._saved = {} # submenu url -> requests saved
+        self.probes = 0
+        self.reused = 0 # landing and probe pages used as page 1
+
+    def probe(self, fetch_page, fallback):
+        # fetch_page(size) -> (served size, page) or None when size is rejected, fallback when all are rejected
+        # returns (size, page) to the prober, page is its page 1 of that size, None to everyone else
+        with self._probe_lock:
+            if self.max_size is not None:
+                return None
+            for size in self.probe_sizes:
+                with self._lock:
+                    self.probes += 1
+                probed = fetch_page(size)
+                if probed is None:
+                    continue
+                served, page = probed
+                self.max_size = min(served, size) # server may clamp the size instead of rejecting it
+                return self.max_size, page
+            self.max_size = fallback
+            return None
+
+    def candidates(self):
+        sizes = []
+        size = self.max_size
+        while size >= self.__class__.MIN_SIZE and len(sizes) < self.__class__.CANDIDATES:
+            sizes.append(size)
+            size //= 2
+        return sizes or [self.max_size]
+
+    def choose(self):
+        # page size of the next submenu: unmeasured candidates first, then the lowest latency per item
+        candidates = self.candidates()
+        with self._lock:
+            for size in candidates:
+                if self._measured.get(size, (0,))[0] < self.samples:
+                    return size
+            return min(candidates, key=lambda size: self._latency_per_item(size))
+
+    def _latency_per_item(self, size):
+        pages, seconds, items = self._measured[size]
+        return seconds / items if items else float('inf')
+
+    def observe(self, size, seconds, items):
+        with self._lock:
+            measured = self._measured.setdefault(size, [0, 0.0, 0])
+            measured[0] += 1
+            measured[1] += seconds
+            measured[2] += items
+
+    def record(self, url, result_count, requests, reused):
+        # requests -> list requests of the submenu including landing page (and probes)
+        baseline = 1 + math.ceil(result_count / self.default_size)
+        with self._lock:
+            self._saved[url] = baseline - requests
+            self.reused += reused
+
+    def requests_saved(self):
+        with self._lock:
+            return dict(self._saved)
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                'max_page_size': self.max_size or 0,
+                'probes': self.probes,
+                'reused_pages': self.reused,
+                'submenus': len(self._saved),
+                'requests_saved': sum(self._saved.values()),
+            }
+            for size in sorted(self._measured):
+                stats['ms_per_item_{0}'.format(size)] = round(self._latency_per_item(size) * 1000, 3)
+        return stats
@@ -0,0 +1,86 @@
+# Process pool for page parsing.
+# BeautifulSoup parsing is pure CPU and holds the GIL, so with fast fetching one core becomes the limit.
+# Raw response bytes go to worker processes, compact picklable results come back:
+# lists of URLs, parsed content dicts, related parts text.
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import parsers
+
+# worker functions, module level so they can be pickled by name
+def parse_menu(html, backend=None):
+    return parsers.MenuPageParser(html, backend=backend).parse()
+
+def parse_num_pages(html, backend=None):
+    return parsers.ListPageParser.get_num_pages(html, backend=backend)
+
+def parse_list_page(html, backend=None):
+    return [resource.url for resource in parsers.ListPageParser(html, backend=backend).parse()]
+
+def parse_list_summary(html, backend=None):
+    # (result count, page size, resource urls) of submenu landing page, delta crawl fingerprint and page 1
+    result_count = parsers.ListPageParser.get_result_count(html, backend=backend)
+    resource_urls = parse_list_page(html, backend=backend)
+    return result_count, parsers.ListPageParser.get_page_size(html) or len(resource_urls), resource_urls
+
+def parse_content_page(html, backend=None):
+    # title, number, slider_images, section_data, usage_items
+    return parsers.ContentPageParser(html, backend=backend).parse()
+
+def parse_xhr(html, backend=None):
+    return parsers.ContentPageParser.xhr_response_parser(html, backend=backend)
+
+class ParsePool:
+
+    # forkserver: crawler has many threads running, fork()ing such a process isn't safe
+    START_METHOD = 'forkserver'
+
+    def __init__(self, workers=0, backend=None):
+        # workers=0 -> parse inline in the calling thread, no extra processes
+        self.workers = workers
+        self.backend = backend
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cpu_count():
+        return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context(self.__class__.START_METHOD)
+                )
+            return self._executor
+
+    def _call(self, func, html):
+        if not self.workers:
+            return func(html, self.backend)
+        return self._get_executor().submit(func, html, self.backend).result()
+
+    def menu(self, html):
+        return self._call(parse_menu, html)
+
+    def num_pages(self, html):
+        return self._call(parse_num_pages, html)
+
+    def list_page(self, html):
+        return self._call(parse_list_page, html)
+
+    def list_summary(self, html):
+        return self._call(parse_list_summary, html)
+
+    def content(self, html):
+        return self._call(parse_content_page, html)
+
+    def xhr(self, html):
+        return self._call(parse_xhr, html)
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
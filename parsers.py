@@ -1,7 +1,10 @@
 import os
+import re
 import copy
+import json
 import collections
 import math
+import lxml.html
 from bs4 import BeautifulSoup
 from resources import Resource, ResourceSet
 from utils import correct_name_generator
@@ -9,19 +12,45 @@ from utils import correct_name_generator
 # custom exception
 class BadParsedNumPages(Exception):
     pass
-    
+
+# XPath equivalent of BeautifulSoup's class matching: find_all('div', {'class': 'partTile'})
+def has_class_xpath(class_name):
+    return 'contains(concat(" ", normalize-space(@class), " "), " {0} ")'.format(class_name)
+
+def lxml_document(html_stream):
+    return lxml.html.document_fromstring(html_stream)
+
 class BasePageParser:
     
     DEFAULT_PARSER = 'lxml'
+    # extraction backend:
+    # 'soup' -> full BeautifulSoup tree + find_all
+    # 'lxml' -> raw lxml tree + XPath, no BeautifulSoup objects at all (several times faster)
+    # can be changed per parser class, e.g. ListPageParser.BACKEND = 'lxml', or per instance
+    BACKENDS = ('soup', 'lxml')
+    BACKEND = 'soup'
 
-    def __init__(self, html_stream):
+    def __init__(self, html_stream, backend=None):
         self._html_stream = html_stream
+        self.backend = self.__class__.get_backend(backend)
+
+    @classmethod
+    def get_backend(cls, backend=None):
+        backend = backend or cls.BACKEND
+        if backend not in cls.BACKENDS:
+            raise ValueError('Unknown parser backend: {0}'.format(backend))
+        return backend
+
+    def parse(self):
+        if self.backend == 'lxml':
+            return self._parse_lxml()
+        return self._parse_soup()
 
     correct_name_generator = staticmethod(correct_name_generator)
 
 class MenuPageParser(BasePageParser):
 
-    def parse(self):
+    def _parse_soup(self):
         menu_dict = collections.OrderedDict()
         soup = BeautifulSoup(self._html_stream, self.__class__.DEFAULT_PARSER)
         divs = soup.find_all('div', {'id': 'heading1'})
@@ -44,21 +73,46 @@ class MenuPageParser(BasePageParser):
                     })
         return menu_dict
 
+    def _parse_lxml(self):
+        menu_dict = collections.OrderedDict()
+        document = lxml_document(self._html_stream)
+        for div in document.xpath('//div[@id="heading1"]'):
+            h4 = div.xpath('.//h4')[0]
+            h4_verbose = h4.text_content().replace('\n', '').strip()
+            normalize_h4_verbose = self.__class__.correct_name_generator(h4_verbose)
+            for inner_div in div.itersiblings('div'):
+                for li in inner_div.iter('li'):
+                    a = li.xpath('.//a')[0]
+                    menu_dict.setdefault(normalize_h4_verbose, []).append({
+                        'name': self.__class__.correct_name_generator(a.text_content()),
+                        'url': a.attrib['href'],
+                    })
+        return menu_dict
+
 class ListPageParser(BasePageParser):
 
     ITEM_PER_PAGE = 100 # this is performance optimizer !!! reduce num requests !!! ~ 3x faster than 12 per page
+                        # default only, crawl probes and autotunes page size, see pagination.py
     PAGINATION_SUFFIX = '#list' # this is "fragment identified" SUFFIX for URL
+    PAGE_SIZE_RE = re.compile(rb"pageSize\s*=\s*['\"]?(\d+)")
 
-    def parse(self):
+    def _parse_soup(self):
+        soup = BeautifulSoup(self._html_stream, self.__class__.DEFAULT_PARSER)
+        divs = soup.find_all('div', {'class': 'partTile'})
+        return self.__class__.make_resource_set(div.find('a')['href'] for div in divs)
+
+    def _parse_lxml(self):
+        document = lxml_document(self._html_stream)
+        divs = document.xpath('//div[{0}]'.format(has_class_xpath('partTile')))
+        return self.__class__.make_resource_set(div.xpath('.//a')[0].attrib['href'] for div in divs)
+
+    @staticmethod
+    def make_resource_set(hrefs):
         SECTION_ID = '#sectionId'
         USAGES = '#usages'
         resource_set = ResourceSet()
-        soup = BeautifulSoup(self._html_stream, self.__class__.DEFAULT_PARSER)
-        divs = soup.find_all('div', {'class': 'partTile'})
         prev_url = None
-        for div in divs:
-            a = div.find('a')
-            a_href = a['href']
+        for a_href in hrefs:
             if USAGES in a_href:
                 continue
             if SECTION_ID in a_href:
@@ -81,35 +135,157 @@ class ListPageParser(BasePageParser):
         return resource_set
 
     @classmethod
-    def get_num_pages(cls, html_stream):
-        soup = BeautifulSoup(html_stream, cls.DEFAULT_PARSER)
-        span = soup.find('span', {'class': 'resultCount'})
-        filtered = list(filter(None, span.get_text().split(' ')))
+    def get_result_count(cls, html_stream, backend=None):
+        # "Showing 1 - 12 of 1,234 Results" -> 1234
+        if cls.get_backend(backend) == 'lxml':
+            document = lxml_document(html_stream)
+            span_text = document.xpath('//span[{0}]'.format(has_class_xpath('resultCount')))[0].text_content()
+        else:
+            soup = BeautifulSoup(html_stream, cls.DEFAULT_PARSER)
+            span_text = soup.find('span', {'class': 'resultCount'}).get_text()
+        filtered = list(filter(None, span_text.split(' ')))
         try:
             get_number = filtered[-2] 
-            try:
-                get_int = math.ceil(int(get_number) / cls.ITEM_PER_PAGE)
-            except ValueError:
-                get_number = get_number.replace(',', '')
-                get_int = math.ceil(int(get_number) / cls.ITEM_PER_PAGE)
-            return get_int
         except IndexError:
             raise BadParsedNumPages
+        return int(get_number.replace(',', ''))
+
+    @classmethod
+    def num_pages(cls, result_count, item_per_page=None):
+        return math.ceil(result_count / (item_per_page or cls.ITEM_PER_PAGE))
+
+    @classmethod
+    def get_num_pages(cls, html_stream, backend=None):
+        return cls.num_pages(cls.get_result_count(html_stream, backend=backend))
     
     @staticmethod
     def generate_page_range(num_pages):
         return range(1, num_pages+1)
 
     @classmethod
-    def generate_valid_url(cls, url, page_num):
+    def generate_valid_url(cls, url, page_num, item_per_page=None):
         # URL: https://parts.ford.com/shop/en/us/accessories/electronics/<item_per_page>/<page>#list
         return '{url}/{item_per_page}/{page_num}{suffix}'.format(
             url=url,
-            item_per_page=cls.ITEM_PER_PAGE,
+            item_per_page=item_per_page or cls.ITEM_PER_PAGE,
             page_num=page_num,
             suffix=cls.PAGINATION_SUFFIX
         )
 
+    @classmethod
+    def split_valid_url(cls, page_url):
+        # inverse of generate_valid_url -> (url, item_per_page, page_num)
+        url, item_per_page, page_num = page_url[:-len(cls.PAGINATION_SUFFIX)].rsplit('/', 2)
+        return url, int(item_per_page), int(page_num)
+
+    @classmethod
+    def get_page_size(cls, html_stream):
+        # var pageSize = '12'; of page script, items per page the server really used, None when missing
+        if isinstance(html_stream, str):
+            html_stream = html_stream.encode()
+        match = cls.PAGE_SIZE_RE.search(html_stream)
+        return int(match.group(1)) if match else None
+
+# JS literal decoding, used by JSParser
+# imageServicesList = {...}; / usageItemsList = [...]; are almost JSON:
+# they may contain trailing commas, single quoted strings and unquoted keys (minified JS)
+JS_TOKEN_RE = re.compile(r'''
+    (?P<string>"(?:[^"\\]|\\.)*")
+    |(?P<single>'(?:[^'\\]|\\.)*')
+    |(?P<number>-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+    |(?P<key>[A-Za-z_$][\w$]*)(?=\s*:)
+    |(?P<word>[A-Za-z_$][\w$]*)
+    |(?P<trailing>,(?=\s*[\]}]))
+    |(?P<other>[^"'\w$,-]+|[,-])
+''', re.VERBOSE | re.DOTALL)
+JS_WORDS = {'true': 'true', 'false': 'false', 'null': 'null', 'undefined': 'null'}
+
+JS_LITERAL_CHARS_RE = re.compile(r'["\'\[\]{}\\]') # chars extract_js_literal cares about
+JSON_DECODER = json.JSONDecoder()
+JS_ASSIGNMENT_RE = re.compile(r'\s*=\s*(?=[\[{])')
+JS_MAX_TRAILING_COMMAS = 64
+
+def extract_js_literal(text, start):
+    # returns source of balanced {...} or [...] starting at text[start], strings are skipped
+    depth, quote = 0, None
+    escaped_index = -1
+    for match in JS_LITERAL_CHARS_RE.finditer(text, start):
+        char, index = match.group(), match.start()
+        if index == escaped_index:
+            continue
+        if quote:
+            if char == '\\':
+                escaped_index = index + 1
+            elif char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char in '[{':
+            depth += 1
+        elif char in ']}':
+            depth -= 1
+            if depth == 0:
+                return text[start:index + 1]
+    return None
+
+def decode_js_literal(source):
+    # tokenizes JS literal and rewrites it to JSON, returns python object or raises ValueError
+    chunks = []
+    for match in JS_TOKEN_RE.finditer(source):
+        kind = match.lastgroup
+        token = match.group()
+        if kind == 'single':
+            token = json.dumps(token[1:-1].replace("\\'", "'"))
+        elif kind == 'key':
+            token = '"{0}"'.format(token)
+        elif kind == 'word':
+            if token not in JS_WORDS:
+                raise ValueError('Not a JS literal: {0}'.format(token))
+            token = JS_WORDS[token]
+        elif kind == 'trailing':
+            token = ''
+        chunks.append(token)
+    return json.loads(''.join(chunks))
+
+def decode_js_literal_at(text, index):
+    # fast path: JSON, C decoder stops at the end of literal by itself.
+    # trailing commas are removed one by one at the positions where decoder fails on them.
+    for _ in range(JS_MAX_TRAILING_COMMAS):
+        try:
+            return JSON_DECODER.raw_decode(text, index)[0]
+        except json.JSONDecodeError as exc:
+            position = exc.pos
+            if position >= len(text) or text[position] not in ']}':
+                break
+            comma = len(text[:position].rstrip()) - 1
+            if comma < index or text[comma] != ',':
+                break
+            text = text[:comma] + text[comma + 1:]
+    # slow path: minified JS (unquoted keys, single quoted strings...)
+    source = extract_js_literal(text, index)
+    if source is None:
+        raise ValueError('Unbalanced JS literal')
+    return decode_js_literal(source)
+
+def find_js_literal(text, variable):
+    # decodes value of last "<variable> = {...}" or "<variable> = [...]" assignment.
+    # "var x = [];" initialization is followed by the real assignment, that's why the last one.
+    # str.rfind is much faster than scanning whole script with a regex
+    position = len(text)
+    while True:
+        position = text.rfind(variable, 0, position)
+        if position == -1:
+            return None
+        if position and (text[position - 1].isalnum() or text[position - 1] in '_$.'):
+            continue
+        match = JS_ASSIGNMENT_RE.match(text, position + len(variable))
+        if match is None:
+            continue
+        try:
+            return decode_js_literal_at(text, match.end())
+        except ValueError:
+            continue
+
 class JSParser:
     
     LEFT_EXPRESSION = '['
@@ -216,30 +392,93 @@ class JSParser:
         </script>
     '''
 
+    SLIDER_VARIABLE = 'imageServicesList'
+    SECTION_VARIABLE = 'usageItemsList'
+
     def __init__(self, soup):
-        self.soup = soup
+        self.soup = soup # BeautifulSoup object or lxml document
+        self._scripts = None
+
+    def iter_script_texts(self):
+        if hasattr(self.soup, 'find_all'):
+            for script in self.soup.find_all('script'):
+                yield script.get_text()
+        else:
+            for script in self.soup.iter('script'):
+                yield script.text or ''
+
+    def _scan_scripts(self):
+        # single pass over all <script> tags, result is cached:
+        # {variable: (script text, decoded literal or None)}
+        if self._scripts is None:
+            variables = (self.__class__.SLIDER_VARIABLE, self.__class__.SECTION_VARIABLE)
+            self._scripts = {}
+            for get_text in self.iter_script_texts():
+                for variable in variables:
+                    if variable not in self._scripts and variable in get_text:
+                        self._scripts[variable] = (get_text, find_js_literal(get_text, variable))
+                if len(self._scripts) == len(variables):
+                    break
+        return self._scripts
 
     def get_slider_script_tag(self):
-        scripts = self.soup.find_all('script')
-        for index, script in enumerate(scripts):
-            get_text = script.get_text()
-            if 'imageFolder' in get_text and \
-               'imagePath' in get_text and \
-               'imageName' in get_text and \
-               'imageSequence' in get_text:
-                return get_text
-
-    # implements JS source code parser
+        get_text = self._scan_scripts().get(self.__class__.SLIDER_VARIABLE, (None, None))[0]
+        if get_text is not None and \
+           'imageFolder' in get_text and \
+           'imagePath' in get_text and \
+           'imageName' in get_text and \
+           'imageSequence' in get_text:
+            return get_text
+
+    def get_slider_data(self):
+        # list of dicts: imageFolder, imagePath, imageName, imageSequence
+        literal = self._scan_scripts().get(self.__class__.SLIDER_VARIABLE, (None, None))[1]
+        if isinstance(literal, dict) and isinstance(literal.get('imageData'), list):
+            return [item for item in literal['imageData'] if isinstance(item, dict)]
+        return None
+
     def get_slider_images(self):
+        image_data = self.get_slider_data()
+        if image_data is not None:
+            return [
+                os.path.join(item['imagePath'], item['imageName'])
+                for item in image_data if 'imagePath' in item and 'imageName' in item
+            ]
         get_text = self.get_slider_script_tag()
         if get_text is None:
             return []
+        return self.__class__.split_slider_images(get_text)
+
+    def get_section_script_tag(self):
+        get_text = self._scan_scripts().get(self.__class__.SECTION_VARIABLE, (None, None))[0]
+        if get_text is not None and '"xads_5sectionid"' in get_text:
+            return get_text
+
+    def get_usage_items(self):
+        # list of dicts with every usage field (xads_5sectionid, xillustration_full, partNumber_ntk, ...)
+        literal = self._scan_scripts().get(self.__class__.SECTION_VARIABLE, (None, None))[1]
+        if isinstance(literal, list):
+            return [item for item in literal if isinstance(item, dict)]
+        return None
+
+    def get_section_ids(self):
+        usage_items = self.get_usage_items()
+        if usage_items is not None:
+            return [str(item['xads_5sectionid']) for item in usage_items if 'xads_5sectionid' in item]
+        get_text = self.get_section_script_tag()
+        if get_text is None:
+            return []
+        return self.__class__.split_section_ids(get_text)
+
+    # line based fallbacks, used only when JS literal can't be decoded
+    @classmethod
+    def split_slider_images(cls, get_text):
         tokens = filter(None, get_text.split('\n'))
         pathes, names = [], []
         for token in tokens:
-            if self.__class__.COLON_EXPRESSION in token and \
-               self.__class__.LEFT_EXPRESSION not in token and \
-               self.__class__.ASSIGNMENT_EXPRESSION not in token:
+            if cls.COLON_EXPRESSION in token and \
+               cls.LEFT_EXPRESSION not in token and \
+               cls.ASSIGNMENT_EXPRESSION not in token:
                 token = token.replace('"', '').replace(',', '').replace('\t', '').replace(' ', '')
                 if 'imagePath' in token:
                     path = token.split('imagePath:')[1]
@@ -251,19 +490,9 @@ class JSParser:
         images = [os.path.join(path, name) for path, name in make_zip]
         return images
 
-    def get_section_script_tag(self):
-        scripts = self.soup.find_all('script')
-        for index, script in enumerate(scripts):
-            get_text = script.get_text()
-            if '"xads_5sectionid"' in get_text:
-                return get_text
-    
-    # implements JS source code parser
-    def get_section_ids(self):
-        get_text = self.get_section_script_tag()
+    @staticmethod
+    def split_section_ids(get_text):
         section_ids = []
-        if get_text is None:
-            return section_ids
         tokens = filter(None, get_text.split('\n'))
         for token in tokens:
             if token == '\t':
@@ -278,37 +507,64 @@ class JSParser:
 
 class ContentPageParser(BasePageParser):
 
+    RELATED_INPUTS = (
+        'partnumber',
+        'vehicleId',
+        'parent_category_rn',
+        'categoryId',
+        'catalogId',
+        'langId',
+        'storeId'
+    )
+
     def parse_related(self, soup):
         inputs = soup.find('div', {'class': 'form-group search-filed'})
         related = {'partnumber': ''}
         for input_ in inputs.find_all('input'):
-            if 'partnumber' in input_['name']:
-                related[input_['name']] = input_['value']
-            elif 'vehicleId' in input_['name']:
-                related[input_['name']] = input_['value']
-            elif 'parent_category_rn' in input_['name']:
-                related[input_['name']] = input_['value']
-            elif 'categoryId' in input_['name']:
-                related[input_['name']] = input_['value']
-            elif 'catalogId' in input_['name']:
-                related[input_['name']] = input_['value']
-            elif 'langId' in input_['name']:
-                related[input_['name']] = input_['value']
-            elif 'storeId' in input_['name']:
+            if any(related_input in input_['name'] for related_input in self.__class__.RELATED_INPUTS):
                 related[input_['name']] = input_['value']
         return related
 
-    def parse(self):
-        parsed_dict = {}
+    def parse_related_lxml(self, document):
+        div = document.xpath('//div[@class="form-group search-filed"]')[0]
+        related = {'partnumber': ''}
+        for input_ in div.iter('input'):
+            name = input_.attrib['name']
+            if any(related_input in name for related_input in self.__class__.RELATED_INPUTS):
+                related[name] = input_.attrib['value']
+        return related
+
+    def _parse_soup(self):
         soup = BeautifulSoup(self._html_stream, self.__class__.DEFAULT_PARSER)
         h2 = soup.find('h2', {'id': 'productName'})
         span = soup.find('span', {'id': 'productPartNumber'})
         image_list = soup.find_all('img', {'class': 'bdr img-responsive'})
-        images = [image['src'] for image in image_list]
-        js_parser = JSParser(soup)
+        return self.make_parsed_dict(
+            title=h2.get_text(),
+            number=span.text,
+            images=[image['src'] for image in image_list],
+            js_parser=JSParser(soup),
+            xhr_request_body=self.parse_related(soup)
+        )
+
+    def _parse_lxml(self):
+        document = lxml_document(self._html_stream)
+        h2 = document.xpath('//h2[@id="productName"]')[0]
+        span = document.xpath('//span[@id="productPartNumber"]')[0]
+        image_list = document.xpath('//img[@class="bdr img-responsive"]')
+        return self.make_parsed_dict(
+            title=h2.text_content(),
+            number=span.text_content(),
+            images=[image.attrib['src'] for image in image_list],
+            js_parser=JSParser(document),
+            xhr_request_body=self.parse_related_lxml(document)
+        )
+
+    def make_parsed_dict(self, title, number, images, js_parser, xhr_request_body):
+        # shared by both backends, gets raw texts of extracted elements
+        parsed_dict = {}
         slider_images = js_parser.get_slider_images()
         section_ids = js_parser.get_section_ids()
-        xhr_request_body = self.parse_related(soup)
         od_section = collections.OrderedDict() 
         sections_data = zip(section_ids, images)
         for section_id, image in sections_data:
@@ -319,23 +575,28 @@ class ContentPageParser(BasePageParser):
                 'xhr_request_body': xhr_dict,
                 'text': ''
             }
-        number = self.__class__.parse_number(span.text.split('\n'))
-        title = h2.get_text().replace('\n', '').strip()
+        number = self.__class__.parse_number(number.split('\n'))
+        title = title.replace('\n', '').strip()
         parsed_dict.update({
             'title': title, 
             'number': number, 
             'slider_images': slider_images,
-            'section_data': od_section
+            'section_data': od_section,
+            'usage_items': js_parser.get_usage_items() or [] # all usageItemsList fields
         })
         return parsed_dict
 
     @classmethod
-    def xhr_response_parser(cls, html_stream):
-        soup = BeautifulSoup(html_stream, cls.DEFAULT_PARSER)
-        h4s = soup.find_all('h4', {'class': 'panel-title'})
+    def xhr_response_parser(cls, html_stream, backend=None):
+        if cls.get_backend(backend) == 'lxml':
+            document = lxml_document(html_stream)
+            h4_texts = [h4.text_content() for h4 in document.xpath('//h4[{0}]'.format(has_class_xpath('panel-title')))]
+        else:
+            soup = BeautifulSoup(html_stream, cls.DEFAULT_PARSER)
+            h4_texts = [h4.get_text() for h4 in soup.find_all('h4', {'class': 'panel-title'})]
         text = ''
-        for h4 in h4s:
-	        text += h4.get_text().replace('\n', '').replace(' ', '').replace('\t', '') +'\n'
+        for h4_text in h4_texts:
+	        text += h4_text.replace('\n', '').replace(' ', '').replace('\t', '') +'\n'
         return text
 
 
@@ -0,0 +1,136 @@
+# Staged producer/consumer pipeline.
+# Every stage owns a bounded queue and a pool of worker threads:
+#   menu -> submenu -> list -> content -> related -> download
+# items flow downstream as soon as they are produced and bounded queues apply
+# back-pressure, so memory usage doesn't grow with the catalog size.
+import time
+import queue
+import itertools
+import functools
+import threading
+import traceback
+from profiling import NULL_SECTION
+
+_STOP = object() # sentinel, tells a worker to exit
+
+class Stage:
+
+    DEFAULT_QUEUE_SIZE = 256
+
+    def __init__(self, name, func, workers=1, queue_size=None, retry=None, metrics=None, priority=None):
+        # func(item, emit) -> emit(new_item) sends new_item to the next stage
+        # retry is retry.RetryScheduler, items failed with retry.retry_on exception are requeued later
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.retry = retry
+        self.metrics = metrics # metrics.Metrics, item processing time per stage
+        # priority(item) -> sort key, lowest first (scheduler.DeadlineScheduler), None -> FIFO
+        self.priority = priority
+        queue_class = queue.Queue if priority is None else queue.PriorityQueue
+        self.queue = queue_class(maxsize=queue_size or self.__class__.DEFAULT_QUEUE_SIZE)
+        self._seq = itertools.count() # FIFO among equal priorities, items aren't comparable
+        self.next_stage = None
+        self.processed = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def put(self, item, attempt=0):
+        self._put((attempt, item), self.priority(item) if self.priority is not None else None)
+
+    def _put(self, entry, key):
+        if self.priority is None:
+            self.queue.put(entry)
+        else:
+            self.queue.put((key, next(self._seq), entry))
+
+    def _get(self):
+        entry = self.queue.get()
+        return entry if self.priority is None else entry[2]
+
+    def _profile(self):
+        # profiling.Profiler section when this stage is profiled
+        return self.metrics.profile(stage=self.name) if self.metrics is not None else NULL_SECTION
+
+    def emit(self, item):
+        if self.next_stage is not None:
+            self.next_stage.put(item)
+
+    def _requeue(self, attempt, item):
+        # called by retry scheduler. task_done() of failed attempt is delayed until now,
+        # so Pipeline.run() doesn't think this stage is drained while item waits for retry.
+        self.put(item, attempt)
+        self.queue.task_done()
+
+    def _handle_error(self, attempt, item, exc):
+        # returns True when item was scheduled for retry
+        if self.retry is not None and isinstance(exc, self.retry.retry_on):
+            callback = functools.partial(self._requeue, attempt + 1, item)
+            if self.retry.retry((self.name, item), callback, attempt + 1, exc):
+                return True
+        else:
+            traceback.print_exc()
+        with self._lock:
+            self.failed += 1
+        return False
+
+    def _work(self):
+        while True:
+            entry = self._get()
+            if entry is _STOP:
+                self.queue.task_done()
+                return
+            attempt, item = entry
+            start = time.perf_counter()
+            try:
+                with self._profile():
+                    self.func(item, self.emit)
+            except Exception as exc:
+                # one broken item must not kill the worker
+                if self._handle_error(attempt, item, exc):
+                    continue
+            else:
+                with self._lock:
+                    self.processed += 1
+                if self.metrics is not None:
+                    self.metrics.observe('stage_seconds', time.perf_counter() - start, stage=self.name)
+            self.queue.task_done()
+
+    def start(self):
+        for index in range(self.workers):
+            thread = threading.Thread(
+                target=self._work,
+                name='{0}-{1}'.format(self.name, index),
+                daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        for thread in self._threads:
+            self._put(_STOP, (float('inf'),)) # after every item
+        for thread in self._threads:
+            thread.join()
+
+class Pipeline:
+
+    def __init__(self, stages):
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next_stage = next_stage
+
+    def queue_depths(self):
+        return {stage.name: stage.queue.qsize() for stage in self.stages}
+
+    def run(self, seeds):
+        for stage in self.stages:
+            stage.start()
+        for seed in seeds:
+            self.stages[0].put(seed)
+        # upstream items are emitted before upstream task_done() is called,
+        # so once stage N is drained nothing new can appear in stage N+1 queue
+        for stage in self.stages:
+            stage.queue.join()
+        for stage in self.stages:
+            stage.stop()
@@ -0,0 +1,238 @@
+# Opt-in profiling of chosen crawl phases, pipeline stages and parsers.
+# Targets are label values of metrics timers and stages:
+#   phases / stages -> menu, submenu, list, content, related, download (shard units: resource too)
+#   parsers         -> MenuPageParser, ListPageParser, ContentPageParser (covers ContentPageParser.xhr_response_parser)
+# Modes:
+#   sample   -> stacks of profiled threads are sampled every interval (wall clock, network waits show up too),
+#               <target>.folded is collapsed stack file for flamegraph.pl / speedscope
+#   cprofile -> deterministic cProfile, <target>.pstats and <target>.txt (top functions by cumulative time)
+#   memory   -> (with either mode) tracemalloc snapshot diff, <target>.alloc.txt with top allocation sites
+# Stages and parsers are profiled in the thread running them, --phases phase runs in engine worker threads,
+# every thread of the phase is profiled. Parsers run in parser processes with --parse-workers N,
+# only IPC wait is seen then, profile them with --parse-workers 0.
+# Off (no profiler) costs one attribute check per timer, non target sections one set lookup.
+import os
+import sys
+import pstats
+import cProfile
+import threading
+import tracemalloc
+import contextlib
+import collections
+
+NULL_SECTION = contextlib.nullcontext()
+
+class Profiler:
+
+    MODES = ('sample', 'cprofile')
+    INTERVAL = 0.005 # seconds between stack samples
+    TOP = 30 # lines of text reports
+    MEMORY_FRAMES = 1 # traceback depth kept by tracemalloc, reports are grouped by line
+
+    def __init__(self, targets, output_dir='profile', mode='sample', interval=None, memory=False, top=None):
+        if mode not in self.__class__.MODES:
+            raise ValueError('unknown profile mode: {0}'.format(mode))
+        self.targets = frozenset(targets)
+        self.output_dir = output_dir
+        self.mode = mode
+        self.interval = interval or self.__class__.INTERVAL
+        self.memory = memory
+        self.top = top or self.__class__.TOP
+        self._lock = threading.Lock()
+        self._active = {} # thread id -> target of its outermost profiled section (or of phase it was started in)
+        self._phase = None # target of running phase, threads started meanwhile are profiled
+        self._stacks = collections.defaultdict(collections.Counter) # target -> folded stack -> samples
+        self._profiles = {} # (thread id, target) -> cProfile.Profile, enabled again by every section
+        self._baselines = {} # target -> tracemalloc snapshot taken when target was entered first
+        self._snapshots = {} # target -> snapshot taken when phase ended (stage targets: at stop)
+        self.samples = 0
+        self.peak_memory = 0 # bytes, traced by tracemalloc
+        self._stop = threading.Event()
+        self._thread = None
+
+    def match(self, labels):
+        # profiled target of timer labels or None
+        for value in labels.values():
+            if value in self.targets or value.split('.', 1)[0] in self.targets:
+                return value
+        return None
+
+    def section(self, labels):
+        target = self.match(labels)
+        if target is None:
+            return NULL_SECTION
+        return _Section(self, target, 'phase' in labels)
+
+    # cProfile
+    def _thread_profile(self, target):
+        key = (threading.get_ident(), target)
+        with self._lock:
+            profile = self._profiles.get(key)
+            if profile is None:
+                profile = self._profiles[key] = cProfile.Profile()
+        return profile
+
+    def _enable(self, target):
+        profile = self._thread_profile(target)
+        try:
+            profile.enable()
+        except ValueError:
+            return None # other profiler active (python 3.12+ allows one), it sees this thread anyway
+        return profile
+
+    def _phase_thread_hook(self, frame, event, arg):
+        # threading.setprofile hook, the first event of every new thread joins it to the running phase
+        sys.setprofile(None)
+        with self._lock:
+            phase = self._phase
+            if phase is not None:
+                self._active[threading.get_ident()] = phase
+        if phase is not None and self.mode == 'cprofile':
+            self._enable(phase)
+
+    # sampling
+    def _fold(self, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append('{0} ({1}:{2})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def _sample(self):
+        sampler = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                active = dict(self._active)
+            if not active:
+                continue
+            for thread_id, frame in sys._current_frames().items():
+                target = active.get(thread_id)
+                if target is None or thread_id == sampler:
+                    continue
+                stack = self._fold(frame)
+                with self._lock:
+                    self._stacks[target][stack] += 1
+                    self.samples += 1
+
+    # memory
+    def _memory_baseline(self, target):
+        if self.memory and target not in self._baselines:
+            self._baselines[target] = tracemalloc.take_snapshot()
+
+    def _memory_snapshot(self, target):
+        if self.memory and target in self._baselines:
+            self._snapshots[target] = tracemalloc.take_snapshot()
+
+    def start(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start(self.__class__.MEMORY_FRAMES)
+        if self.mode == 'sample':
+            self._thread = threading.Thread(target=self._sample, name='profile-sampler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        # writes reports, returns their paths
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.memory:
+            for target in self._baselines:
+                if target not in self._snapshots:
+                    self._snapshots[target] = tracemalloc.take_snapshot()
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        paths = []
+        with self._lock:
+            for target, stacks in self._stacks.items():
+                paths.append(self._write_folded(target, stacks))
+            by_target = collections.defaultdict(list)
+            for (thread_id, target), profile in self._profiles.items():
+                by_target[target].append(profile)
+        for target, profiles in by_target.items():
+            paths.extend(self._write_pstats(target, profiles))
+        for target, snapshot in self._snapshots.items():
+            paths.append(self._write_allocations(target, self._baselines[target], snapshot))
+        return paths
+
+    def _path(self, target, suffix):
+        return os.path.join(self.output_dir, target + suffix)
+
+    def _write_folded(self, target, stacks):
+        path = self._path(target, '.folded')
+        with open(path, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write('{0} {1}\n'.format(stack, count))
+        return path
+
+    def _write_pstats(self, target, profiles):
+        for profile in profiles:
+            profile.disable() # pool threads are gone, their profiles were never disabled
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        path = self._path(target, '.pstats')
+        stats.dump_stats(path)
+        text_path = self._path(target, '.txt')
+        with open(text_path, 'w') as f:
+            stats.stream = f
+            stats.sort_stats('cumulative').print_stats(self.top)
+        return [path, text_path]
+
+    def _write_allocations(self, target, baseline, snapshot):
+        path = self._path(target, '.alloc.txt')
+        with open(path, 'w') as f:
+            f.write('# {0}: top {1} allocation sites, growth since first {0} section, peak traced {2} bytes\n'.format(
+                target, self.top, self.peak_memory
+            ))
+            for stat in snapshot.compare_to(baseline, 'lineno')[:self.top]:
+                f.write('{0}\n'.format(stat))
+        return path
+
+    def stats(self):
+        with self._lock:
+            return {'samples': self.samples, 'profiles': len(self._profiles), 'targets': len(self._stacks)}
+
+class _Section:
+
+    def __init__(self, profiler, target, phase):
+        self.profiler = profiler
+        self.target = target
+        self.phase = phase
+        self.entered = False
+        self.profile = None
+
+    def __enter__(self):
+        profiler = self.profiler
+        thread_id = threading.get_ident()
+        with profiler._lock:
+            # nested sections (parser inside stage or phase) are part of the outermost one
+            self.entered = thread_id not in profiler._active and profiler._phase is None
+            if self.entered:
+                profiler._active[thread_id] = self.target
+                if self.phase:
+                    profiler._phase = self.target
+                    threading.setprofile(profiler._phase_thread_hook)
+                profiler._memory_baseline(self.target)
+        if self.entered and profiler.mode == 'cprofile':
+            self.profile = profiler._enable(self.target)
+        return self
+
+    def __exit__(self, *exc_info):
+        if not self.entered:
+            return
+        profiler = self.profiler
+        thread_id = threading.get_ident()
+        if self.profile is not None:
+            self.profile.disable()
+        with profiler._lock:
+            if self.phase:
+                threading.setprofile(None)
+                profiler._phase = None
+                for thread_id, target in list(profiler._active.items()):
+                    if target == self.target:
+                        del profiler._active[thread_id] # worker threads of the phase are gone
+                profiler._memory_snapshot(self.target)
+            else:
+                del profiler._active[thread_id]
@@ -0,0 +1,68 @@
+# Related items (FordRelatedItemsView XHR) of product page sections.
+# Responses are memoized on normalized request parameters (ContentPageParser.parse_related + sectionId),
+# the same part/section is requested once per crawl even when listed again or retried.
+# Own concurrency limit: XHRs can't starve product pages and images of connections.
+import threading
+import collections
+
+def normalize_params(params):
+    # order and surrounding whitespace of values don't change the response
+    return tuple(sorted((name, str(value).strip()) for name, value in params.items()))
+
+class RelatedItems:
+
+    DEFAULT_CONCURRENCY = 8 # XHRs in flight
+    MAX_ENTRIES = 100000 # memoized texts, least recently used are dropped
+
+    def __init__(self, fetch_text, concurrency=None, max_entries=None):
+        # fetch_text(params) -> parsed related items text, raises RequestException
+        self.fetch_text = fetch_text
+        self._slots = threading.BoundedSemaphore(concurrency or self.__class__.DEFAULT_CONCURRENCY)
+        self._lock = threading.Lock()
+        self.max_entries = max_entries or self.__class__.MAX_ENTRIES
+        self._texts = collections.OrderedDict() # normalized params -> text
+        self._pending = {} # normalized params -> threading.Event, requested by other thread
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, params):
+        # concurrent callers with equal params wait for one request, failed request is repeated by the next one
+        key = normalize_params(params)
+        while True:
+            with self._lock:
+                if key in self._texts:
+                    self._texts.move_to_end(key)
+                    self.hits += 1
+                    return self._texts[key]
+                event = self._pending.get(key)
+                if event is None:
+                    event = self._pending[key] = threading.Event()
+                    break
+            event.wait()
+        try:
+            with self._slots:
+                text = self.fetch_text(params)
+            with self._lock:
+                self._texts[key] = text
+                self.misses += 1
+                if len(self._texts) > self.max_entries:
+                    self._texts.popitem(last=False)
+            return text
+        finally:
+            with self._lock:
+                del self._pending[key]
+            event.set()
+
+    def fetch_resource(self, resource):
+        # fills text of every section still without it, returns number of sections filled
+        filled = 0
+        for section in resource.sections:
+            if section.text:
+                continue # fetched by previous attempt or loaded from journal
+            section.text = self.get(resource.xhr_params(section))
+            filled += 1
+        return filled
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'unique': len(self._texts)}
@@ -1,94 +1,182 @@
 # We are trying to avoid "Circular Import"
 import os
-import requests
-import collections
-import app
+import sys
+import threading
+import httpsession
+import collections.abc
+from filedownload import download_file
 from utils import (
-    correct_name_generator, get_svg, set_cookie
+    correct_name_generator, get_svg, set_cookie, write_atomic
 )
 
-DEFAULT_CHUNK_SIZE = 1024
+def split_url(url):
+    # (prefix, name), prefix is interned: resources of the same listing share one prefix string
+    index = url.rfind('/') + 1
+    return sys.intern(url[:index]), url[index:]
+
+class Section:
+
+    # one section of product page, xhr parameters are Resource.related + sectionId
+    __slots__ = ('section_id', 'image', 'text')
+
+    def __init__(self, section_id, image, text=''):
+        self.section_id = section_id
+        self.image = image
+        self.text = text
 
 class Resource:
 
     # __slots__ is advance feature of python
     # we can reduce usage of RAM, because we don't have __dict__ attribute anymore.
+    # url is kept as (interned prefix, name), parsed content as tuples and Section objects,
+    # dictionaries only exist while content is saved (content_dict) or requested (xhr_params)
     
     __slots__ = (
         'title',
         'number',
-        'dirname',
-        'url',
+        '_url_prefix',
+        '_url_name',
         'slider_images',
-        'sections_data'
+        'related',
+        'sections'
     )
 
     SECTION_IMAGES = 'https://parts.ford.com/images/section-images/'
     RELATED_ITEMS_URL = 'https://parts.ford.com/shop/FordRelatedItemsView'
+    COOKIES = None # loaded once per process, see get_cookies
+    _cookies_lock = threading.Lock()
 
     def __init__(self, url):
-        self.url = url
-        cookies = set_cookie()
-        setattr(type(self), 'COOKIES', cookies) # COOKIES is static variable
+        self._url_prefix, self._url_name = split_url(url)
+        self.title = None
+        self.number = None
+        self.slider_images = None
+        self.related = None
+        self.sections = None # None until product page is parsed
+
+    @property
+    def url(self):
+        return self._url_prefix + self._url_name
+
+    @property
+    def dirname(self):
+        return '{title}_{number}'.format(title=self.title, number=self.number)
+
+    @classmethod
+    def get_cookies(cls):
+        # cookies.json is read by the first caller only
+        with cls._cookies_lock:
+            if cls.COOKIES is None:
+                cls.COOKIES = set_cookie()
+            return cls.COOKIES
+
+    @classmethod
+    def session_fetch(cls, url, kind=None, **kwargs):
+        return httpsession.shared_session(cls.get_cookies()).get(url, **kwargs)
+
+    def set_content(self, parsed_dict):
+        # parsed_dict is ContentPageParser.parse output or content_dict() saved by journal
+        self.title = parsed_dict['title']
+        self.number = parsed_dict['number']
+        self.slider_images = tuple(parsed_dict['slider_images'])
+        self.related = ()
+        sections = []
+        for section_id, section_value in parsed_dict['section_data'].items():
+            if not self.related:
+                # every section has the same xhr parameters, only sectionId differs
+                self.related = tuple(
+                    (sys.intern(key), sys.intern(value))
+                    for key, value in section_value['xhr_request_body'].items()
+                    if key != 'sectionId'
+                )
+            sections.append(Section(section_id, sys.intern(section_value['image']), section_value['text']))
+        self.sections = tuple(sections)
+
+    def xhr_params(self, section):
+        params = dict(self.related)
+        params['sectionId'] = section.section_id
+        return params
+
+    def content_dict(self):
+        # JSON-able form of parsed content, same layout as ContentPageParser.parse output
+        return {
+            'title': self.title,
+            'number': self.number,
+            'slider_images': list(self.slider_images),
+            'section_data': {
+                section.section_id: {
+                    'image': section.image,
+                    'xhr_request_body': self.xhr_params(section),
+                    'text': section.text
+                }
+                for section in self.sections
+            },
+        }
+
+    def __repr__(self):
+        return '<Resource {url}>'.format(url=self.url)
     
-    def download(self, new_dir):
+    @staticmethod
+    def _save(url, path, fetch, store, kind, chunk_size):
+        # returns response status code
+        if store is not None:
+            return store.save(url, path, fetch, kind=kind)
+        return download_file(url, path, fetch, kind=kind, chunk_size=chunk_size)
+
+    def iter_files(self):
+        # (path relative to resource directory, kind, source) of every file of the resource
+        # kind is 'text' (source is file content) or 'image'/'svg' (source is url)
         for slider_image in self.slider_images:
-            os_slider_image = os.path.basename(slider_image)
-            slider_image_path = os.path.join(new_dir, correct_name_generator(os_slider_image))
-            response = requests.get(slider_image, cookies=self.__class__.COOKIES)
-            with open(slider_image_path, 'wb') as f:
-                f.write(response.content)
-        section_data_dict = self.sections_data.items()
-        with open(os.path.join(new_dir, 'www'), 'w+') as f:
-            f.write(self.url)
-        for index, (section_id, section_data) in enumerate(section_data_dict, start=1):
-            image = section_data['image'].lstrip('/')
+            yield correct_name_generator(os.path.basename(slider_image)), 'image', slider_image
+        yield 'www', 'text', self.url
+        for index, section in enumerate(self.sections, start=1):
+            image = section.image.lstrip('/')
             if 'http' not in image:
                 image = os.path.join(self.__class__.SECTION_IMAGES, image)
-            if len(section_data_dict) == 1:
-                filename = os.path.basename(image)
-                image_path = os.path.join(new_dir, filename) if filename else ''
-                with open(os.path.join(new_dir, 'related_parts'), 'w+') as f:
-                    f.write(section_data['text'])
+            # one section -> files are in resource directory, else directory per section (represents sectionId)
+            section_dir = '' if len(self.sections) == 1 else correct_name_generator(str(index))
+            if section.text is not None: # None -> related items weren't requested
+                yield os.path.join(section_dir, 'related_parts'), 'text', section.text
+            filename = os.path.basename(image)
+            if filename:
+                yield os.path.join(section_dir, filename), 'image', image
+                yield get_svg(os.path.join(section_dir, filename)), 'svg', get_svg(image)
+
+    def download(self, new_dir, fetch=None, store=None, chunk_size=None):
+        # fetch is CrawlEngine.fetch like callable (respects concurrency limits, kind is for metrics)
+        # store is blobstore.BlobStore, shared images are downloaded once and hardlinked here
+        # files are streamed and renamed when complete, retried download continues where it stopped
+        if fetch is None:
+            fetch = self.__class__.session_fetch
+        for path, kind, source in self.iter_files():
+            path = os.path.join(new_dir, path)
+            if os.path.dirname(path) != new_dir:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            if kind == 'text':
+                write_atomic(path, source)
             else:
-                dir_index = str(index) # this is directory name... represents sectionId
-                dir_with_section = app.OSMixin.create_subdir(new_dir, correct_name_generator(dir_index))
-                with open(os.path.join(dir_with_section, 'related_parts'), 'w+') as f:
-                    f.write(section_data['text'])
-                filename = os.path.basename(image)
-                image_path = os.path.join(dir_with_section, filename) if filename else ''
-            response = requests.get(image, cookies=self.__class__.COOKIES)
-            if image_path:
-                with open(image_path, 'wb') as f:
-                    f.write(response.content)
-                image_to_svg = get_svg(image)
-                svg_image_response = requests.get(image_to_svg, cookies=self.__class__.COOKIES, stream=True)
-                if svg_image_response.status_code == 200:
-                    get_svg_path = get_svg(image_path)
-                    with open(get_svg_path, 'wb') as f:
-                        for chunk in svg_image_response.iter_content(chunk_size=DEFAULT_CHUNK_SIZE):
-                            if chunk:
-                                f.write(chunk)
+                self._save(source, path, fetch, store, kind, chunk_size)
 
 # uses list_iterator object behind the scenes !!!
-class ResourceSet(collections.Iterable):
+class ResourceSet(collections.abc.Iterable):
     
     def __init__(self):
         self.container = []
 
     def __str__(self):
-        left_expression = '['
-        right_expression = ']'
-        beautify = ''
-        for item in self.container:
-            beautify += item.url + ', '
-        beautify = left_expression + beautify.rstrip(', ') +  right_expression
-        return beautify
+        return '[' + ', '.join(item.url for item in self.container) + ']'
 
     __repr__ = __str__
 
     def __iter__(self):
         return iter(self.container)
+
+    @classmethod
+    def from_urls(cls, urls):
+        resource_set = cls()
+        for url in urls:
+            resource_set.add(Resource(url=url))
+        return resource_set
     
     def __len__(self):
         return len(self.container)
@@ -0,0 +1,82 @@
+# Retry scheduler: exponential backoff with jitter, max attempts and dead-letter list.
+# Failed items wait in a heap until their retry time, workers keep processing other items.
+import time
+import heapq
+import random
+import itertools
+import threading
+import collections
+
+DeadLetter = collections.namedtuple('DeadLetter', ['key', 'attempts', 'error'])
+
+class RetryScheduler:
+
+    DEFAULT_MAX_ATTEMPTS = 5
+    DEFAULT_BASE_DELAY = 1.0 # seconds, doubled on every attempt
+    DEFAULT_MAX_DELAY = 120.0
+
+    def __init__(self, max_attempts=None, base_delay=None, max_delay=None, retry_on=(Exception,)):
+        self.retry_on = retry_on # exception classes which are worth retrying
+        self.max_attempts = max_attempts or self.__class__.DEFAULT_MAX_ATTEMPTS
+        self.base_delay = self.__class__.DEFAULT_BASE_DELAY if base_delay is None else base_delay
+        self.max_delay = self.__class__.DEFAULT_MAX_DELAY if max_delay is None else max_delay
+        self.retries = 0
+        self.dead_letters = []
+        self._heap = [] # (due, seq, callback)
+        self._seq = itertools.count() # tie breaker, callbacks aren't comparable
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def delay(self, attempt):
+        # "full jitter": uniform(0, base * 2 ** attempt), spreads retries of a failed burst
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(0, ceiling)
+
+    def retry(self, key, callback, attempt, error):
+        # attempt is number of failed attempts so far.
+        # returns True when callback is scheduled, False when item goes to dead letters.
+        if attempt >= self.max_attempts:
+            self.dead_letter(key, attempt, error)
+            return False
+        due = time.monotonic() + self.delay(attempt)
+        with self._condition:
+            self.retries += 1
+            heapq.heappush(self._heap, (due, next(self._seq), callback))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='retry-scheduler', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return True
+
+    def dead_letter(self, key, attempt, error):
+        with self._condition:
+            self.dead_letters.append(DeadLetter(key, attempt, repr(error)))
+
+    def pending(self):
+        with self._condition:
+            return len(self._heap)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._condition.wait(timeout)
+                due, seq, callback = heapq.heappop(self._heap)
+            callback() # outside the lock, callback may block on a full queue
+
+    def call(self, key, func, *args):
+        # blocking variant for the phase by phase mode: retries func in the calling thread.
+        # returns None when all attempts failed.
+        attempt = 0
+        while True:
+            try:
+                return func(*args)
+            except self.retry_on as exc:
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    self.dead_letter(key, attempt, exc)
+                    return None
+                with self._condition:
+                    self.retries += 1
+                time.sleep(self.delay(attempt))
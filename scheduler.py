@@ -0,0 +1,197 @@
+# Deadline-aware crawl scheduler.
+# The Ford session lives ~6-7 hours, the most valuable part of the catalog has to be finished before that:
+#   menu weights       -> submenus of heavier menus are listed, parsed and downloaded first
+#   smallest first     -> among equal weights, submenus with fewer list pages first (more complete submenus)
+#   content first      -> request slots go to menu/list/product/XHR requests before images when both wait
+#   deadline           -> no new resource is started after it, unfinished ones stay in the journal for next run
+# ETA is estimated from measured request latency and get_num_pages counts, printed every eta_interval seconds.
+import time
+import heapq
+import datetime
+import itertools
+import threading
+
+class PrioritySlots:
+
+    # BoundedSemaphore replacement, waiting acquirers are served lowest priority value first
+
+    def __init__(self, value):
+        self.value = value
+        self._condition = threading.Condition()
+        self._waiters = [] # (priority, seq)
+        self._seq = itertools.count()
+
+    def acquire(self, priority=0):
+        with self._condition:
+            entry = (priority, next(self._seq))
+            heapq.heappush(self._waiters, entry)
+            while self.value == 0 or self._waiters[0] != entry:
+                self._condition.wait()
+            heapq.heappop(self._waiters)
+            self.value -= 1
+            self._condition.notify_all() # next waiter may fit too
+
+    def release(self):
+        with self._condition:
+            self.value += 1
+            self._condition.notify_all()
+
+    def slot(self, priority=0):
+        return _Slot(self, priority)
+
+class _Slot:
+
+    def __init__(self, slots, priority):
+        self.slots = slots
+        self.priority = priority
+
+    def __enter__(self):
+        self.slots.acquire(self.priority)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.slots.release()
+
+class DeadlineScheduler:
+
+    # request kinds in order of importance when content_first is on
+    KIND_PRIORITIES = {'menu': 0, 'list': 1, 'content': 2, 'xhr': 3, 'image': 4, 'svg': 4}
+    DEFAULT_REQUESTS_PER_RESOURCE = 8 # product page, XHRs, images, until measured
+    DEFAULT_ETA_INTERVAL = 60.0
+
+    def __init__(self, deadline=None, menu_weights=None, smallest_first=False, content_first=False,
+                 resources_per_page=None, eta_interval=None):
+        self.deadline = deadline # seconds since start, None -> no time budget
+        self.menu_weights = menu_weights or {} # menu name -> weight, default 1
+        self.smallest_first = smallest_first
+        self.content_first = content_first
+        self.resources_per_page = resources_per_page # expected, until list pages are parsed
+        self.eta_interval = eta_interval or self.__class__.DEFAULT_ETA_INTERVAL
+        self.started = time.monotonic()
+        self.concurrency = 1 # set by engine
+        self._lock = threading.Lock()
+        self._submenus = {} # submenu directory -> [weight, num_pages, seq]
+        self._seq = itertools.count()
+        self.pages_total = 0
+        self.pages_done = 0
+        self.resources_listed = 0
+        self.resources_done = 0
+        self.resource_requests = 0 # requests of finished resources
+        self.requests = 0
+        self.request_seconds = 0.0
+        self.deferred = 0 # resources not started because of deadline
+        self._stop = threading.Event()
+        self._thread = None
+
+    # priorities
+    def request_priority(self, kind):
+        return self.__class__.KIND_PRIORITIES.get(kind, 0) if self.content_first else 0
+
+    def add_submenu(self, subdirname, menu_name):
+        with self._lock:
+            if subdirname not in self._submenus:
+                self._submenus[subdirname] = [self.menu_weights.get(menu_name, 1), None, next(self._seq)]
+
+    def item_priority(self, subdirname):
+        # sort key of pipeline items and phase work lists, lower is sooner
+        with self._lock:
+            weight, num_pages, seq = self._submenus.get(subdirname) or (1, None, 0)
+        if not self.smallest_first:
+            return (-weight, seq)
+        return (-weight, num_pages if num_pages is not None else float('inf'), seq)
+
+    # progress
+    def set_num_pages(self, subdirname, num_pages):
+        with self._lock:
+            if subdirname in self._submenus:
+                self._submenus[subdirname][1] = num_pages
+            self.pages_total += num_pages
+
+    def page_done(self, resources_count):
+        with self._lock:
+            self.pages_done += 1
+            self.resources_listed += resources_count
+
+    def resource_done(self, requests):
+        with self._lock:
+            self.resources_done += 1
+            self.resource_requests += requests
+
+    def observe_request(self, seconds):
+        with self._lock:
+            self.requests += 1
+            self.request_seconds += seconds
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def expired(self):
+        return self.deadline is not None and self.elapsed() >= self.deadline
+
+    def defer(self):
+        # True (and counted) when new resource mustn't be started any more
+        if not self.expired():
+            return False
+        with self._lock:
+            self.deferred += 1
+        return True
+
+    def estimate(self):
+        # (remaining requests, eta seconds), eta is None until the first request is measured
+        with self._lock:
+            pages_left = max(self.pages_total - self.pages_done, 0)
+            per_page = self.resources_listed / self.pages_done if self.pages_done else self.resources_per_page or 0
+            per_resource = (
+                self.resource_requests / self.resources_done if self.resources_done
+                else self.__class__.DEFAULT_REQUESTS_PER_RESOURCE
+            )
+            resources_left = max(self.resources_listed + pages_left * per_page - self.resources_done - self.deferred, 0)
+            remaining = pages_left + resources_left * per_resource
+            latency = self.request_seconds / self.requests if self.requests else None
+        if latency is None:
+            return remaining, None
+        return remaining, remaining * latency / self.concurrency
+
+    def stats(self):
+        remaining, eta = self.estimate()
+        with self._lock:
+            return {
+                'pages_total': self.pages_total,
+                'pages_done': self.pages_done,
+                'resources_listed': self.resources_listed,
+                'resources_done': self.resources_done,
+                'deferred': self.deferred,
+                'remaining_requests': int(remaining),
+                'eta_seconds': round(eta, 1) if eta is not None else None,
+                'deadline_seconds': round(self.deadline - self.elapsed(), 1) if self.deadline is not None else None,
+            }
+
+    def format_eta(self):
+        stats = self.stats()
+        eta = stats['eta_seconds']
+        line = '{0}/{1} resources, ~{2} requests left, ETA {3}'.format(
+            stats['resources_done'],
+            int(stats['resources_listed']),
+            stats['remaining_requests'],
+            datetime.timedelta(seconds=int(eta)) if eta is not None else '?'
+        )
+        if self.deadline is not None:
+            left = max(self.deadline - self.elapsed(), 0)
+            line += ', deadline in {0}'.format(datetime.timedelta(seconds=int(left)))
+            if eta is not None and eta > left:
+                line += " (won't finish, lowest priority work will be deferred)"
+        return line
+
+    def _run(self):
+        while not self._stop.wait(self.eta_interval):
+            print('ETA          =====================================> ', self.format_eta())
+
+    def start(self):
+        self.started = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name='eta-reporter', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
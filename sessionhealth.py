@@ -0,0 +1,162 @@
+# Session health: https://parts.ford.com/ deletes the session after ~6-7 hours.
+# Expired session answers with a redirect to the logon page (other redirects are normal: canonical URLs,
+# discontinued parts), or with a page without the markup
+# parsers need (AttributeError in parsers). Such response is detected right after the request:
+#   fetching is paused, cookies are loaded again from the provider, session gets them and
+#   fetching is resumed, the request fails with SessionExpired and is requeued by retry scheduler.
+# Cookies can also be rotated proactively, every rotate_after seconds, before the session dies.
+import json
+import time
+import threading
+import subprocess
+from urllib.parse import urlsplit
+import requests
+
+class SessionExpired(requests.exceptions.RequestException):
+    # RequestException subclass, retried like any other failed request
+    pass
+
+class FileCookieProvider:
+
+    # cookies.json (or other file) read again on every refresh, edit it while the crawl is paused
+
+    def __init__(self, path='cookies.json'):
+        self.path = path
+
+    def load(self):
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+class CommandCookieProvider:
+
+    # shell command printing cookies JSON, e.g. headless browser login script
+
+    def __init__(self, command):
+        self.command = command
+
+    def load(self):
+        return json.loads(subprocess.check_output(self.command, shell=True))
+
+class SessionHealth:
+
+    # expected markup of every page kind, the same elements parsers start with
+    MARKERS = {
+        'menu': b'heading1',
+        'list': b'resultCount',
+        'content': b'productName',
+        'xhr': None, # related items may be empty, only redirects are checked
+    }
+    EXPIRED_STATUSES = (401, 403)
+    LOGON_URL = '/shop/LogonForm' # only its path is compared, full URL works too
+    POLL_INTERVAL = 5.0 # seconds between provider loads while waiting for new cookies
+    REFRESH_TIMEOUT = 600.0 # give up waiting, crawl goes on (and fails) with old cookies
+
+    def __init__(self, session, provider, cache=None, rotate_after=None, refresh_timeout=None, poll_interval=None,
+                 logon_url=None):
+        self.session = session # httpsession.PooledSession
+        self.provider = provider # load() -> cookies dict
+        self.cache = cache # httpcache.HTTPCache, expired pages must not be served from it
+        self.rotate_after = rotate_after # seconds, None -> refresh only when expired session is detected
+        self.refresh_timeout = self.__class__.REFRESH_TIMEOUT if refresh_timeout is None else refresh_timeout
+        self.poll_interval = self.__class__.POLL_INTERVAL if poll_interval is None else poll_interval
+        self.logon_path = urlsplit(logon_url or self.__class__.LOGON_URL).path
+        self.generation = 0 # incremented by every cookie change
+        self._failed_generation = None # refresh of it gave no new cookies, it isn't paused for again
+        self.refreshed_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._resumed = threading.Event() # cleared while cookies are refreshed
+        self._resumed.set()
+        self._refreshing = False
+        self.expired_responses = 0
+        self.refreshes = 0
+        self.rotations = 0
+        self.failed_refreshes = 0
+        self.paused_seconds = 0.0
+
+    def wait(self):
+        # called before every request, returns generation of cookies the request is sent with
+        if self.rotate_after is not None and time.monotonic() - self.refreshed_at > self.rotate_after:
+            self.refresh(self.generation, wait=False)
+        self._resumed.wait()
+        return self.generation
+
+    def expired(self, response, kind):
+        markers = self.__class__.MARKERS
+        if kind not in markers:
+            return False # images and svgs don't need session
+        if response.status_code in self.__class__.EXPIRED_STATUSES:
+            return True
+        if response.history and urlsplit(response.url).path.startswith(self.logon_path):
+            return True # redirected to logon page
+        marker = markers[kind]
+        return marker is not None and response.status_code == 200 and marker not in response.content
+
+    def check(self, response, kind, generation):
+        # returns response, raises SessionExpired when it came from expired session
+        if not self.expired(response, kind):
+            return response
+        with self._lock:
+            self.expired_responses += 1
+        url = response.history[0].url if response.history else response.url
+        if self.cache is not None:
+            self.cache.invalidate(url)
+        response.close()
+        self.refresh(generation)
+        raise SessionExpired('session expired: {0}'.format(url), response=response)
+
+    def _load_cookies(self, wait):
+        # new cookies, None when provider keeps returning the current ones (or fails)
+        current = requests.utils.dict_from_cookiejar(self.session.cookies)
+        deadline = time.monotonic() + self.refresh_timeout
+        while True:
+            try:
+                cookies = self.provider.load()
+            except Exception as exc:
+                print('Cookie provider failed: {0!r}'.format(exc))
+                cookies = None
+            if cookies and cookies != current:
+                return cookies
+            if not wait or time.monotonic() + self.poll_interval > deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+    def refresh(self, generation, wait=True):
+        # only the first caller of a generation refreshes, requests of other threads are paused meanwhile
+        with self._lock:
+            if generation != self.generation or self._refreshing:
+                return
+            if wait and generation == self._failed_generation:
+                return # provider had nothing new, retries of expired requests don't stall the crawl again
+            self._refreshing = True
+            self._resumed.clear()
+        start = time.monotonic()
+        cookies = None
+        try:
+            cookies = self._load_cookies(wait)
+        finally:
+            with self._lock:
+                if cookies:
+                    self.session.cookies.clear()
+                    self.session.cookies.update(cookies)
+                    self.generation += 1
+                    if wait:
+                        self.refreshes += 1
+                    else:
+                        self.rotations += 1
+                elif wait:
+                    self.failed_refreshes += 1
+                    self._failed_generation = generation
+                self.refreshed_at = time.monotonic()
+                self.paused_seconds += time.monotonic() - start
+                self._refreshing = False
+                self._resumed.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'expired_responses': self.expired_responses,
+                'refreshes': self.refreshes,
+                'rotations': self.rotations,
+                'failed_refreshes': self.failed_refreshes,
+                'paused_seconds': round(self.paused_seconds, 3),
+            }
@@ -0,0 +1,265 @@
+# Output sinks, where downloaded resources are written.
+#   dirs -> directory per menu / submenu / resource / section (original layout)
+#   tar  -> same tree packed into sharded tar archives, millions of tiny files become a few big ones
+#   pack -> one JSON line per resource in catalog.jsonl, images in blob store (content addressed)
+# Unique directory names are resolved from memory (UniqueNames) instead of os.path.exists probing.
+import os
+import io
+import json
+import glob
+import tarfile
+import tempfile
+import threading
+from filedownload import download_file
+from utils import generate_unique_dirname
+
+class UniqueNames:
+
+    # in memory replacement of utils.generate_unique_dirname, same "-1" suffix rule
+
+    def __init__(self, listdir=False):
+        # listdir=True -> names already on disk are read once per parent directory
+        self.listdir = listdir
+        self._names = {} # parent -> set of names
+        self._lock = threading.Lock()
+
+    def _get_names(self, parent):
+        names = self._names.get(parent)
+        if names is None:
+            names = set(os.listdir(parent)) if self.listdir and os.path.isdir(parent) else set()
+            self._names[parent] = names
+        return names
+
+    def unique(self, parent, name):
+        with self._lock:
+            names = self._get_names(parent)
+            while name in names:
+                name += '-1'
+            names.add(name)
+            return os.path.join(parent, name)
+
+    def reserve(self, path):
+        # name from previous (resumed) run
+        with self._lock:
+            self._get_names(os.path.dirname(path)).add(os.path.basename(path))
+
+class DirectorySink:
+
+    def __init__(self, base_dir, store=None, chunk_size=None):
+        self.base_dir = base_dir
+        self.store = store
+        self.chunk_size = chunk_size
+        self.names = UniqueNames(listdir=True)
+
+    def menu_dir(self, menu_name):
+        # menu directory is reused when it already exists
+        dirname = os.path.join(self.base_dir, menu_name)
+        os.makedirs(dirname, exist_ok=True)
+        return dirname
+
+    def make_dir(self, parent, name):
+        while True:
+            dirname = self.names.unique(parent, name)
+            try:
+                os.mkdir(dirname)
+            except FileExistsError:
+                continue # created by other worker process meanwhile, next unique name
+            return dirname
+
+    def reuse(self, dirname):
+        # True when directory of previous run (journal) can be used again
+        if not os.path.isdir(dirname):
+            return False
+        self.names.reserve(dirname)
+        return True
+
+    def write_resource(self, resource, dirname, fetch):
+        resource.download(dirname, fetch=fetch, store=self.store, chunk_size=self.chunk_size)
+
+    def link(self, url, dirname, parent):
+        # later listing of the same part (dedup.ResourceIndex), returns False when already linked
+        link_path = os.path.join(parent, os.path.basename(dirname))
+        if os.path.lexists(link_path):
+            if os.path.realpath(link_path) == os.path.realpath(dirname):
+                return False # same submenu, or linked by previous (resumed) run
+            link_path = generate_unique_dirname(link_path) # other part with the same name
+        try:
+            os.symlink(os.path.relpath(dirname, parent), link_path)
+        except OSError:
+            # filesystem without symlinks, <submenu dir>/links manifest
+            with open(os.path.join(parent, 'links'), 'a') as f:
+                f.write('{0}\t{1}\n'.format(url, dirname))
+        return True
+
+    def close(self):
+        pass
+
+class PackedSink:
+
+    # common part of archive sinks, paths only exist in memory and in the index
+    INDEX_NAME = None
+
+    def __init__(self, base_dir, store=None, chunk_size=None):
+        self.base_dir = base_dir
+        self.store = store
+        self.chunk_size = chunk_size
+        self.names = UniqueNames()
+        self.tmp_dir = os.path.join(base_dir, 'tmp')
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._load_index()
+
+    def _index_path(self):
+        return os.path.join(self.base_dir, self.__class__.INDEX_NAME)
+
+    def _load_index(self):
+        # names written by previous runs stay unique
+        if not os.path.exists(self._index_path()):
+            return
+        with open(self._index_path(), 'r') as f:
+            for line in f:
+                self.names.reserve(os.path.join(self.base_dir, json.loads(line)['path']))
+
+    def _append_index(self, entry):
+        with open(self._index_path(), 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    def archive_name(self, path):
+        return os.path.relpath(path, self.base_dir)
+
+    def menu_dir(self, menu_name):
+        return os.path.join(self.base_dir, menu_name)
+
+    def make_dir(self, parent, name):
+        return self.names.unique(parent, name)
+
+    def reuse(self, dirname):
+        self.names.reserve(dirname)
+        return True
+
+    def _fetch_file(self, url, fetch, kind):
+        # returns (path of local copy, is temporary) or (None, False) for non 200 response
+        if self.store is not None:
+            status, digest = self.store.get(url, fetch, kind=kind)
+            return (self.store.blob_path(digest), False) if digest else (None, False)
+        fd, path = tempfile.mkstemp(dir=self.tmp_dir)
+        os.close(fd)
+        os.remove(path) # download_file skips existing paths
+        if download_file(url, path, fetch, kind=kind, chunk_size=self.chunk_size) != 200:
+            return None, False
+        return path, True
+
+class TarSink(PackedSink):
+
+    INDEX_NAME = 'index.jsonl' # {"path", "url", "shard"} per resource
+    SHARD_NAME = 'catalog-{0:05d}.tar'
+    SHARD_SIZE = 1024 ** 3 # bytes, next shard is started after this
+
+    def __init__(self, base_dir, store=None, chunk_size=None, shard_size=None):
+        super().__init__(base_dir, store=store, chunk_size=chunk_size)
+        self.shard_size = shard_size or self.__class__.SHARD_SIZE
+        # resumed run never appends to old shards, it starts new ones
+        self.shard_index = len(glob.glob(os.path.join(base_dir, 'catalog-*.tar')))
+        self._tar = None
+        self._shard_name = None
+
+    def _get_tar(self):
+        if self._tar is not None and self._tar.offset >= self.shard_size:
+            self._tar.close()
+            self._tar = None
+        if self._tar is None:
+            self._shard_name = self.__class__.SHARD_NAME.format(self.shard_index)
+            self._tar = tarfile.open(os.path.join(self.base_dir, self._shard_name), 'w')
+            self.shard_index += 1
+        return self._tar
+
+    def write_resource(self, resource, dirname, fetch):
+        # files are downloaded first, then the whole resource is appended to the shard at once
+        members = [] # (archive name, bytes or local path, is temporary)
+        try:
+            for path, kind, source in resource.iter_files():
+                name = os.path.join(self.archive_name(dirname), path)
+                if kind == 'text':
+                    members.append((name, source.encode(), False))
+                    continue
+                local_path, temporary = self._fetch_file(source, fetch, kind)
+                if local_path is not None:
+                    members.append((name, local_path, temporary))
+            with self._lock:
+                tar = self._get_tar()
+                for name, source, temporary in members:
+                    if isinstance(source, bytes):
+                        info = tarfile.TarInfo(name)
+                        info.size = len(source)
+                        tar.addfile(info, io.BytesIO(source))
+                    else:
+                        tar.add(source, arcname=name)
+                self._append_index({'path': self.archive_name(dirname), 'url': resource.url, 'shard': self._shard_name})
+        finally:
+            for name, source, temporary in members:
+                if temporary:
+                    os.remove(source)
+
+    def link(self, url, dirname, parent):
+        name = self.archive_name(self.names.unique(parent, os.path.basename(dirname)))
+        info = tarfile.TarInfo(name)
+        info.type = tarfile.SYMTYPE
+        info.linkname = os.path.relpath(dirname, parent)
+        with self._lock:
+            self._get_tar().addfile(info)
+            self._append_index({'path': name, 'url': url, 'shard': self._shard_name, 'link': info.linkname})
+        return True
+
+    def close(self):
+        with self._lock:
+            if self._tar is not None:
+                self._tar.close()
+                self._tar = None
+
+class PackSink(PackedSink):
+
+    # catalog.jsonl: {"path", "url", "title", "number", "files": {relative path: {"text"} or {"sha256"}}}
+    # images are blobs of blobstore.BlobStore, catalog.idx is {"path", "offset"} of every record
+    INDEX_NAME = 'catalog.idx'
+    CATALOG_NAME = 'catalog.jsonl'
+
+    def __init__(self, base_dir, store=None, chunk_size=None):
+        if store is None:
+            raise ValueError('pack output needs blob store')
+        super().__init__(base_dir, store=store, chunk_size=chunk_size)
+        self._catalog = open(os.path.join(base_dir, self.__class__.CATALOG_NAME), 'ab')
+
+    def _write_record(self, record):
+        with self._lock:
+            offset = self._catalog.tell()
+            self._catalog.write(json.dumps(record).encode() + b'\n')
+            self._catalog.flush()
+            self._append_index({'path': record['path'], 'offset': offset})
+
+    def write_resource(self, resource, dirname, fetch):
+        files = {}
+        for path, kind, source in resource.iter_files():
+            if kind == 'text':
+                files[path] = {'text': source}
+                continue
+            status, digest = self.store.get(source, fetch, kind=kind)
+            if digest is not None:
+                files[path] = {'url': source, 'sha256': digest}
+        self._write_record({
+            'path': self.archive_name(dirname),
+            'url': resource.url,
+            'title': resource.title,
+            'number': resource.number,
+            'files': files,
+        })
+
+    def link(self, url, dirname, parent):
+        name = self.archive_name(self.names.unique(parent, os.path.basename(dirname)))
+        self._write_record({'path': name, 'url': url, 'link': self.archive_name(dirname)})
+        return True
+
+    def close(self):
+        with self._lock:
+            self._catalog.close()
+
+SINKS = {'dirs': DirectorySink, 'tar': TarSink, 'pack': PackSink}
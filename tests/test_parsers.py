@@ -0,0 +1,78 @@
+# Parser backend parity: every backend returns exactly what the soup backend returns.
+# Pages are fixtures/*.html rendered by mockserver (the same pages benchmark.py parses).
+# >>> python -m unittest discover -s tests   (or python -m pytest -q tests)
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import parsers
+import mockserver
+
+PARSE_FUNCTIONS = (
+    ('MenuPageParser', 'menu', lambda html, backend: parsers.MenuPageParser(html, backend=backend).parse()),
+    ('ListPageParser', 'list', lambda html, backend: [
+        resource.url for resource in parsers.ListPageParser(html, backend=backend).parse()
+    ]),
+    ('ListPageParser.get_result_count', 'list', lambda html, backend: (
+        parsers.ListPageParser.get_result_count(html, backend=backend)
+    )),
+    ('ContentPageParser', 'content', lambda html, backend: parsers.ContentPageParser(html, backend=backend).parse()),
+    ('ContentPageParser.xhr_response_parser', 'xhr', lambda html, backend: (
+        parsers.ContentPageParser.xhr_response_parser(html, backend=backend)
+    )),
+)
+
+# server layouts the fixtures are rendered with, (MockFordServer kwargs, list per_page)
+LAYOUTS = (
+    (dict(menus=2, submenus=3, items=250, sections=2, slider_images=2), 12),
+    (dict(menus=3, submenus=1, items=40, sections=5, slider_images=0), 100),
+    (dict(menus=1, submenus=2, items=7, sections=1, slider_images=4, shared_items=3), 100),
+)
+
+def render_pages(server, per_page):
+    # fixture name -> rendered pages
+    return {
+        'menu': [server.menu_page()],
+        'list': [server.list_page(0, 0, per_page=per_page, page=page) for page in (1, 2)],
+        'content': [server.content_page(product) for product in ('0-0-0', '0-0-5', 'shared-1')],
+        'xhr': [server.xhr_page('PN-0-0-0', section) for section in ('1', '2')],
+    }
+
+class ParserParityTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pages = []
+        for server_kwargs, per_page in LAYOUTS:
+            server = mockserver.MockFordServer(**server_kwargs) # pages only, never started
+            try:
+                cls.pages.append(render_pages(server, per_page))
+            finally:
+                server.stop()
+
+    def test_backends_match_soup(self):
+        for name, fixture, parse in PARSE_FUNCTIONS:
+            for layout, pages in enumerate(self.pages):
+                for index, html in enumerate(pages[fixture]):
+                    expected = parse(html, 'soup')
+                    self.assertTrue(expected, '{0} parsed nothing from {1} page'.format(name, fixture))
+                    for backend in parsers.BasePageParser.BACKENDS:
+                        if backend == 'soup':
+                            continue
+                        with self.subTest(parser=name, backend=backend, layout=layout, page=index):
+                            self.assertEqual(parse(html, backend), expected)
+
+    def test_bytes_and_str_input(self):
+        # crawler passes response.content (bytes), journal replays may pass str
+        html = self.pages[0]['content'][0]
+        for backend in parsers.BasePageParser.BACKENDS:
+            with self.subTest(backend=backend):
+                self.assertEqual(
+                    parsers.ContentPageParser(html.encode(), backend=backend).parse(),
+                    parsers.ContentPageParser(html, backend=backend).parse()
+                )
+
+if __name__ == '__main__':
+    unittest.main()
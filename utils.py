@@ -23,6 +23,13 @@ def create_subdir(dir1, dir2):
         os.mkdir(subdirname)
     return subdirname
 
+def write_atomic(path, text):
+    # readers never see half written file, crash leaves old file or nothing
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
 def set_cookie():
     cookie_file = open('cookies.json', 'r')
     cookie_dict = json.load(cookie_file)
@@ -0,0 +1,189 @@
+# Shared work queue of a sharded crawl (SQLite lease table).
+# The crawl is split into claimable units: menu -> submenu -> list page -> resource (-> link).
+# Any number of worker processes (same box, or machines sharing a filesystem with working locks)
+# open the same database file and drain it together:
+#   claim     -> unit is leased to one worker for LEASE_SECONDS
+#   heartbeat -> worker renews leases of units it is still working on
+#   complete  -> unit is done, never claimed again
+#   release   -> unit failed, claimable again after backoff (failed for good after max_attempts)
+# Lease of a crashed (or stopped) worker expires and the unit is claimed by another worker.
+import os
+import json
+import time
+import socket
+import random
+import sqlite3
+import threading
+
+class WorkQueue:
+
+    LEASE_SECONDS = 60.0
+    MAX_ATTEMPTS = 5
+    BASE_DELAY = 1.0 # seconds, doubled on every failed attempt (full jitter, like retry.RetryScheduler)
+    MAX_DELAY = 120.0
+    # deeper units first: resources are finished before more list pages are expanded
+    PRIORITIES = {'menu': 0, 'submenu': 1, 'list': 2, 'resource': 3, 'link': -1}
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS units (
+            key TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            priority INTEGER NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            owner TEXT,
+            expires REAL NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS units_claim ON units (state, priority, expires);
+        CREATE TABLE IF NOT EXISTS links (
+            url TEXT NOT NULL,
+            parent TEXT NOT NULL,
+            PRIMARY KEY (url, parent)
+        );
+    '''
+
+    def __init__(self, path, worker_id=None, lease_seconds=None, max_attempts=None):
+        self.path = path
+        self.worker_id = worker_id or '{0}-{1}'.format(socket.gethostname(), os.getpid())
+        self.lease_seconds = lease_seconds or self.__class__.LEASE_SECONDS
+        self.max_attempts = max_attempts or self.__class__.MAX_ATTEMPTS
+        self._lock = threading.Lock()
+        # one connection per process shared by its threads, other processes have their own
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=60)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(self.__class__.SCHEMA)
+        self._heartbeat_stop = threading.Event()
+        self._heartbeat_thread = None
+        self.claimed = 0
+        self.completed = 0
+        self.released = 0
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._connection.execute(sql, params).fetchall()
+
+    def _fetch_one(self, sql, params=()):
+        rows = self._execute(sql, params)
+        return rows[0] if rows else None
+
+    @staticmethod
+    def unit_key(kind, *parts):
+        return '\t'.join((kind,) + parts)
+
+    def add(self, kind, key, payload):
+        # returns False when unit already exists (added by other worker or by previous attempt)
+        with self._lock:
+            cursor = self._connection.execute(
+                'INSERT OR IGNORE INTO units (key, kind, payload, priority) VALUES (?, ?, ?, ?)',
+                (key, kind, json.dumps(payload), self.__class__.PRIORITIES[kind])
+            )
+            return cursor.rowcount == 1
+
+    def exists(self, key):
+        return self._fetch_one('SELECT 1 FROM units WHERE key = ?', (key,)) is not None
+
+    def get(self, key):
+        # returns (state, payload) or (None, None)
+        row = self._fetch_one('SELECT state, payload FROM units WHERE key = ?', (key,))
+        return (row[0], json.loads(row[1])) if row else (None, None)
+
+    def update_payload(self, key, payload):
+        # progress of leased unit (e.g. directory already created), seen by the next attempt
+        self._execute('UPDATE units SET payload = ? WHERE key = ?', (json.dumps(payload), key))
+
+    def claim(self):
+        # returns (key, kind, payload) or None when nothing is claimable right now
+        now = time.time()
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE') # one claimer at a time across processes
+            try:
+                row = self._connection.execute(
+                    "SELECT key, kind, payload FROM units WHERE state IN ('pending', 'leased') AND expires <= ? "
+                    'ORDER BY priority DESC, rowid LIMIT 1',
+                    (now,)
+                ).fetchone()
+                if row is not None:
+                    self._connection.execute(
+                        "UPDATE units SET state = 'leased', owner = ?, expires = ? WHERE key = ?",
+                        (self.worker_id, now + self.lease_seconds, row[0])
+                    )
+                    self.claimed += 1
+                self._connection.execute('COMMIT')
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+        return (row[0], row[1], json.loads(row[2])) if row is not None else None
+
+    def complete(self, key):
+        self._execute(
+            "UPDATE units SET state = 'done', owner = NULL, error = NULL WHERE key = ? AND owner = ?",
+            (key, self.worker_id)
+        )
+        with self._lock:
+            self.completed += 1
+
+    def delay(self, attempt):
+        ceiling = min(self.__class__.MAX_DELAY, self.__class__.BASE_DELAY * 2 ** (attempt - 1))
+        return random.uniform(0, ceiling)
+
+    def release(self, key, error):
+        # failed attempt, unit becomes claimable after backoff or is failed for good
+        row = self._fetch_one('SELECT attempts FROM units WHERE key = ?', (key,))
+        attempts = (row[0] if row else 0) + 1
+        state = 'failed' if attempts >= self.max_attempts else 'pending'
+        self._execute(
+            'UPDATE units SET state = ?, owner = NULL, expires = ?, attempts = ?, error = ? WHERE key = ? AND owner = ?',
+            (state, time.time() + self.delay(attempts), attempts, repr(error), key, self.worker_id)
+        )
+        with self._lock:
+            self.released += 1
+
+    def heartbeat(self):
+        # renews leases of every unit this worker holds
+        self._execute(
+            "UPDATE units SET expires = ? WHERE state = 'leased' AND owner = ?",
+            (time.time() + self.lease_seconds, self.worker_id)
+        )
+
+    def _heartbeat_loop(self):
+        while not self._heartbeat_stop.wait(self.lease_seconds / 3):
+            self.heartbeat()
+
+    def start_heartbeat(self):
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat_loop, name='queue-heartbeat', daemon=True)
+        self._heartbeat_thread.start()
+
+    def stop_heartbeat(self):
+        self._heartbeat_stop.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join()
+
+    def active(self):
+        # units not finished yet (pending, waiting for retry or leased by any worker)
+        return self._fetch_one("SELECT COUNT(*) FROM units WHERE state IN ('pending', 'leased')")[0]
+
+    # duplicate listings of the same resource, linked when the crawl is finished
+    def add_link(self, url, parent):
+        self._execute('INSERT OR IGNORE INTO links (url, parent) VALUES (?, ?)', (url, parent))
+
+    def iter_links(self):
+        for url, parent in self._execute('SELECT url, parent FROM links'):
+            yield url, parent
+
+    def failed(self):
+        return self._execute("SELECT key, attempts, error FROM units WHERE state = 'failed'")
+
+    def counts(self):
+        rows = self._execute('SELECT state, COUNT(*) FROM units GROUP BY state')
+        return dict(rows)
+
+    def stats(self):
+        with self._lock:
+            return {'claimed': self.claimed, 'completed': self.completed, 'released': self.released}
+
+    def close(self):
+        self.stop_heartbeat()
+        with self._lock:
+            self._connection.close()